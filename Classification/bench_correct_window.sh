@@ -0,0 +1,48 @@
+#!/bin/bash
+
+# Full vs windowed corrective step on HIGGS: time per stage and AUC per stage.
+# WINDOWS lists the --correct_window values to compare (0 = full correction);
+# extra arguments are passed on to main_cls_cv.py and override the ones below.
+dataset=higgs
+WINDOWS=${WINDOWS:-"0 5 10"}
+
+BASEDIR=$(dirname "$0")
+OUTDIR="${BASEDIR}/ckpt/"
+
+if [ ! -d "${OUTDIR}" ]
+then   
+    echo "Output dir ${OUTDIR} does not exist, creating..."
+    mkdir -p ${OUTDIR}
+fi    
+
+for window in ${WINDOWS}
+do
+    python -u ${BASEDIR}/main_cls_cv.py \
+        --feat_d 28 \
+        --hidden_d 16 \
+        --boost_rate 1 \
+        --lr 0.005 \
+        --L2 .0e-3 \
+        --num_nets 40 \
+        --data ${dataset} \
+        --tr ${BASEDIR}/../data/${dataset}.train \
+        --te ${BASEDIR}/../data/${dataset}.test \
+        --batch_size 2048 \
+        --epochs_per_stage 1 \
+        --correct_epoch 1 \
+        --model_order second \
+        --normalization True \
+        --cv True \
+        --sparse False \
+        --correct_window ${window} \
+        --out_f ${OUTDIR}/${dataset}_cls_window${window} \
+        "$@" > ${OUTDIR}/${dataset}_correct_window${window}.log
+done
+
+for window in ${WINDOWS}
+do
+    log=${OUTDIR}/${dataset}_correct_window${window}.log
+    echo "--correct_window ${window}"
+    paste <(grep 'training time' ${log} | awk '{print $3, $6}') <(grep 'AUC@Test' ${log} | grep '^Stage:' | awk '{print "AUC@Test", $NF}') | awk '{print "  stage", $1, "time", $2, "sec,", $3, $4}'
+    grep 'Best validation stage' ${log} | sed 's/^/  /'
+done
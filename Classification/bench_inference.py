@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+import argparse
+import time
+import numpy as np
+import torch
+from data.data import LibSVMData
+from models.mlp import MLP_2HL
+from models.dynamic_net import DynamicNet
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--feat_d', type=int, required=True)
+parser.add_argument('--hidden_d', type=int, required=True)
+parser.add_argument('--num_nets', type=int, default=40)
+parser.add_argument('--model', type=str, default=None)      # checkpoint, random ensemble if not given
+parser.add_argument('--te', type=str, default=None)         # LibSVM test set, random rows if not given
+parser.add_argument('--num_rows', type=int, default=100000)
+parser.add_argument('--batch_sizes', type=str, default='1,64,2048,100000')
+parser.add_argument('--repeat', type=int, default=5)
+parser.add_argument('--sparse', default=False, type=lambda x: (str(x).lower() == 'true'))
+
+opt = parser.parse_args()
+
+
+def random_ensemble():
+    net_ensemble = DynamicNet(0., 1.)
+    for stage in range(opt.num_nets):
+        model = MLP_2HL.get_model(stage, opt)
+        for bn in [model.bn, model.bn2]:
+            bn.running_mean.normal_(0, 0.1)
+            bn.running_var.uniform_(0.5, 2.)
+        net_ensemble.add(model)
+    return net_ensemble
+
+
+def timeit(f, x, batch_size):
+    best = float('inf')
+    for _ in range(opt.repeat):
+        t0 = time.time()
+        with torch.no_grad():
+            for i in range(0, len(x), batch_size):
+                f(x[i:i + batch_size])
+        best = min(best, time.time() - t0)
+    return best
+
+
+if __name__ == "__main__":
+    if opt.model is not None:
+        net_ensemble = DynamicNet.from_file(opt.model, lambda stage: MLP_2HL.get_model(stage, opt))
+    else:
+        net_ensemble = random_ensemble()
+    net_ensemble.to_eval()
+
+    if opt.te is not None:
+        x = torch.from_numpy(LibSVMData(opt.te, opt.feat_d, False).feat)
+    else:
+        x = torch.randn(opt.num_rows, opt.feat_d)
+
+    fused = net_ensemble.fuse()
+    scripted = torch.jit.script(fused)
+    with torch.no_grad():
+        ref = net_ensemble.forward(x)[1]
+        err = (fused(x)[1] - ref).abs().max().item()
+    print(f'#Stages: {len(net_ensemble.models)}, #Rows: {len(x)}, threads: {torch.get_num_threads()}, max abs diff: {err:.2e}')
+
+    for batch_size in [int(b) for b in opt.batch_sizes.split(',')]:
+        rows = x[:max(batch_size, min(len(x), 20 * batch_size))]
+        t_loop = timeit(net_ensemble.forward, rows, batch_size)
+        t_fused = timeit(fused, rows, batch_size)
+        t_script = timeit(scripted, rows, batch_size)
+        print(f'Batch {batch_size:7d}: loop {len(rows) / t_loop:12.0f} rows/s, fused {len(rows) / t_fused:12.0f} rows/s '
+              f'({t_loop / t_fused:.1f}x), fused+script {len(rows) / t_script:12.0f} rows/s ({t_loop / t_script:.1f}x)')
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import argparse
+import time
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torch.utils.data.sampler import SubsetRandomSampler
+from data.data import LibSVMData, LibCSVData, LibSVMRegData, IndexedData
+from data.sparseloader import DataLoader
+from data.batchloader import BatchLoader
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--feat_d', type=int, required=True)
+parser.add_argument('--tr', type=str, default=None)         # dataset file, random rows if not given
+parser.add_argument('--format', type=str, default='libsvm', choices=['libsvm', 'csv', 'npz'])
+parser.add_argument('--num_rows', type=int, default=200000)
+parser.add_argument('--batch_sizes', type=str, default='256,2048')
+parser.add_argument('--num_workers', type=int, default=2)  # of the sparseloader DataLoader, as in training
+parser.add_argument('--repeat', type=int, default=3)
+
+opt = parser.parse_args()
+
+
+class RandomData(Dataset):
+    # Same layout and __getitem__ as LibSVMData
+    def __init__(self, num_rows, dim):
+        self.feat = np.random.rand(num_rows, dim).astype(np.float32)
+        self.label = np.sign(np.random.randn(num_rows)).astype(np.float32)
+
+    def __getitem__(self, index):
+        return self.feat[index, :], self.label[index]
+
+    def __len__(self):
+        return len(self.label)
+
+
+def get_data():
+    if opt.tr is None:
+        return RandomData(opt.num_rows, opt.feat_d)
+    if opt.format == 'libsvm':
+        return LibSVMData(opt.tr, opt.feat_d, False)
+    if opt.format == 'csv':
+        return LibCSVData(opt.tr, opt.feat_d)
+    return LibSVMRegData(opt.tr, opt.feat_d, False)
+
+
+def timeit(loader):
+    # Best of --repeat passes; every batch is touched so no loader can skip work
+    best = float('inf')
+    for _ in range(opt.repeat):
+        t0 = time.time()
+        total = 0.
+        for x, y, idx in loader:
+            total += float(x[0, 0]) + len(idx)
+        best = min(best, time.time() - t0)
+    return best
+
+
+if __name__ == "__main__":
+    data = IndexedData(get_data())
+    n = len(data)
+    subset = np.random.permutation(n)[:n // 2].tolist()
+    print(f'#Rows: {n}, #Features: {data.data.feat.shape[1]}, DataLoader workers: {opt.num_workers}')
+    modes = [('sequential', dict(shuffle=False)),
+             ('shuffle', dict(shuffle=True)),
+             ('subset sampler', dict(sampler=SubsetRandomSampler(subset), drop_last=True))]
+    for batch_size in [int(b) for b in opt.batch_sizes.split(',')]:
+        for name, kwargs in modes:
+            rows = len(subset) if 'sampler' in kwargs else n
+            t_old = timeit(DataLoader(data, batch_size, num_workers=opt.num_workers, **kwargs))
+            t_new = timeit(BatchLoader(data, batch_size, **kwargs))
+            print(f'Batch {batch_size:6d}, {name:14s}: DataLoader {rows / t_old:12.0f} rows/s, '
+                  f'BatchLoader {rows / t_new:12.0f} rows/s ({t_old / t_new:.1f}x)')
@@ -0,0 +1,83 @@
+import numpy as np
+import torch
+from torch.utils.data.sampler import SequentialSampler, RandomSampler, SubsetRandomSampler
+from data.data import IndexedData
+from data.sharded import ChunkShuffleSampler
+
+
+class BatchLoader(object):
+    """Loader for dense in-memory datasets (LibSVMData, LibCSVData,
+    LibSVMRegData, or IndexedData around one of them).
+
+    Every batch is gathered from the dataset's `feat` and `label` arrays with
+    a single slice (sequential order) or a single fancy index (shuffle or a
+    sampler) instead of one `__getitem__` per row and `default_collate`, and in
+    the calling process, so no batch goes through a worker queue. Batches are
+    the same tuples the sparseloader DataLoader yields: (x, y) or, for
+    IndexedData, (x, y, sample ids). Sequential batches share memory with the
+    dataset.
+
+    The arrays are looked up on every pass, so feat and label may be replaced
+    (e.g. after a split or scaling) after the loader is created. Datasets
+    with a `take` method (data/sharded.py) gather each batch themselves.
+    """
+    def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, drop_last=False):
+        if not self.supports(dataset):
+            raise TypeError(f'{type(dataset).__name__} has no dense feat array, use data.sparseloader.DataLoader')
+        if sampler is not None and shuffle:
+            raise ValueError('sampler option is mutually exclusive with shuffle')
+        if sampler is None:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.drop_last = drop_last
+
+    @staticmethod
+    def supports(dataset):
+        data = dataset.data if isinstance(dataset, IndexedData) else dataset
+        if hasattr(data, 'take'):
+            return True
+        return isinstance(getattr(data, 'feat', None), np.ndarray) and hasattr(data, 'label')
+
+    def _order(self):
+        # Row ids of one pass, None for 0 .. n-1 in order; the samplers of the
+        # training scripts are drawn in one call instead of row by row
+        if type(self.sampler) is SequentialSampler:
+            return None
+        if type(self.sampler) is RandomSampler and not self.sampler.replacement and len(self.sampler) == len(self.dataset):
+            return torch.randperm(len(self.dataset)).numpy()
+        if type(self.sampler) is SubsetRandomSampler:
+            indices = np.asarray(self.sampler.indices)
+            return indices[torch.randperm(len(indices)).numpy()]
+        if type(self.sampler) is ChunkShuffleSampler:
+            return self.sampler.permutation()
+        return np.fromiter(iter(self.sampler), dtype=np.int64)
+
+    def __iter__(self):
+        indexed = isinstance(self.dataset, IndexedData)
+        data = self.dataset.data if indexed else self.dataset
+        take = getattr(data, 'take', None)
+        if take is None:
+            feat, label = data.feat, np.asarray(data.label)
+            take = lambda rows: (feat[rows], label[rows])
+        order = self._order()
+        n = len(self.sampler)
+        stop = n - n % self.batch_size if self.drop_last else n
+        for start in range(0, stop, self.batch_size):
+            end = min(start + self.batch_size, n)
+            if order is None:
+                rows = slice(start, end)
+                idx = torch.arange(start, end)
+            else:
+                rows = order[start:end]
+                idx = torch.from_numpy(rows)
+            x, y = take(rows)
+            batch = (torch.from_numpy(x), torch.from_numpy(y))
+            yield batch + (idx,) if indexed else batch
+
+    def __len__(self):
+        n = len(self.sampler)
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
@@ -0,0 +1,106 @@
+import hashlib
+import os
+import shutil
+import warnings
+import numpy as np
+
+# Binary cache of parsed dataset files. The arrays parsed from a source file
+# are saved once as .npy files in a .npycache directory next to it and memory
+# mapped by every later run, so startup no longer re-parses the text. An entry
+# is keyed by the source name and the parse options, and records a
+# fingerprint of the source (size, mtime and its first and last MiB); it is
+# rebuilt when the source no longer matches. cached_dir keeps any other
+# files derived from a source the same way (e.g. the shards of data/sharded.py).
+
+_EDGE = 1 << 20
+
+
+def fingerprint(path):
+    st = os.stat(path)
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        h.update(f.read(_EDGE))
+        if st.st_size > 2 * _EDGE:
+            f.seek(-_EDGE, os.SEEK_END)
+            h.update(f.read(_EDGE))
+    return f'{st.st_size} {st.st_mtime_ns} {h.hexdigest()}'
+
+
+def _entry(root, key):
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(root)), '.npycache')
+    name = os.path.basename(root) + '.' + hashlib.sha1(repr(key).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, name)
+
+
+def _load(path):
+    # Copy-on-write maps: callers may change the arrays (e.g. relabel) without touching the files
+    names = sorted(f[:-4] for f in os.listdir(path) if f.endswith('.npy'))
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='c') for name in names}
+
+
+def _valid(path, source_fingerprint):
+    try:
+        with open(os.path.join(path, 'fingerprint')) as f:
+            return f.read().rstrip('\n') == source_fingerprint
+    except OSError:
+        return False
+
+
+def cached_dir(root, key, build):
+    """Cache directory of files derived from the file `root`.
+
+    :param key: the build options (anything with a stable repr), part of the entry name
+    :param build: called with an empty directory on a cache miss, writes the files into it
+    :return: path of the entry, None if it could not be stored
+    """
+    path = _entry(root, key)
+    source_fingerprint = fingerprint(root)
+    if _valid(path, source_fingerprint):
+        return path
+    tmp = f'{path}.tmp{os.getpid()}'
+    try:
+        os.makedirs(tmp)
+        build(tmp)
+        with open(os.path.join(tmp, 'fingerprint'), 'w') as f:
+            f.write(source_fingerprint + '\n')
+        shutil.rmtree(path, ignore_errors=True)     # stale entry
+        os.rename(tmp, path)
+    except OSError as e:
+        # read-only data directory, or another process stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not _valid(path, source_fingerprint):
+            warnings.warn(f'Could not cache {root}: {e}')
+            return None
+    print(f'Cached {root} in {path}')
+    return path
+
+
+def cached_arrays(root, key, parse, enabled=True, in_place=False):
+    """Arrays parsed from the file `root`, memory mapped from the cache.
+
+    :param key: the parse options (anything with a stable repr), part of the entry name
+    :param parse: called on a cache miss, returns a dict of name -> numpy array
+    :param enabled: parse without caching if False
+    :param in_place: call parse with the directory of the new entry (None when not caching);
+        it may write arrays there itself as <name>.npy (e.g. with np.lib.format.open_memmap),
+        those are not saved again
+    :return: dict of name -> array
+    """
+    run = (lambda path: parse(path)) if in_place else (lambda path: parse())
+    if not enabled:
+        return run(None)
+    parsed = {}
+
+    def build(path):
+        parsed.update(run(path))
+        for name, a in parsed.items():
+            fname = os.path.join(path, name + '.npy')
+            if isinstance(a, np.memmap) and os.path.exists(fname):
+                a.flush()
+            else:
+                np.save(fname, np.ascontiguousarray(a))
+
+    path = cached_dir(root, key, build)
+    if path is None:
+        return parsed or run(None)
+    return _load(path)
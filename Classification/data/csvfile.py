@@ -0,0 +1,106 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from data.stream import line_ranges, read_range, count_lines
+
+# Chunked, multi-threaded reader for the headerless numeric CSV files of
+# LibCSVData and CriteoCSVData. The file is cut into ranges of about
+# `chunk_bytes` on line boundaries. A first pass counts the rows of every
+# range, so that every range can then be parsed by pandas' C parser in a
+# thread and written as float32 straight into its rows of one preallocated
+# (optionally memory mapped .npy) feature array. At most `workers` ranges
+# are in memory at a time.
+
+_CHUNK = 1 << 24
+
+
+def _compact(arrays, starts, rows):
+    # Moves the parsed rows of every range down over the rows left empty by
+    # blank lines, returns the number of rows
+    dst = 0
+    for start, n in zip(starts, rows):
+        if start != dst:
+            for a in arrays:
+                a[dst:dst + n] = a[start:start + n]
+        dst += n
+    return dst
+
+
+def read_csv(path, label_col=0, weight_col=None, out=None, chunk_bytes=_CHUNK, workers=None):
+    """Float32 features, labels and weights of a headerless numeric CSV file.
+
+    :param label_col: column of the labels (negative counts from the end)
+    :param weight_col: column of the sample weights, None if there is none
+    :param out: .npy file the features are written to and memory mapped from, in memory if None
+    :return: (features, labels, weights); features are the other columns in order, weights may be None
+    """
+    workers = workers or len(os.sched_getaffinity(0))
+    ranges = line_ranges(path, max(1, -(-os.path.getsize(path) // chunk_bytes)))
+    with open(path, 'rb') as f:
+        num_cols = f.readline().count(b',') + 1
+    special = [c % num_cols for c in (label_col, weight_col) if c is not None]
+    feat_cols = np.array([c for c in range(num_cols) if c not in special])
+
+    with ThreadPoolExecutor(workers) as pool:
+        starts = np.concatenate([[0], np.cumsum(list(pool.map(lambda r: count_lines(read_range(path, *r)), ranges)))])
+    shape = (int(starts[-1]), len(feat_cols))
+    feat = np.empty(shape, np.float32) if out is None else np.lib.format.open_memmap(out, 'w+', np.float32, shape)
+    label = np.empty(shape[0], np.float32)
+    weights = np.empty(shape[0], np.float32) if weight_col is not None else None
+
+    def parse(k):
+        buf = read_range(path, *ranges[k])
+        if not buf.strip():
+            return 0
+        block = pd.read_csv(io.BytesIO(buf), header=None, dtype=np.float32).to_numpy(np.float32)
+        rows = slice(starts[k], starts[k] + len(block))
+        np.take(block, feat_cols, axis=1, out=feat[rows], mode='clip')
+        label[rows] = block[:, label_col]
+        if weights is not None:
+            weights[rows] = block[:, weight_col]
+        return len(block)
+    with ThreadPoolExecutor(workers) as pool:
+        rows = list(pool.map(parse, range(len(ranges))))
+
+    if sum(rows) < shape[0]:
+        # blank lines were counted as rows
+        arrays = [a for a in (feat, label, weights) if a is not None]
+        n = _compact(arrays, starts[:-1], rows)
+        feat, label = feat[:n], label[:n]
+        weights = weights[:n] if weights is not None else None
+        if out is not None:
+            np.save(out + '.tmp.npy', feat)
+            os.replace(out + '.tmp.npy', out)
+            feat = np.load(out, mmap_mode='r+')
+    return feat, label, weights
+
+
+def log_fill(feat, chunk_rows=1 << 16, workers=None):
+    """CriteoCSVData's normalization in place, chunk_rows rows at a time:
+    log(x - min + 1) with the minimum over all features, then missing values
+    set to the mean of their (transformed) column.
+    """
+    blocks = [slice(start, start + chunk_rows) for start in range(0, len(feat), chunk_rows)]
+    if not blocks:
+        return feat
+
+    def log(rows):
+        x = feat[rows]
+        np.subtract(x, mm, out=x)
+        np.add(x, 1, out=x)
+        np.log(x, out=x)
+        return np.nansum(x, 0, dtype=np.float64), np.sum(~np.isnan(x), 0)
+
+    def fill(rows):
+        x = feat[rows]
+        np.copyto(x, mean, where=np.isnan(x))
+
+    with ThreadPoolExecutor(workers or len(os.sched_getaffinity(0))) as pool:
+        mm = np.float32(np.nanmin(list(pool.map(lambda rows: np.nanmin(feat[rows]), blocks))))
+        sums, counts = zip(*pool.map(log, blocks))
+        with np.errstate(invalid='ignore'):
+            mean = (np.sum(sums, 0) / np.sum(counts, 0)).astype(np.float32)     # NaN for all-missing columns
+        list(pool.map(fill, blocks))
+    return feat
@@ -0,0 +1,117 @@
+import copy
+import os
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torch.utils.data.sampler import Sampler
+from data.cache import cached_dir
+from data.stream import iter_chunks
+
+# Out-of-core training data. The source file is streamed once, `shard_rows`
+# rows at a time, into .npy shards in its .npycache directory (data/cache.py)
+# and the shards are memory mapped: only the labels are held in memory and
+# the operating system pages feature rows in as batches touch them.
+# ChunkShuffleSampler orders the rows of a pass so that those pages are
+# mostly read in runs instead of at random.
+
+
+class ShardedData(Dataset):
+    """Disk-backed LibSVMData (fmt 'libsvm'; 'csv' and 'npz' read the
+    LibCSVData and LibSVMRegData layouts).
+
+    Batches are gathered with `take`, which BatchLoader uses. `subset(rows)`
+    is a view of some of the rows (e.g. the train / validation split) that
+    copies no features, and `transform`, if set, is applied to every
+    gathered block (e.g. a fitted scaler's transform).
+    """
+    def __init__(self, root, dim, pos=1, neg=-1, out_pos=1, out_neg=-1, fmt='libsvm', shard_rows=1 << 20, zero_based='auto'):
+        def build(path):
+            for i, (feat, label) in enumerate(iter_chunks(root, fmt, dim, shard_rows, zero_based, labels=True)):
+                np.save(os.path.join(path, f'feat.{i:05d}.npy'), feat)
+                np.save(os.path.join(path, f'label.{i:05d}.npy'), label)
+        path = cached_dir(root, ('shards', fmt, dim, shard_rows, zero_based), build)
+        if path is None:
+            raise OSError(f'Could not write the shards of {root}')
+        names = sorted(f[5:] for f in os.listdir(path) if f.startswith('feat.'))
+        self.shards = [np.load(os.path.join(path, 'feat.' + name), mmap_mode='r') for name in names]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.label = np.concatenate([np.load(os.path.join(path, 'label.' + name)) for name in names])
+        idx_pos = self.label == pos
+        idx_neg = self.label == neg
+        self.label[idx_pos] = out_pos
+        self.label[idx_neg] = out_neg
+        self.dim = dim
+        self.rows = None        # file row of every position, None for all rows in file order
+        self.transform = None
+
+    def subset(self, positions):
+        # Positions are kept in file order, so consecutive positions of the view stay close on disk
+        view = copy.copy(self)
+        positions = np.sort(np.asarray(positions))
+        view.rows = positions if self.rows is None else self.rows[positions]
+        view.label = self.label[positions]
+        return view
+
+    def _gather(self, index):
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(len(self)))
+        rows = index if self.rows is None else self.rows[index]
+        shard = np.searchsorted(self.offsets, rows, side='right') - 1
+        feat = np.empty((len(rows), self.dim), dtype=np.float32)
+        for s in np.unique(shard):
+            mask = shard == s
+            feat[mask] = self.shards[s][rows[mask] - self.offsets[s]]
+        return feat
+
+    def take(self, index):
+        """Features and labels at the given positions (a slice or an int array)."""
+        feat = self._gather(index)
+        if self.transform is not None:
+            feat = self.transform(feat).astype(np.float32, copy=False)
+        return feat, self.label[index]
+
+    def chunks(self, chunk_rows):
+        # Untransformed features of every position in order, e.g. to fit a scaler
+        for start in range(0, len(self), chunk_rows):
+            yield self._gather(slice(start, start + chunk_rows))
+
+    def __getitem__(self, index):
+        feat, label = self.take(np.array([index]))
+        return feat[0], label[0]
+
+    def __len__(self):
+        return len(self.label)
+
+
+class ChunkShuffleSampler(Sampler):
+    """Approximately uniform random order over `indices` that reads a
+    disk-backed dataset in runs.
+
+    The sorted indices are cut into chunks of `chunk_rows` consecutive
+    positions. Every pass visits the chunks in random order, `buffer_chunks`
+    of them at a time, and shuffles the rows of the chunks in this buffer
+    together, so a batch only touches the pages of `buffer_chunks` chunks.
+    With buffer_chunks at least the number of chunks this is a uniform
+    shuffle, like SubsetRandomSampler.
+    """
+    def __init__(self, indices, chunk_rows=4096, buffer_chunks=64):
+        self.indices = np.sort(np.asarray(indices, dtype=np.int64))
+        self.chunk_rows = chunk_rows
+        self.buffer_chunks = buffer_chunks
+
+    def permutation(self):
+        # One pass as an array, for BatchLoader
+        bounds = np.flatnonzero(np.diff(self.indices // self.chunk_rows)) + 1
+        chunks = np.split(self.indices, bounds)
+        order = torch.randperm(len(chunks)).tolist()
+        blocks = [self.indices[:0]]
+        for start in range(0, len(order), self.buffer_chunks):
+            buf = np.concatenate([chunks[c] for c in order[start:start + self.buffer_chunks]])
+            blocks.append(buf[torch.randperm(len(buf)).numpy()])
+        return np.concatenate(blocks)
+
+    def __iter__(self):
+        return iter(self.permutation().tolist())
+
+    def __len__(self):
+        return len(self.indices)
@@ -3,14 +3,24 @@ import numpy as np
 import sklearn
 import argparse
 import copy
+import os
+import sys
 import time
 import torch
 import torch.nn as nn
 from data.sparseloader import DataLoader
-from data.data import LibSVMData, LibCSVData, CriteoCSVData
+from data.batchloader import BatchLoader
+from data.data import LibSVMData, LibCSVData, CriteoCSVData, IndexedData
+from data.sharded import ShardedData, ChunkShuffleSampler
 from data.sparse_data import LibSVMDataSp
 from models.mlp import MLP_1HL, MLP_2HL, MLP_3HL
 from models.dynamic_net import DynamicNet, ForwardType
+from models.stage_cache import StageCache
+from models.checkpoint import StageCheckpoint
+from models.precision import bf16_autocast
+from models.candidates import train_candidates
+from models.plateau import EpochPlateau
+from models.distributed import init_distributed, shard_indices, broadcast_module, all_reduce_grads, average_buffers, broadcast_flag, all_reduce_mean
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from torch.utils.data.sampler import SubsetRandomSampler
 from torch.optim import SGD, Adam
@@ -30,48 +40,123 @@ parser.add_argument('--batch_size', type=int, required=True)
 parser.add_argument('--epochs_per_stage', type=int, required=True)
 parser.add_argument('--correct_epoch', type=int ,required=True)
 parser.add_argument('--L2', type=float, required=True)
+# End the learner and corrective epoch loops of a stage once their loss on a held-out slice of the
+# stage's training rows improves by less than this fraction (0: always run all the epochs)
+parser.add_argument('--plateau_tol', type=float, default=0.)
+# Fraction of the stage's training rows held out for --plateau_tol
+parser.add_argument('--plateau_holdout', type=float, default=0.05)
+# Epoch cap of both loops under --plateau_tol (0: --epochs_per_stage and --correct_epoch)
+parser.add_argument('--max_epochs', type=int, default=0)
 parser.add_argument('--sparse', default=False, type=lambda x: (str(x).lower() == 'true'))
 parser.add_argument('--normalization', default=False, type=lambda x: (str(x).lower() == 'true'))
 parser.add_argument('--cv', default=False, type=lambda x: (str(x).lower() == 'true')) 
 parser.add_argument('--model_order',default='second', type=str)
+# Train this many candidate learners per stage in forked processes (CPU only) and keep the one
+# with the lowest validation logloss (mean training loss without --cv)
+parser.add_argument('--candidates', type=int, default=1)
+# Learning rate multipliers cycled over the candidates; each candidate also gets its own seed
+parser.add_argument('--candidate_lr_scale', type=str, default='1')
+# Corrective step on the last N stages only (plus boost_rate), 0 corrects all of them
+parser.add_argument('--correct_window', type=int, default=0)
+# Recompute the corrective step's activations in backward, this many stages at a time (0: keep them all)
+parser.add_argument('--checkpoint_segment', type=int, default=0)
+# Keep the parsed dataset files as memory mapped .npy files in a .npycache directory next to them
+parser.add_argument('--data_cache', default=True, type=lambda x: (str(x).lower() == 'true'))
+# Train from memory mapped shards of --tr and --te (data/sharded.py) for datasets larger than RAM
+parser.add_argument('--out_of_core', default=False, type=lambda x: (str(x).lower() == 'true'))
+# Rows per shard file under --out_of_core
+parser.add_argument('--shard_rows', type=int, default=1 << 20)
+# Stage shuffling under --out_of_core: chunks of this many consecutive rows, mixed --shuffle_buffer chunks at a time
+parser.add_argument('--shuffle_chunk', type=int, default=4096)
+parser.add_argument('--shuffle_buffer', type=int, default=64)
+# Cache the frozen ensemble's outputs per sample (models/stage_cache.py). The frozen learners then run
+# in eval mode (BatchNorm running stats, left unchanged) instead of train mode, in the corrective step
+# too for the ones before --correct_window. The cache keeps the outputs of the learners a corrective
+# step did not change, so it saves work with --correct_window or --epochs_per_stage > 1
+parser.add_argument('--stage_cache', default=False, type=lambda x: (str(x).lower() == 'true'))
+# Gather dense batches with one slice or fancy index of the feature array (data/batchloader.py)
+# instead of per-row __getitem__ in loader workers
+parser.add_argument('--batch_loader', default=True, type=lambda x: (str(x).lower() == 'true'))
+# Score every prefix of the final ensemble once after training instead of re-scoring after each stage
+parser.add_argument('--staged_eval', default=False, type=lambda x: (str(x).lower() == 'true'))
+# Stop once AUC@Val has not improved for this many stages and keep the ensemble of the best stage (0: off)
+parser.add_argument('--patience', type=int, default=0)
 parser.add_argument('--out_f', type=str, required=True)
 parser.add_argument('--cuda', action='store_true')
+parser.add_argument('--num_threads', type=int, default=0)
+# Set by torch.distributed.launch; torchrun and the launcher's environment (RANK, WORLD_SIZE, ...)
+# start data-parallel training over gloo, see models/distributed.py
+parser.add_argument('--local_rank', type=int, default=0)
+# bfloat16 autocast for stage training, the corrective step and evaluation (CPU, torch >= 1.10)
+parser.add_argument('--bf16', default=False, type=lambda x: (str(x).lower() == 'true'))
 
 opt = parser.parse_args()
-
+if opt.bf16 and (opt.cuda or not hasattr(torch, 'autocast')):
+    parser.error('--bf16 needs CPU training and torch >= 1.10')
+if opt.patience and (not opt.cv or opt.staged_eval):
+    parser.error('--patience needs the per-stage validation of --cv True --staged_eval False')
+if opt.plateau_tol and not 0 < opt.plateau_holdout < 1:
+    parser.error('--plateau_holdout must be a fraction in (0, 1)')
+if opt.candidates > 1 and opt.cuda:
+    parser.error('--candidates needs CPU training')
+if opt.out_of_core and opt.data == 'real-sim':
+    parser.error('--out_of_core needs a dense dataset')
+
+device = torch.device('cuda' if opt.cuda else 'cpu')
 if not opt.cuda:
-    torch.set_num_threads(16)
+    # One intra-op thread per core available to this process (split between the ranks on this host) unless given
+    torch.set_num_threads(opt.num_threads or max(1, len(os.sched_getaffinity(0)) // int(os.environ.get('LOCAL_WORLD_SIZE', 1))))
+rank, world_size = init_distributed()
+if opt.candidates > 1 and world_size > 1:
+    parser.error('--candidates cannot be combined with distributed training')
 
 # prepare the dataset
+def libsvm_data(root, pos=1, neg=-1):
+    # LibSVMData, or its memory mapped shards under --out_of_core
+    if opt.out_of_core:
+        return ShardedData(root, opt.feat_d, pos, neg, shard_rows=opt.shard_rows)
+    return LibSVMData(root, opt.feat_d, opt.normalization, pos, neg, cache=opt.data_cache)
+
+def csv_data(root, pos=1, neg=-1):
+    if opt.out_of_core:
+        return ShardedData(root, opt.feat_d, pos, neg, fmt='csv', shard_rows=opt.shard_rows)
+    return LibCSVData(root, opt.feat_d, pos, neg, cache=opt.data_cache)
+
+def select(data, idx):
+    # Rows idx of a dataset: a view of the shards under --out_of_core, else a copy
+    if isinstance(data, ShardedData):
+        return data.subset(idx)
+    data = copy.copy(data)
+    data.feat, data.label = data.feat[idx], data.label[idx]
+    return data
+
 def get_data():
     if opt.data in ['a9a', 'ijcnn1']:
-        train = LibSVMData(opt.tr, opt.feat_d, opt.normalization)
-        test = LibSVMData(opt.te, opt.feat_d, opt.normalization)
+        train = libsvm_data(opt.tr)
+        test = libsvm_data(opt.te)
     elif opt.data == 'covtype':
-        train = LibSVMData(opt.tr, opt.feat_d,opt.normalization, 1, 2)
-        test = LibSVMData(opt.te, opt.feat_d, opt.normalization, 1, 2)
+        train = libsvm_data(opt.tr, 1, 2)
+        test = libsvm_data(opt.te, 1, 2)
     elif opt.data == 'mnist28':
-        train = LibSVMData(opt.tr, opt.feat_d, opt.normalization, 2, 8)
-        test = LibSVMData(opt.te, opt.feat_d, opt.normalization, 2, 8)
+        train = libsvm_data(opt.tr, 2, 8)
+        test = libsvm_data(opt.te, 2, 8)
     elif opt.data == 'higgs':
-        train = LibSVMData(opt.tr, opt.feat_d,opt.normalization, 0, 1)
-        test = LibSVMData(opt.te, opt.feat_d,opt.normalization, 0, 1)
+        train = libsvm_data(opt.tr, 0, 1)
+        test = libsvm_data(opt.te, 0, 1)
     elif opt.data == 'real-sim':
         train = LibSVMDataSp(opt.tr, opt.feat_d)
         test = LibSVMDataSp(opt.te, opt.feat_d)
     elif opt.data in ['criteo', 'criteo2', 'Allstate']:
-        train = LibCSVData(opt.tr, opt.feat_d, 1, 0)
-        test = LibCSVData(opt.te, opt.feat_d, 1, 0)
+        train = csv_data(opt.tr, 1, 0)
+        test = csv_data(opt.te, 1, 0)
     elif opt.data == 'yahoo.pair':
-        train = LibCSVData(opt.tr, opt.feat_d)
-        test = LibCSVData(opt.te, opt.feat_d)
+        train = csv_data(opt.tr)
+        test = csv_data(opt.te)
     else:
         pass
 
     val = []
     if opt.cv:
-        val = copy.deepcopy(train)
-
         # Split the data from cut point
         print('Creating Validation set! \n')
         indices = list(range(len(train)))
@@ -80,12 +165,18 @@ def get_data():
         train_idx = indices[:cut]
         val_idx = indices[cut:]
 
-        train.feat = train.feat[train_idx]
-        train.label = train.label[train_idx]
-        val.feat = val.feat[val_idx]
-        val.label = val.label[val_idx]
-
-    if opt.normalization:
+        val = select(train, val_idx)
+        train = select(train, train_idx)
+
+    scaler = None
+    if opt.normalization and opt.out_of_core:
+        # Fit on the training shards a shard at a time, scale every gathered batch
+        scaler = MinMaxScaler()
+        for x in train.chunks(opt.shard_rows):
+            scaler.partial_fit(x)
+        for data in [train, test] + ([val] if opt.cv else []):
+            data.transform = scaler.transform
+    elif opt.normalization:
         scaler = MinMaxScaler() #StandardScaler()
         scaler.fit(train.feat)
         train.feat = scaler.transform(train.feat)
@@ -94,50 +185,64 @@ def get_data():
             val.feat = scaler.transform(val.feat)
 
     print(f'#Train: {len(train)}, #Val: {len(val)} #Test: {len(test)}')
-    return train, test, val
+    return train, test, val, scaler
 
 
 def get_optim(params, lr, weight_decay):
     optimizer = Adam(params, lr, weight_decay=weight_decay)
     return optimizer
 
-def accuracy(net_ensemble, test_loader):
+def subset_sampler(idx):
+    # Random order over the rows idx, read shard chunk by chunk under --out_of_core
+    if opt.out_of_core:
+        return ChunkShuffleSampler(idx, opt.shuffle_chunk, opt.shuffle_buffer)
+    return SubsetRandomSampler(idx)
+
+def get_loader(dataset, batch_size, **kwargs):
+    if opt.batch_loader and BatchLoader.supports(dataset):
+        return BatchLoader(dataset, batch_size, **kwargs)
+    return DataLoader(dataset, batch_size, num_workers=2, **kwargs)
+
+def ensemble_forward(net_ensemble, x, idx, cache):
+    with bf16_autocast(opt.bf16):
+        if cache is None:
+            return net_ensemble.forward(x)
+        return cache.forward(net_ensemble, x, idx)
+
+def accuracy(net_ensemble, test_loader, cache=None):
     correct = 0
     total = 0
     loss = 0
-    for x, y in test_loader:
-        if opt.cuda:
-            x, y = x.cuda(), y.cuda()
+    for x, y, *idx in test_loader:
+        x, y = x.to(device), y.to(device)
         with torch.no_grad():
-            middle_feat, out = net_ensemble.forward(x)
+            middle_feat, out = ensemble_forward(net_ensemble, x, *idx, cache)
         correct += (torch.sum(y[out > 0.] > 0) + torch.sum(y[out < .0] < 0)).item()
         total += y.numel()
     return correct / total
 
-def logloss(net_ensemble, test_loader):
+def logloss(net_ensemble, test_loader, cache=None):
     loss = 0
     total = 0
     loss_f = nn.BCEWithLogitsLoss() # Binary cross entopy loss with logits, reduction=mean by default
-    for x, y in test_loader:
-        if opt.cuda:
-            x, y= x.cuda(), y.cuda().view(-1, 1)
+    for x, y, *idx in test_loader:
+        x, y = x.to(device), y.to(device).view(-1, 1)
         y = (y + 1) / 2
         with torch.no_grad():
-            _, out = net_ensemble.forward(x)
-        out = torch.as_tensor(out, dtype=torch.float32).cuda().view(-1, 1)
+            _, out = ensemble_forward(net_ensemble, x, *idx, cache)
+        out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
         loss += loss_f(out, y)
         total += 1
 
     return loss / total
 
-def auc_score(net_ensemble, test_loader):
+def auc_score(net_ensemble, test_loader, cache=None):
     actual = []
     posterior = []
-    for x, y in test_loader:
-        if opt.cuda:
-            x = x.cuda()
+    for x, y, *idx in test_loader:
+        x = x.to(device)
         with torch.no_grad():
-            _, out = net_ensemble.forward(x)
+            _, out = ensemble_forward(net_ensemble, x, *idx, cache)
         prob = 1.0 - 1.0 / torch.exp(out)   # Why not using the scores themselve than converting to prob
         prob = prob.cpu().numpy().tolist()
         posterior.extend(prob)
@@ -145,13 +250,105 @@ def auc_score(net_ensemble, test_loader):
     score = auc(actual, posterior)
     return score
 
+def staged_auc_logloss(net_ensemble, test_loader):
+    # AUC and logloss of every ensemble prefix from a single cascade pass over the loader
+    actual = []
+    scores = []
+    for x, y, *_ in test_loader:
+        x = x.to(device)
+        with bf16_autocast(opt.bf16):
+            scores.append(torch.stack([out.view(-1) for _, out in net_ensemble.staged_forward(x)]).cpu())
+        actual.append(y)
+    actual = torch.cat(actual)
+    scores = torch.cat(scores, 1)
+    loss_f = nn.BCEWithLogitsLoss()
+    aucs, losses = [], []
+    for out in scores:
+        prob = 1.0 - 1.0 / torch.exp(out)
+        aucs.append(auc(actual.numpy().tolist(), prob.numpy().tolist()))
+        losses.append(loss_f(out, (actual + 1) / 2).item())
+    return aucs, losses
+
+def max_epochs(epochs, holdout_loader):
+    # Under --plateau_tol the loops stop early, up to --max_epochs if given
+    return (opt.max_epochs or epochs) if holdout_loader is not None else epochs
+
+def learner_loss(model, net_ensemble, x, y, idx, cache):
+    # Newton weighted loss of the learner against the second order targets of the frozen ensemble
+    loss_f1 = nn.MSELoss(reduction='none')
+    x, y = x.to(device), y.to(device).view(-1, 1)
+    middle_feat, out = ensemble_forward(net_ensemble, x, idx, cache)
+    out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
+    if opt.model_order=='first':
+        grad_direction = y / (1.0 + torch.exp(y * out))
+    else:
+        h = 1/((1+torch.exp(y*out))*(1+torch.exp(-y*out)))
+        grad_direction = y * (1.0 + torch.exp(-y * out))
+        out = torch.as_tensor(out)
+        nwtn_weights = (torch.exp(out) + torch.exp(-out)).abs()
+    with bf16_autocast(opt.bf16):
+        _, out = model(x, middle_feat)
+    out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
+    loss = loss_f1(net_ensemble.boost_rate*out, grad_direction)  # T
+    loss = loss*h
+    return loss.mean()
+
+def heldout_learner_loss(model, net_ensemble, holdout_loader, cache):
+    model.eval()
+    loss = total = 0
+    with torch.no_grad():
+        for x, y, idx in holdout_loader:
+            loss += learner_loss(model, net_ensemble, x, y, idx, cache).item() * len(y)
+            total += len(y)
+    model.train()
+    return all_reduce_mean(loss / total)
+
+def heldout_logloss(net_ensemble, holdout_loader, cache):
+    net_ensemble.to_eval()
+    loss = logloss(net_ensemble, holdout_loader, cache).item()
+    net_ensemble.to_train()
+    return all_reduce_mean(loss)
+
+def fit_learner(model, lr, net_ensemble, train_loader, train_cache, holdout_loader=None):
+    # Fits one stage learner to the second order targets of the frozen ensemble,
+    # returns its batch losses and the number of epochs it took
+    optimizer = get_optim(model.parameters(), lr, opt.L2)
+    stage_mdlloss = []
+    plateau = None
+    if holdout_loader is not None:
+        plateau = EpochPlateau(opt.plateau_tol, heldout_learner_loss(model, net_ensemble, holdout_loader, train_cache))
+    epochs = 0
+    for epoch in range(max_epochs(opt.epochs_per_stage, holdout_loader)):
+        epochs += 1
+        for i, (x, y, idx) in enumerate(train_loader):
+            loss = learner_loss(model, net_ensemble, x, y, idx, train_cache)
+            model.zero_grad()
+            loss.backward()
+            all_reduce_grads(model.parameters())
+            optimizer.step()
+            stage_mdlloss.append(loss.item())
+        if plateau is not None and plateau.stop(heldout_learner_loss(model, net_ensemble, holdout_loader, train_cache)):
+            break
+    average_buffers([model])
+    return stage_mdlloss, epochs
+
+def fit_candidate(stage, lr, net_ensemble, train_loader, train_cache, holdout_loader, val_loader, val_cache):
+    # Runs in a forked process (models/candidates.py): adding the learner to the
+    # ensemble here only changes this process' copy
+    model = MLP_2HL.get_model(stage, opt)
+    model.to(device)
+    stage_mdlloss, epochs = fit_learner(model, lr, net_ensemble, train_loader, train_cache, holdout_loader)
+    if val_loader is None:
+        return model, stage_mdlloss, epochs, float(np.mean(stage_mdlloss))
+    net_ensemble.add(model)
+    net_ensemble.to_eval()
+    loss = logloss(net_ensemble, val_loader, val_cache).item()
+    net_ensemble.to_train()
+    return model, stage_mdlloss, epochs, loss
+
 def init_gbnn(train):
-    positive = negative = 0
-    for i in range(len(train)):
-        if train[i][1] > 0:
-            positive += 1
-        else:
-            negative += 1
+    positive = int(np.sum(np.asarray(train.label) > 0))
+    negative = len(train) - positive
     blind_acc = max(positive, negative) / (positive + negative)
     print(f'Blind accuracy: {blind_acc}')
     #print(f'Blind Logloss: {blind_acc}')
@@ -159,75 +356,84 @@ def init_gbnn(train):
 
 if __name__ == "__main__":
 
-    train, test, val = get_data()
+    train, test, val, scaler = get_data()
     print(opt.data + ' training and test datasets are loaded!')
-    train_loader = DataLoader(train, opt.batch_size, shuffle = True, drop_last=False, num_workers=2)
-    test_loader = DataLoader(test, opt.batch_size, shuffle=False, drop_last=False, num_workers=2)
+    train_loader = get_loader(train, opt.batch_size, shuffle = True, drop_last=False)
+    test_loader = get_loader(IndexedData(test), opt.batch_size, shuffle=False, drop_last=False)
     if opt.cv:
-        val_loader = DataLoader(val, opt.batch_size, shuffle=True, drop_last=False, num_workers=2)
+        val_loader = get_loader(IndexedData(val), opt.batch_size, shuffle=True, drop_last=False)
     # For CV use
     best_score = 0
     val_score = best_score
     best_stage = opt.num_nets-1
 
     c0 = init_gbnn(train)
-    net_ensemble = DynamicNet(c0, opt.boost_rate)
-    loss_f1 = nn.MSELoss(reduction='none')
+    if world_size > 1:
+        # c0 comes from all training rows, then every rank keeps its own shard
+        shard = shard_indices(len(train), rank, world_size)
+        train = select(train, shard)
+        print(f'Rank {rank}/{world_size}: {len(train)} training rows')
+    net_ensemble = DynamicNet(c0, opt.boost_rate, device)
+    # Only rank 0 evaluates and checkpoints
+    checkpoint = StageCheckpoint(opt.out_f) if rank == 0 else None
+    if checkpoint is not None:
+        # Fit on the training split only; predict.py, serve.py, distill.py and quantize.py load it from the checkpoint
+        checkpoint.save_scaler(scaler)
+    # Outputs of the frozen learners for every training sample
+    train_cache = StageCache(len(train)) if opt.stage_cache else None
+    # Same for the evaluation sets: after a corrective step with --correct_window W an evaluation
+    # reruns W + 1 learners per row, without a window the whole cascade
+    test_cache = StageCache(len(test)) if opt.stage_cache else None
+    val_cache = StageCache(len(val)) if opt.stage_cache and opt.cv else None
     loss_f2 = nn.BCEWithLogitsLoss(reduction='none')
     loss_models = torch.zeros((opt.num_nets, 3))
+    lr_scale = [float(v) for v in opt.candidate_lr_scale.split(',')]
 
     all_ensm_losses = []
     all_ensm_losses_te = []
     all_mdl_losses = []
     dynamic_br = []
+    epochs_used = []    # learner and corrective epochs of every stage
+    best_state = None
+    stop_reason = f'trained all {opt.num_nets} stages'
 
     for stage in range(opt.num_nets):
         t0 = time.time()
         #### Higgs 100K, 1M , 10M experiment: Subsampling the data each model training time ############
         indices = list(range(len(train)))
-        split = 1000000
+        split = 1000000 // world_size    # per rank
         indices = sklearn.utils.shuffle(indices, random_state=41)
         train_idx = indices[:split]
-        train_sampler = SubsetRandomSampler(train_idx)
-        train_loader = DataLoader(train, opt.batch_size, sampler = train_sampler, drop_last=True, num_workers=2)
+        holdout_loader = None
+        if opt.plateau_tol:
+            cut = int(len(train_idx) * (1 - opt.plateau_holdout))
+            holdout_idx, train_idx = train_idx[cut:], train_idx[:cut]
+            holdout_loader = get_loader(IndexedData(train), opt.batch_size, sampler=subset_sampler(holdout_idx), drop_last=False)
+        train_sampler = subset_sampler(train_idx)
+        train_loader = get_loader(IndexedData(train), opt.batch_size, sampler = train_sampler, drop_last=True)
         ################################################################################################
 
-        model = MLP_2HL.get_model(stage, opt)  # Initialize the model_k: f_k(x), multilayer perception v2
-        if opt.cuda:
-            model.cuda()
-
-        optimizer = get_optim(model.parameters(), opt.lr, opt.L2)
         net_ensemble.to_train() # Set the models in ensemble net to train mode
-
-        stage_mdlloss = []
-        for epoch in range(opt.epochs_per_stage):
-            for i, (x, y) in enumerate(train_loader):
-                if opt.cuda:
-                    x, y= x.cuda(), y.cuda().view(-1, 1)
-                middle_feat, out = net_ensemble.forward(x)
-                out = torch.as_tensor(out, dtype=torch.float32).cuda().view(-1, 1)
-                if opt.model_order=='first':
-                    grad_direction = y / (1.0 + torch.exp(y * out))
-                else:
-                    h = 1/((1+torch.exp(y*out))*(1+torch.exp(-y*out)))
-                    grad_direction = y * (1.0 + torch.exp(-y * out))
-                    out = torch.as_tensor(out)
-                    nwtn_weights = (torch.exp(out) + torch.exp(-out)).abs()
-                _, out = model(x, middle_feat)
-                out = torch.as_tensor(out, dtype=torch.float32).cuda().view(-1, 1)
-                loss = loss_f1(net_ensemble.boost_rate*out, grad_direction)  # T
-                loss = loss*h
-                loss = loss.mean()
-                model.zero_grad()
-                loss.backward()
-                optimizer.step()
-                stage_mdlloss.append(loss.item()) 
+        if opt.candidates > 1:
+            fit = lambda k: fit_candidate(stage, opt.lr * lr_scale[k % len(lr_scale)], net_ensemble, train_loader, train_cache, holdout_loader,
+                                          val_loader if opt.cv else None, val_cache)
+            results = train_candidates(fit, opt.candidates, max(1, torch.get_num_threads() // opt.candidates))
+            losses = [r[3] for r in results]
+            best = int(np.argmin(losses))
+            model, stage_mdlloss, learner_epochs, _ = results[best]
+            print(f'Stage - {stage}, candidate losses: {np.round(losses, 4).tolist()}, kept candidate {best}')
+        else:
+            model = MLP_2HL.get_model(stage, opt)  # Initialize the model_k: f_k(x), multilayer perception v2
+            model.to(device)
+            broadcast_module(model)     # same initial weights on every rank
+            stage_mdlloss, learner_epochs = fit_learner(model, opt.lr, net_ensemble, train_loader, train_cache, holdout_loader)
 
         net_ensemble.add(model)
         sml = np.mean(stage_mdlloss)
 
 
         stage_loss = []
+        correct_epochs = 0
         lr_scaler = 2
         # fully-corrective step
         if stage != 0:
@@ -236,27 +442,45 @@ if __name__ == "__main__":
                 #lr_scaler *= 2
                 opt.lr /= 2
                 opt.L2 /= 2
-            optimizer = get_optim(net_ensemble.parameters(), opt.lr / lr_scaler, opt.L2)
-            for _ in range(opt.correct_epoch):
-                for i, (x, y) in enumerate(train_loader):
-                    if opt.cuda:
-                        x, y = x.cuda(), y.cuda().view(-1, 1)
-                    _, out = net_ensemble.forward_grad(x)
-                    out = torch.as_tensor(out, dtype=torch.float32).cuda().view(-1, 1)
+            params = net_ensemble.parameters(opt.correct_window)
+            optimizer = get_optim(params, opt.lr / lr_scaler, opt.L2)
+            plateau = None
+            if holdout_loader is not None:
+                plateau = EpochPlateau(opt.plateau_tol, heldout_logloss(net_ensemble, holdout_loader, train_cache))
+            for correct_epochs in range(1, max_epochs(opt.correct_epoch, holdout_loader) + 1):
+                for i, (x, y, _) in enumerate(train_loader):
+                    x, y = x.to(device), y.to(device).view(-1, 1)
+                    with bf16_autocast(opt.bf16):
+                        _, out = net_ensemble.forward_grad(x, opt.correct_window, opt.checkpoint_segment, opt.stage_cache)
+                    out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
                     y = (y + 1.0) / 2.0
                     loss = loss_f2(out, y).mean() 
                     optimizer.zero_grad()
                     loss.backward()
+                    all_reduce_grads(params)
                     optimizer.step()
                     stage_loss.append(loss.item())
-
+                if plateau is not None and plateau.stop(heldout_logloss(net_ensemble, holdout_loader, train_cache)):
+                    break
+            # Under --stage_cache the learners before the window ran in eval mode and did not change
+            first = net_ensemble.window_start(opt.correct_window) if opt.stage_cache else 0
+            if average_buffers(net_ensemble.models[first:]):
+                # The averaged BatchNorm stats change the outputs cached since the last forward_grad
+                net_ensemble.changed(first)
+
+        if rank != 0:
+            if opt.patience and broadcast_flag(False):
+                break
+            continue
         
-        sl_te = logloss(net_ensemble, test_loader)
+        if opt.staged_eval:
+            sl_te = float('nan') # filled in by the staged pass after training
+        else:
+            sl_te = logloss(net_ensemble, test_loader, test_cache)
         # Store dynamic boost rate
         dynamic_br.append(net_ensemble.boost_rate.item())
-        # store model
-        net_ensemble.to_file(opt.out_f)
-        net_ensemble = DynamicNet.from_file(opt.out_f, lambda stage: MLP_2HL.get_model(stage, opt))
+        # store model: writes the stages changed since the last save (models/checkpoint.py)
+        checkpoint.save(net_ensemble)
 
         elapsed_tr = time.time()-t0
         sl = 0
@@ -268,27 +492,54 @@ if __name__ == "__main__":
         all_ensm_losses.append(sl)
         all_ensm_losses_te.append(sl_te)
         all_mdl_losses.append(sml)
-        print(f'Stage - {stage}, training time: {elapsed_tr: .1f} sec, boost rate: {net_ensemble.boost_rate: .4f}, Training Loss: {sl: .4f}, Test Loss: {sl_te: .4f}')
+        epochs_used.append([learner_epochs, correct_epochs])
+        print(f'Stage - {stage}, training time: {elapsed_tr: .1f} sec, boost rate: {net_ensemble.boost_rate: .4f}, Training Loss: {sl: .4f}, Test Loss: {sl_te: .4f}, epochs: {learner_epochs} learner, {correct_epochs} corrective')
 
 
-        if opt.cuda:
-            net_ensemble.to_cuda()
         net_ensemble.to_eval() # Set the models in ensemble net to eval mode
+        if opt.staged_eval:
+            continue
 
         # Train
         print('Acc results from stage := ' + str(stage) + '\n')
         # AUC
         if opt.cv:
-            val_score = auc_score(net_ensemble, val_loader) 
+            val_score = auc_score(net_ensemble, val_loader, val_cache)
             if val_score > best_score:
                 best_score = val_score
                 best_stage = stage
+                if opt.patience:
+                    best_state = net_ensemble.snapshot()
 
-        test_score = auc_score(net_ensemble, test_loader)
+        test_score = auc_score(net_ensemble, test_loader, test_cache)
         print(f'Stage: {stage}, AUC@Val: {val_score:.4f}, AUC@Test: {test_score:.4f}')
 
         loss_models[stage, 1], loss_models[stage, 2] = val_score, test_score
 
+        if opt.patience and broadcast_flag(stage - best_stage >= opt.patience):
+            stop_reason = f'no AUC@Val improvement for {opt.patience} stages after stage {best_stage}'
+            break
+
+    if rank != 0:
+        sys.exit(0)
+
+    if best_state is not None and len(net_ensemble.models) > best_stage + 1:
+        # Early stopped: the saved ensemble is the one of the best stage
+        net_ensemble.restore(best_state)
+        loss_models = loss_models[:stage + 1]
+    print(f'Stopped after stage {stage}: {stop_reason}')
+    checkpoint.save(net_ensemble, stop_reason=stop_reason, best_stage=best_stage)
+
+    if opt.staged_eval:
+        # Every prefix of the final ensemble, one cascade pass per set
+        test_scores, all_ensm_losses_te = staged_auc_logloss(net_ensemble, test_loader)
+        val_scores = staged_auc_logloss(net_ensemble, val_loader)[0] if opt.cv else [val_score] * len(test_scores)
+        for stage, (val_score, test_score) in enumerate(zip(val_scores, test_scores)):
+            print(f'Stage: {stage}, AUC@Val: {val_score:.4f}, AUC@Test: {test_score:.4f}, Test Loss: {all_ensm_losses_te[stage]: .4f}')
+            loss_models[stage, 1], loss_models[stage, 2] = val_score, test_score
+        if opt.cv:
+            best_stage = int(np.argmax(val_scores))
+
     val_auc, te_auc = loss_models[best_stage, 1], loss_models[best_stage, 2]
     print(f'Best validation stage: {best_stage},  AUC@Val: {val_auc:.4f}, final AUC@Test: {te_auc:.4f}')
 
@@ -297,5 +548,5 @@ if __name__ == "__main__":
     np.save(fname, loss_models) 
 
     fname = './results/' + opt.data + '_cls'
-    np.savez(fname, training_loss=all_ensm_losses, test_loss=all_ensm_losses_te, model_losses=all_mdl_losses, dynamic_boostrate=dynamic_br, params=opt)
+    np.savez(fname, training_loss=all_ensm_losses, test_loss=all_ensm_losses_te, model_losses=all_mdl_losses, dynamic_boostrate=dynamic_br, epochs_used=epochs_used, stop_reason=stop_reason, params=opt)
 
@@ -0,0 +1,59 @@
+import torch
+import torch.nn as nn
+from .fused_net import FusedDynamicNet
+
+
+class EnsembleModule(nn.Module):
+    """nn.Module view of a DynamicNet (eval mode) whose forward maps features
+    to the ensemble score c0 + boost_rate * sum of learner outputs, so the
+    whole cascade can be traced into one TorchScript or ONNX graph.
+    """
+    def __init__(self, net_ensemble):
+        super(EnsembleModule, self).__init__()
+        if len(net_ensemble.models) == 0:
+            raise ValueError('Cannot export an empty ensemble')
+        self.learners = nn.ModuleList(net_ensemble.models)
+        self.register_buffer('c0', torch.tensor(float(net_ensemble.c0)))
+        self.register_buffer('boost_rate', net_ensemble.boost_rate.detach().clone())
+        self.eval()
+
+    def forward(self, x):
+        middle_feat = None
+        prediction = None
+        for m in self.learners:
+            middle_feat, pred = m(x, middle_feat)
+            pred = pred.view(-1)
+            prediction = pred if prediction is None else prediction + pred
+        return self.c0 + self.boost_rate * prediction
+
+
+class FusedEnsembleModule(nn.Module):
+    # Same output from the FusedDynamicNet graph (MLP_2HL learners only)
+    def __init__(self, net_ensemble):
+        super(FusedEnsembleModule, self).__init__()
+        # no row chunking: the exported graph must not depend on the batch size
+        self.fused = FusedDynamicNet(net_ensemble, chunk_size=2 ** 62)
+        self.eval()
+
+    def forward(self, x):
+        return self.fused(x)[1]
+
+
+def export_module(net_ensemble, fused=False):
+    net_ensemble.to_eval()
+    return FusedEnsembleModule(net_ensemble) if fused else EnsembleModule(net_ensemble)
+
+
+def to_torchscript(module, example, path):
+    # The cascade has no data-dependent control flow, tracing captures it exactly
+    with torch.no_grad():
+        scripted = torch.jit.trace(module, example)
+    scripted.save(path)
+    return scripted
+
+
+def to_onnx(module, example, path, opset_version=11):
+    # Batch dimension left dynamic; input 'x' (N, feat_d), output 'score' (N,)
+    with torch.no_grad():
+        torch.onnx.export(module, (example,), path, input_names=['x'], output_names=['score'],
+                          dynamic_axes={'x': {0: 'batch'}, 'score': {0: 'batch'}}, opset_version=opset_version)
@@ -0,0 +1,89 @@
+import queue
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+def _run_group(models, num_threads, in_queue, out_queue):
+    # One process per stage group: continue the cascade of every batch it
+    # receives and hand (x, middle_feat, prediction) to the next group
+    torch.set_num_threads(num_threads)
+    with torch.no_grad():
+        while True:
+            item = in_queue.get()
+            if item is None:
+                out_queue.put(None)
+                break
+            x, middle_feat, prediction = item
+            for m in models:
+                middle_feat, pred = m(x, middle_feat)
+                prediction = pred if prediction is None else prediction + pred
+            out_queue.put((x, middle_feat, prediction))
+
+
+class PipelineDynamicNet(object):
+    """Inference engine running contiguous groups of DynamicNet stages in
+    separate processes, chained by torch.multiprocessing queues.
+
+    Tensors put on these queues are moved to shared memory and only a handle
+    is sent, so a batch goes from group to group without copies while the
+    groups work on different batches at the same time. Every stage does the
+    same operations as DynamicNet.forward, so scores are identical to it on
+    the same batches. Groups are forked, so the learners are inherited rather
+    than pickled (Linux). Call `close` when done.
+    """
+    def __init__(self, net_ensemble, num_groups, num_threads=1, max_in_flight=None):
+        models = net_ensemble.models
+        if not 0 < num_groups <= len(models):
+            raise ValueError(f'Cannot split {len(models)} stages into {num_groups} groups')
+        net_ensemble.to_eval()
+        self.c0 = net_ensemble.c0
+        self.boost_rate = net_ensemble.boost_rate.detach().clone()
+        self.max_in_flight = max_in_flight or 2 * num_groups
+        bounds = np.linspace(0, len(models), num_groups + 1).round().astype(int)
+        self.groups = [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+        ctx = mp.get_context('fork')
+        self.queues = [ctx.Queue() for _ in range(num_groups + 1)]
+        self.procs = []
+        for i, (a, b) in enumerate(self.groups):
+            p = ctx.Process(target=_run_group, args=(models[a:b], num_threads, self.queues[i], self.queues[i + 1]), daemon=True)
+            p.start()
+            self.procs.append(p)
+
+    def _result(self):
+        while True:
+            try:
+                _, middle_feat, prediction = self.queues[-1].get(timeout=1.)
+                return middle_feat, self.c0 + self.boost_rate * prediction
+            except queue.Empty:
+                # A group that died never hands its batches on
+                for (a, b), p in zip(self.groups, self.procs):
+                    if not p.is_alive():
+                        raise RuntimeError(f'Process of stages {a}-{b - 1} exited with code {p.exitcode}')
+
+    def map(self, batches):
+        # Yields (middle_feat, output) of every batch, in order; the chain is FIFO
+        in_flight = 0
+        for x in batches:
+            if in_flight >= self.max_in_flight:
+                yield self._result()
+                in_flight -= 1
+            self.queues[0].put((x, None, None))
+            in_flight += 1
+        for _ in range(in_flight):
+            yield self._result()
+
+    def forward(self, x, batch_size=4096):
+        middle_feat, out = zip(*self.map(torch.split(x, batch_size)))
+        return torch.cat(middle_feat, 0), torch.cat(out, 0)
+
+    def close(self):
+        if all(p.is_alive() for p in self.procs):
+            self.queues[0].put(None)
+        else:
+            # the groups after a dead one would wait for input forever
+            for p in self.procs:
+                p.terminate()
+        for p in self.procs:
+            p.join()
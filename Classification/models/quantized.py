@@ -0,0 +1,66 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from .fused_net import _bn_affine
+from .mlp import MLP_1HL, MLP_2HL
+
+
+def _fold_linear(linear, bn=None, cols=None):
+    # nn.Linear computing linear(bn(x)) with bn in eval mode, restricted to the
+    # input columns `cols` (a slice, bias kept only if it starts at 0); also
+    # turns SpLinear into nn.Linear
+    w, b = linear.weight.detach().cpu(), linear.bias.detach().cpu()
+    if bn is not None:
+        scale, shift = [t.detach().cpu() for t in _bn_affine(bn)]
+        b = b + w.mv(shift)
+        w = w * scale
+    if cols is not None:
+        w = w[:, cols]
+    bias = cols is None or not cols.start
+    folded = nn.Linear(w.shape[1], w.shape[0], bias=bias)
+    folded.weight.data.copy_(w)
+    if bias:
+        folded.bias.data.copy_(b)
+    return folded
+
+
+class FoldedLearner(nn.Module):
+    """MLP_1HL / MLP_2HL learner with its BatchNorm layers folded into the
+    neighbouring Linear layers, leaving a plain Linear stack to quantize.
+
+    bn2 only runs when the learner gets the previous middle_feat, so it is
+    folded for every stage but the first. There `in_layer` is split into its
+    x and middle_feat columns: the two inputs have very different ranges and
+    dynamic quantization picks one activation scale per Linear input.
+    Inputs must be dense.
+    """
+    def __init__(self, model, stage):
+        super(FoldedLearner, self).__init__()
+        if not isinstance(model, (MLP_1HL, MLP_2HL)):
+            raise ValueError(f'Quantization is only implemented for MLP_1HL and MLP_2HL learners, got {type(model).__name__}')
+        with torch.no_grad():
+            if stage > 0:
+                feat_d = model.in_layer.weight.shape[1] - model.out_layer.weight.shape[1]
+                self.in_layer = _fold_linear(model.in_layer, model.bn2, slice(0, feat_d))
+                self.mid_layer = _fold_linear(model.in_layer, model.bn2, slice(feat_d, None))
+            else:
+                self.in_layer = _fold_linear(model.in_layer)
+                self.mid_layer = None
+            if isinstance(model, MLP_2HL):
+                self.hidden_layer = _fold_linear(model.hidden_layer, model.bn)
+            else:
+                self.hidden_layer = None
+            self.out_layer = _fold_linear(model.out_layer)
+
+    def forward(self, x, lower_f):
+        out = self.in_layer(x)
+        if lower_f is not None:
+            out = out + self.mid_layer(lower_f)
+        if self.hidden_layer is not None:
+            out = self.hidden_layer(F.leaky_relu(out, 0.1))
+        return out, self.out_layer(F.relu(out)).squeeze()
+
+
+def quantize_learner(model, stage, dtype=torch.qint8):
+    # Weights are stored as int8, activations are quantized on the fly per batch (CPU only)
+    return torch.quantization.quantize_dynamic(FoldedLearner(model, stage).eval(), {nn.Linear}, dtype=dtype)
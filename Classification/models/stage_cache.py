@@ -0,0 +1,110 @@
+import torch
+
+
+class StageCache(object):
+    """Per-sample outputs of the frozen ensemble, indexed by sample id.
+
+    For every sample we keep the running sum of the learner outputs (before c0
+    and boost_rate are applied), the last middle_feat and the number of stages
+    they reflect. A lookup only runs the learners a row has not seen yet, so
+    after `DynamicNet.add` each row costs one learner instead of the whole
+    cascade. Frozen learners are evaluated in eval mode, so BatchNorm uses
+    (and does not update) its running statistics, unlike a plain
+    `DynamicNet.forward` on an ensemble in train mode.
+
+    The rows follow `DynamicNet.stage_versions`: when learners change (the
+    corrective step), rows that saw them are rewound to the first changed
+    stage, not to stage 0. For that every row also keeps its state at the
+    stage where the previous change started; a --correct_window slides by one
+    stage per stage, so that state is still valid at the next change, and a
+    lookup reruns the window plus one stage. Without a window every stage
+    changes and the rows are rebuilt from stage 0.
+    """
+    def __init__(self, num_samples):
+        self.num_samples = num_samples
+        self.net = None
+        self.versions = None    # stage_versions the rows are valid for
+        self.keep = 0           # stage the rows keep their state at
+        self.stage = None
+        self.middle_feat = None
+        self.prediction = None
+        self.base_stage = None
+        self.base_feat = None
+        self.base_prediction = None
+
+    def _reset(self, net_ensemble, device):
+        self.net = net_ensemble
+        self.versions = list(net_ensemble.stage_versions)
+        self.keep = 0
+        self.stage = torch.zeros(self.num_samples, dtype=torch.long, device=device)
+        self.prediction = torch.zeros(self.num_samples, device=device)
+        self.base_stage = torch.zeros(self.num_samples, dtype=torch.long, device=device)
+        self.base_prediction = torch.zeros(self.num_samples, device=device)
+        if self.middle_feat is not None:
+            self.middle_feat = self.middle_feat.to(device)
+            self.base_feat = self.base_feat.to(device)
+
+    def _sync(self, net_ensemble, device):
+        if self.net is not net_ensemble:
+            self._reset(net_ensemble, device)
+            return
+        old, versions = self.versions, net_ensemble.stage_versions
+        first = next((k for k, (a, b) in enumerate(zip(old, versions)) if a != b), min(len(old), len(versions)))
+        self.versions = list(versions)
+        if first == len(old):
+            return      # unchanged, at most new learners added
+        # Rows that saw a changed learner go back to their kept state if it is
+        # older than the change, else to stage 0
+        stale = self.stage > first
+        self.base_stage[self.base_stage > first] = 0
+        self.stage[stale] = self.base_stage[stale]
+        self.prediction[stale] = self.base_prediction[stale]
+        if self.middle_feat is not None:
+            self.middle_feat[stale] = self.base_feat[stale]
+        self.keep = first
+
+    def _store(self, index, middle_feat, prediction, base=False):
+        if self.middle_feat is None:
+            self.middle_feat = torch.zeros((self.num_samples, middle_feat.shape[1]), device=middle_feat.device)
+            self.base_feat = torch.zeros_like(self.middle_feat)
+        if base:
+            self.base_feat[index] = middle_feat.to(self.base_feat.dtype)
+            self.base_prediction[index] = prediction
+        else:
+            self.middle_feat[index] = middle_feat.to(self.middle_feat.dtype)     # bf16 under autocast
+            self.prediction[index] = prediction
+
+    def _advance(self, net_ensemble, x, index, start):
+        if start == 0:
+            middle_feat = None
+            prediction = torch.zeros(len(index), device=self.prediction.device)
+        else:
+            middle_feat = self.middle_feat[index]
+            prediction = self.prediction[index]
+        for k in range(start, len(net_ensemble.models)):
+            if k == self.keep and k > 0:
+                self._store(index, middle_feat, prediction, base=True)
+                self.base_stage[index] = k
+            m = net_ensemble.models[k]
+            training = m.training
+            m.eval()
+            middle_feat, pred = m(x, middle_feat)
+            m.train(training)
+            prediction = prediction + pred.view(-1)
+        self._store(index, middle_feat, prediction)
+        self.stage[index] = len(net_ensemble.models)
+
+    def forward(self, net_ensemble, x, index):
+        if len(net_ensemble.models) == 0:
+            return net_ensemble.forward(x)
+        self._sync(net_ensemble, x.device)
+        index = torch.as_tensor(index, dtype=torch.long, device=self.stage.device)
+        num_stages = len(net_ensemble.models)
+        stage = self.stage[index]
+        with torch.no_grad():
+            for start in torch.unique(stage[stage != num_stages]).tolist():
+                rows = (stage == start).nonzero().view(-1)
+                self._advance(net_ensemble, x[rows], index[rows], start)
+        middle_feat = self.middle_feat[index]
+        prediction = self.prediction[index]
+        return middle_feat, net_ensemble.c0 + net_ensemble.boost_rate * prediction
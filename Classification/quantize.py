@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+import numpy as np
+import argparse
+import os
+import sys
+import time
+import torch
+import torch.nn as nn
+from data.sparseloader import DataLoader
+from data.data import LibSVMData, LibCSVData
+from models.mlp import MLP_2HL
+from models.dynamic_net import DynamicNet
+from models.checkpoint import read_scaler, write_scaler
+from misc.auc import auc
+
+
+parser = argparse.ArgumentParser()
+# A checkpoint written by main_cls_cv.py and the options it was trained with
+parser.add_argument('--model', type=str, required=True)
+parser.add_argument('--feat_d', type=int, required=True)
+parser.add_argument('--hidden_d', type=int, required=True)
+parser.add_argument('--data', type=str, required=True)
+parser.add_argument('--te', type=str, required=True)
+parser.add_argument('--normalization', default=False, type=lambda x: (str(x).lower() == 'true'))
+parser.add_argument('--batch_size', type=int, default=2048)
+parser.add_argument('--out_f', type=str, required=True)
+# Exit with status 1 if the test AUC drops by more than this
+parser.add_argument('--max_drift', type=float, default=None)
+parser.add_argument('--num_threads', type=int, default=0)
+
+opt = parser.parse_args()
+opt.sparse = False      # the int8 learners take dense inputs
+
+device = torch.device('cpu')
+torch.set_num_threads(opt.num_threads or len(os.sched_getaffinity(0)))
+
+# Same test sets and preprocessing as main_cls_cv.py, with the scaler it fit on its
+# training split and saved with the checkpoint
+def get_data():
+    if opt.data in ['a9a', 'ijcnn1']:
+        test = LibSVMData(opt.te, opt.feat_d, opt.normalization)
+    elif opt.data == 'covtype':
+        test = LibSVMData(opt.te, opt.feat_d, opt.normalization, 1, 2)
+    elif opt.data == 'mnist28':
+        test = LibSVMData(opt.te, opt.feat_d, opt.normalization, 2, 8)
+    elif opt.data == 'higgs':
+        test = LibSVMData(opt.te, opt.feat_d,opt.normalization, 0, 1)
+    elif opt.data in ['criteo', 'criteo2', 'Allstate']:
+        test = LibCSVData(opt.te, opt.feat_d, 1, 0)
+    elif opt.data == 'yahoo.pair':
+        test = LibCSVData(opt.te, opt.feat_d)
+    else:
+        pass
+
+    scaler = None
+    if opt.normalization:
+        scaler = read_scaler(opt.model)
+        if scaler is None:
+            parser.error(f'--normalization: no scaler saved with {opt.model}')
+        test.feat = scaler.transform(test.feat)
+
+    print(f'#Test: {len(test)}')
+    return test, scaler
+
+
+def predict(net_ensemble, loader):
+    scores = []
+    t0 = time.time()
+    for x, _ in loader:
+        with torch.no_grad():
+            _, out = net_ensemble.forward(x.to(device))
+        scores.append(out.view(-1))
+    return torch.cat(scores), time.time() - t0
+
+
+def auc_logloss(scores, label):
+    prob = 1.0 - 1.0 / torch.exp(scores)
+    loss = nn.BCEWithLogitsLoss()(scores, (label + 1) / 2).item()
+    return auc(label.numpy().tolist(), prob.numpy().tolist()), loss
+
+
+if __name__ == "__main__":
+
+    test, scaler = get_data()
+    builder = lambda stage: MLP_2HL.get_model(stage, opt)
+    net_ensemble = DynamicNet.from_file(opt.model, builder, device)
+    net_ensemble.to_eval()
+    net_ensemble.quantize().to_file(opt.out_f)
+    # Next to the int8 file, so predict.py and serve.py scale its inputs as in training
+    write_scaler(opt.out_f, scaler)
+    # Score with the reloaded file so the saved model is what gets checked
+    qnet = DynamicNet.from_file(opt.out_f, builder, device)
+
+    test_loader = DataLoader(test, opt.batch_size, shuffle=False, drop_last=False, num_workers=2)
+    label = torch.as_tensor(test.label, dtype=torch.float32)
+    scores, t_float = predict(net_ensemble, test_loader)
+    qscores, t_int8 = predict(qnet, test_loader)
+    (auc_float, loss_float), (auc_int8, loss_int8) = auc_logloss(scores, label), auc_logloss(qscores, label)
+    drift = auc_float - auc_int8
+
+    print(f'#Stages: {len(net_ensemble.models)}, model size: {os.path.getsize(opt.out_f) / 1024:.1f} KB (int8)')
+    print(f'float32: AUC@Test: {auc_float:.4f}, Loss@Test: {loss_float:.4f}, {len(test) / t_float:.0f} rows/s')
+    print(f'int8:    AUC@Test: {auc_int8:.4f}, Loss@Test: {loss_int8:.4f}, {len(test) / t_int8:.0f} rows/s')
+    print(f'AUC drift: {drift:.5f}, max abs score diff: {(scores - qscores).abs().max().item():.2e}')
+    if opt.max_drift is not None and drift > opt.max_drift:
+        print(f'AUC drift above {opt.max_drift}')
+        sys.exit(1)
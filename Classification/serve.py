@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+import numpy as np
+import argparse
+import asyncio
+import collections
+import json
+import os
+import time
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from models.mlp import MLP_2HL
+from models.dynamic_net import DynamicNet
+from models.checkpoint import read_scaler
+
+
+parser = argparse.ArgumentParser()
+# A checkpoint (file or directory) and the options the ensemble was trained with
+parser.add_argument('--model', type=str, required=True)
+parser.add_argument('--feat_d', type=int, required=True)
+parser.add_argument('--hidden_d', type=int, required=True)
+# Feature scaling: 'auto' applies the scaler saved with the checkpoint, if there is one (see predict.py)
+parser.add_argument('--scaler', type=str, default='auto', choices=['auto', 'none'])
+# Listen on a TCP port, or on a Unix socket if --unix is given
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8080)
+parser.add_argument('--unix', type=str, default=None)
+# A micro-batch is scored once it holds max_batch rows or its first request waited max_wait ms
+parser.add_argument('--max_batch', type=int, default=256)
+parser.add_argument('--max_wait', type=float, default=2.)
+parser.add_argument('--num_threads', type=int, default=0)
+
+opt = parser.parse_args()
+opt.sparse = False
+
+torch.set_num_threads(opt.num_threads or len(os.sched_getaffinity(0)))
+
+
+class Stats(object):
+    """Request latencies (last `window` requests) and micro-batch sizes."""
+    def __init__(self, window=100000):
+        self.latency = collections.deque(maxlen=window)
+        self.batch_sizes = collections.Counter()    # power-of-two buckets
+        self.requests = 0
+        self.batches = 0
+
+    def add_batch(self, rows):
+        self.batches += 1
+        self.batch_sizes[1 << max(rows - 1, 0).bit_length()] += 1
+
+    def add_request(self, seconds):
+        self.requests += 1
+        self.latency.append(seconds)
+
+    def report(self):
+        lat = np.array(self.latency) * 1000
+        pct = lambda q: float(np.percentile(lat, q)) if len(lat) else None
+        return {'requests': self.requests, 'batches': self.batches,
+                'latency_ms': {'p50': pct(50), 'p90': pct(90), 'p99': pct(99)},
+                'batch_size_histogram': {f'<={k}': v for k, v in sorted(self.batch_sizes.items())}}
+
+
+class MicroBatcher(object):
+    """Coalesces concurrent `predict` calls into one forward pass.
+
+    Scoring runs in a single worker thread (torch releases the GIL), so the
+    event loop keeps accepting requests while a batch is in flight.
+    """
+    def __init__(self, score, max_batch, max_wait, stats):
+        self.score = score
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = stats
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(1)
+
+    async def predict(self, x):
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((x, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            pending = [await self.queue.get()]
+            rows = len(pending[0][0])
+            deadline = loop.time() + self.max_wait
+            while rows < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                rows += len(item[0])
+            self.stats.add_batch(rows)
+            try:
+                out = await loop.run_in_executor(self.executor, self.score, np.concatenate([x for x, _ in pending]))
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for x, future in pending:
+                future.set_result(out[start:start + len(x)])
+                start += len(x)
+
+
+def scorer(net_ensemble, scaler):
+    # The fused graph gives the same scores with far fewer kernel calls
+    if not net_ensemble.quantized and all(isinstance(m, MLP_2HL) for m in net_ensemble.models):
+        fused = net_ensemble.fuse()
+        forward = lambda x: fused(x)[1]
+    else:
+        forward = lambda x: net_ensemble.forward(x)[1]
+
+    def score(x):
+        if scaler is not None:
+            x = scaler.transform(x)
+        with torch.no_grad():
+            return forward(torch.as_tensor(x, dtype=torch.float32)).view(-1).numpy()
+    return score
+
+
+async def respond(writer, status, result):
+    payload = json.dumps(result).encode()
+    writer.write(f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                 f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n'.encode() + payload)
+    await writer.drain()
+
+
+async def handle(reader, writer, batcher, stats):
+    # Minimal HTTP/1.1 with keep-alive:
+    #   POST /predict  {"rows": [[f_1, ..., f_d], ...]}  ->  {"scores": [...]}
+    #   GET  /stats    latency percentiles and batch-size histogram
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            try:
+                method, path, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, value = line.decode().split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+            except ValueError as e:
+                # The next request cannot be found in the stream, so answer and close
+                await respond(writer, 400, {'error': f'malformed request: {e}'})
+                break
+
+            t0 = time.time()
+            status, result = 200, None
+            if method == 'POST' and path == '/predict':
+                try:
+                    x = np.asarray(json.loads(body)['rows'], dtype=np.float32).reshape(-1, opt.feat_d)
+                except (ValueError, KeyError, TypeError) as e:
+                    status, result = 400, {'error': str(e)}
+                else:
+                    result = {'scores': (await batcher.predict(x)).tolist()}
+                    stats.add_request(time.time() - t0)
+            elif method == 'GET' and path == '/stats':
+                result = stats.report()
+            else:
+                status, result = 404, {'error': f'no route {method} {path}'}
+
+            await respond(writer, status, result)
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start():
+    net_ensemble = DynamicNet.from_file(opt.model, lambda stage: MLP_2HL.get_model(stage, opt))
+    net_ensemble.to_eval()
+    scaler = None
+    if opt.scaler != 'none':
+        scaler = read_scaler(opt.model)
+        if scaler is None:
+            print(f'No scaler saved with {opt.model}, serving unscaled features')
+    stats = Stats()
+    batcher = MicroBatcher(scorer(net_ensemble, scaler), opt.max_batch, opt.max_wait / 1000., stats)
+    asyncio.ensure_future(batcher.run())
+
+    client = lambda reader, writer: handle(reader, writer, batcher, stats)
+    if opt.unix is not None:
+        await asyncio.start_unix_server(client, opt.unix)
+        print(f'Serving {len(net_ensemble.models)} stages on unix:{opt.unix}')
+    else:
+        await asyncio.start_server(client, opt.host, opt.port)
+        print(f'Serving {len(net_ensemble.models)} stages on http://{opt.host}:{opt.port}')
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(start())
+    loop.run_forever()
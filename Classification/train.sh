@@ -35,5 +35,5 @@ CUDA_VISIBLE_DEVICES=0 python -u main_cls_cv.py \
     --normalization True \
     --cv True \
     --sparse False \
-    --out_f ${OUTDIR}/${dataset}_cls.pth \
+    --out_f ${OUTDIR}/${dataset}_cls \
     --cuda
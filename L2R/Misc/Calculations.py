@@ -2,19 +2,23 @@ import numpy as np
 import pandas as pd
 import torch
 
-def loss_calc_(y_true, y_pred, gain_type, sigma, N, device):
+# The N x N pair matrices below are built in `dtype` (torch.bfloat16 halves
+# their memory traffic); score differences are taken in the dtype of y_pred
+# and the row sums are accumulated in fp32.
+
+def loss_calc_(y_true, y_pred, gain_type, sigma, N, device, dtype=torch.float32):
 
     # compute the rank order of each document
     rank_df = pd.DataFrame({"y": y_true, "doc": np.arange(y_true.shape[0])})
     rank_df = rank_df.sort_values("y").reset_index(drop=True)
     rank_order = rank_df.sort_values("doc").index.values + 1
 
-    pos_pairs_score_diff = 1.0 + torch.exp(-sigma * (y_pred - y_pred.t()))
+    pos_pairs_score_diff = 1.0 + torch.exp(-sigma * (y_pred - y_pred.t()).to(dtype))
 
-    y_tensor = torch.tensor(y_true, dtype=torch.float32, device=device).view(-1, 1)
+    y_tensor = torch.tensor(y_true, dtype=dtype, device=device).view(-1, 1)
     rel_diff = y_tensor - y_tensor.t()
-    pos_pairs = (rel_diff > 0).type(torch.float32)
-    neg_pairs = (rel_diff < 0).type(torch.float32)
+    pos_pairs = (rel_diff > 0).to(dtype)
+    neg_pairs = (rel_diff < 0).to(dtype)
     Sij = pos_pairs - neg_pairs
     if gain_type == "exp2":
         gain_diff = torch.pow(2.0, y_tensor) - torch.pow(2.0, y_tensor.t())
@@ -24,27 +28,28 @@ def loss_calc_(y_true, y_pred, gain_type, sigma, N, device):
         raise ValueError("NDCG_gain method not supported yet {}".format(ndcg_gain_in_train))
 
     rank_order_tensor = torch.tensor(rank_order, dtype=torch.float32, device=device).view(-1, 1)
-    decay_diff = 1.0 / torch.log2(rank_order_tensor + 1.0) - 1.0 / torch.log2(rank_order_tensor.t() + 1.0)
+    decay = (1.0 / torch.log2(rank_order_tensor + 1.0)).to(dtype)
+    decay_diff = decay - decay.t()
 
-    loss = (0.5*sigma*(1 - Sij)*(y_pred - y_pred.t()) + torch.log(pos_pairs_score_diff))
-    loss = torch.sum(loss, 1, keepdim=True)
+    loss = (0.5*sigma*(1 - Sij)*(y_pred - y_pred.t()).to(dtype) + torch.log(pos_pairs_score_diff))
+    loss = torch.sum(loss, 1, keepdim=True, dtype=torch.float32)
     #import ipdb; ipdb.set_trace()
     return  loss
 
 
-def grad_calc_(y_true, y_pred, gain_type, sigma, N, device):
+def grad_calc_(y_true, y_pred, gain_type, sigma, N, device, dtype=torch.float32):
 
     # compute the rank order of each document
     rank_df = pd.DataFrame({"y": y_true, "doc": np.arange(y_true.shape[0])})
     rank_df = rank_df.sort_values("y").reset_index(drop=True)
     rank_order = rank_df.sort_values("doc").index.values + 1
 
-    pos_pairs_score_diff = 1.0/(1.0 + torch.exp(sigma * (y_pred - y_pred.t())))
+    pos_pairs_score_diff = 1.0/(1.0 + torch.exp(sigma * (y_pred - y_pred.t()).to(dtype)))
 
-    y_tensor = torch.tensor(y_true, dtype=torch.float32, device=device).view(-1, 1)
+    y_tensor = torch.tensor(y_true, dtype=dtype, device=device).view(-1, 1)
     rel_diff = y_tensor - y_tensor.t()
-    pos_pairs = (rel_diff > 0).type(torch.float32)
-    neg_pairs = (rel_diff < 0).type(torch.float32)
+    pos_pairs = (rel_diff > 0).to(dtype)
+    neg_pairs = (rel_diff < 0).to(dtype)
     Sij = pos_pairs - neg_pairs
     if gain_type == "exp2":
         gain_diff = torch.pow(2.0, y_tensor) - torch.pow(2.0, y_tensor.t())
@@ -54,15 +59,16 @@ def grad_calc_(y_true, y_pred, gain_type, sigma, N, device):
         raise ValueError("NDCG_gain method not supported yet {}".format(ndcg_gain_in_train))
 
     rank_order_tensor = torch.tensor(rank_order, dtype=torch.float32, device=device).view(-1, 1)
-    decay_diff = 1.0 / torch.log2(rank_order_tensor + 1.0) - 1.0 / torch.log2(rank_order_tensor.t() + 1.0)
+    decay = (1.0 / torch.log2(rank_order_tensor + 1.0)).to(dtype)
+    decay_diff = decay - decay.t()
 
     grad_ord1 = sigma * (0.5 * (1 - Sij) - pos_pairs_score_diff) 
     grad_ord2 = sigma*sigma*pos_pairs_score_diff*(1-pos_pairs_score_diff) 
     
     #import ipdb; ipdb.set_trace()
 
-    grad_ord1 = torch.sum(grad_ord1, 1, keepdim=True)
-    grad_ord2 = torch.sum(grad_ord2, 1, keepdim=True)
+    grad_ord1 = torch.sum(grad_ord1, 1, keepdim=True, dtype=torch.float32)
+    grad_ord2 = torch.sum(grad_ord2, 1, keepdim=True, dtype=torch.float32)
 
 
     #print(grad_ord1.shape, y_pred.shape)
@@ -76,7 +82,7 @@ def grad_calc_(y_true, y_pred, gain_type, sigma, N, device):
     return  grad_ord1, grad_ord2
 
 
-def grad_calc_v2(y_true, y_pred, gain_type, sigma, N, device):
+def grad_calc_v2(y_true, y_pred, gain_type, sigma, N, device, dtype=torch.float32):
     # Normalize the gradients with NDCG delta adopted from Microsoft paper
 
 
@@ -86,8 +92,8 @@ def grad_calc_v2(y_true, y_pred, gain_type, sigma, N, device):
     rank_df = rank_df.sort_values("y").reset_index(drop=True)
     rank_order = rank_df.sort_values("doc").index.values + 1
 
-    pos_pairs_score_diff = 1.0/(1.0 + torch.exp(sigma * (y_pred - y_pred.t())))
-    y_tensor = torch.tensor(y_true, dtype=torch.float32, device=device).view(-1, 1)
+    pos_pairs_score_diff = 1.0/(1.0 + torch.exp(sigma * (y_pred - y_pred.t()).to(dtype)))
+    y_tensor = torch.tensor(y_true, dtype=dtype, device=device).view(-1, 1)
 
     if gain_type == "exp2":
         gain_diff = torch.pow(2.0, y_tensor) - torch.pow(2.0, y_tensor.t())
@@ -97,15 +103,16 @@ def grad_calc_v2(y_true, y_pred, gain_type, sigma, N, device):
         raise ValueError("NDCG_gain method not supported yet {}".format(ndcg_gain_in_train))
 
     rank_order_tensor = torch.tensor(rank_order, dtype=torch.float32, device=device).view(-1, 1)
-    decay_diff = 1.0 / torch.log2(rank_order_tensor + 1.0) - 1.0 / torch.log2(rank_order_tensor.t() + 1.0)
+    decay = (1.0 / torch.log2(rank_order_tensor + 1.0)).to(dtype)
+    decay_diff = decay - decay.t()
 
     delta_ndcg = torch.abs(N * gain_diff * decay_diff)
 
     grad_ord1 = sigma * (-pos_pairs_score_diff * delta_ndcg)
-    grad_ord1 = torch.sum(grad_ord1, 1, keepdim=True)
+    grad_ord1 = torch.sum(grad_ord1, 1, keepdim=True, dtype=torch.float32)
 
     grad_ord2 = (sigma*sigma)*pos_pairs_score_diff*(1-pos_pairs_score_diff)*delta_ndcg
-    grad_ord2 = torch.sum(grad_ord2, 1, keepdim=True)
+    grad_ord2 = torch.sum(grad_ord2, 1, keepdim=True, dtype=torch.float32)
 
 
     #print(grad_ord1.shape, y_pred.shape)
@@ -116,7 +123,7 @@ def grad_calc_v2(y_true, y_pred, gain_type, sigma, N, device):
         
     return  grad_ord1, grad_ord2
 
-def loss_calc_v2(y_true, y_pred, gain_type, sigma, N, device):
+def loss_calc_v2(y_true, y_pred, gain_type, sigma, N, device, dtype=torch.float32):
     # Normalize the loss with NDCG delta adopted from Microsoft paper
 
     rank_df = pd.DataFrame({"y": y_true, "doc": np.arange(y_true.shape[0])})
@@ -124,8 +131,8 @@ def loss_calc_v2(y_true, y_pred, gain_type, sigma, N, device):
     rank_order = rank_df.sort_values("doc").index.values + 1
 
 
-    pos_pairs_score_diff = 1.0 + torch.exp(-sigma * (y_pred - y_pred.t()))
-    y_tensor = torch.tensor(y_true, dtype=torch.float32, device=device).view(-1, 1)
+    pos_pairs_score_diff = 1.0 + torch.exp(-sigma * (y_pred - y_pred.t()).to(dtype))
+    y_tensor = torch.tensor(y_true, dtype=dtype, device=device).view(-1, 1)
 
     if gain_type == "exp2":
         gain_diff = torch.pow(2.0, y_tensor) - torch.pow(2.0, y_tensor.t())
@@ -135,11 +142,12 @@ def loss_calc_v2(y_true, y_pred, gain_type, sigma, N, device):
         raise ValueError("NDCG_gain method not supported yet {}".format(ndcg_gain_in_train))
 
     rank_order_tensor = torch.tensor(rank_order, dtype=torch.float32, device=device).view(-1, 1)
-    decay_diff = 1.0 / torch.log2(rank_order_tensor + 1.0) - 1.0 / torch.log2(rank_order_tensor.t() + 1.0)
+    decay = (1.0 / torch.log2(rank_order_tensor + 1.0)).to(dtype)
+    decay_diff = decay - decay.t()
 
     delta_ndcg = torch.abs(N * gain_diff * decay_diff)
 
     loss = torch.log(pos_pairs_score_diff) * delta_ndcg
-    loss = torch.sum(loss, 1, keepdim=True)
+    loss = torch.sum(loss, 1, keepdim=True, dtype=torch.float32)
         
     return  loss
\ No newline at end of file
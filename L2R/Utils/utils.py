@@ -15,8 +15,8 @@ from DataLoader.DataLoader import get_time, L2R_DataLoader
 from Misc.metrics import NDCG
 
 
-def get_device():
-    if torch.cuda.is_available():
+def get_device(cuda=True):
+    if cuda and torch.cuda.is_available():
         device = "cuda:0" 
     else:
         device = "cpu"
@@ -152,16 +152,42 @@ def eval_cross_entropy_loss(model, device, loader, phase="Eval", sigma=1.0):
         ))
 
 
-def eval_ndcg_at_k(inference_model, device, df_valid, valid_loader, batch_size, k_list, gain_type, phase="Eval"):
-    # print("Eval Phase evaluate NDCG @ {}".format(k_list))
+def ndcg_from_scores(qids, rels, scores, k_list, gain_type):
     ndcg_metrics = {k: NDCG(k, gain_type) for k in k_list}
+    result_df = pd.DataFrame({'qid': qids, 'rel': rels, 'score': scores})
+    session_ndcgs = defaultdict(list)
+    for qid, result_qid in result_df.groupby('qid', sort=False):
+        result_qid = result_qid.sort_values('score', ascending=False)
+        rel_rank = result_qid.rel.values
+        for k, ndcg in ndcg_metrics.items():
+            if ndcg.maxDCG(rel_rank) == 0:
+                continue
+            ndcg_k = ndcg.evaluate(rel_rank)
+            if not np.isnan(ndcg_k):
+                session_ndcgs[k].append(ndcg_k)
+
+    return {k: np.mean(session_ndcgs[k]) for k in k_list}
+
+
+def eval_ndcg_at_k(inference_model, device, df_valid, valid_loader, batch_size, k_list, gain_type, phase="Eval", cache=None):
+    """
+    :param cache: optional StageCache over the rows of df_valid, so that only
+        the stages added or changed since the previous call are evaluated
+    """
+    # print("Eval Phase evaluate NDCG @ {}".format(k_list))
     qids, rels, scores = [], [], []
     inference_model.to_eval() # Set the models in ensemble net to eval mode
+    count = 0
     with torch.no_grad():
         for qid, rel, x in valid_loader.generate_query_batch(df_valid, batch_size):
             if x is None or x.shape[0] == 0:
                 continue
-            _, y_tensor = inference_model.forward(torch.Tensor(x).to(device))
+            x = torch.Tensor(x).to(device)
+            if cache is not None:
+                _, y_tensor = cache.forward(inference_model, x, np.arange(count, count + len(x)))
+            else:
+                _, y_tensor = inference_model.forward(x)
+            count += len(x)
             scores.append(y_tensor.cpu().numpy().squeeze())
             qids.append(qid)
             rels.append(rel)
@@ -169,23 +195,38 @@ def eval_ndcg_at_k(inference_model, device, df_valid, valid_loader, batch_size,
     qids = np.hstack(qids)
     rels = np.hstack(rels)
     scores = np.hstack(scores)
-    result_df = pd.DataFrame({'qid': qids, 'rel': rels, 'score': scores})
-    session_ndcgs = defaultdict(list)
-    for qid in result_df.qid.unique():
-        result_qid = result_df[result_df.qid == qid].sort_values('score', ascending=False)
-        rel_rank = result_qid.rel.values
-        for k, ndcg in ndcg_metrics.items():
-            if ndcg.maxDCG(rel_rank) == 0:
-                continue
-            ndcg_k = ndcg.evaluate(rel_rank)
-            if not np.isnan(ndcg_k):
-                session_ndcgs[k].append(ndcg_k)
-
-    ndcg_result = {k: np.mean(session_ndcgs[k]) for k in k_list}
+    ndcg_result = ndcg_from_scores(qids, rels, scores, k_list, gain_type)
     ndcg_result_print = ", ".join(["NDCG@{}: {:.5f}".format(k, ndcg_result[k]) for k in k_list])
     print(get_time(), "{} Phase evaluate {}".format(phase, ndcg_result_print))
     return ndcg_result
 
+
+def eval_ndcg_at_k_staged(inference_model, device, df_valid, valid_loader, batch_size, k_list, gain_type, phase="Eval"):
+    """
+    NDCG@k of every ensemble prefix, scored in a single cascade pass over the data
+    :return: list with one {k: ndcg} dict per stage
+    """
+    qids, rels, scores = [], [], []
+    inference_model.to_eval() # Set the models in ensemble net to eval mode
+    for qid, rel, x in valid_loader.generate_query_batch(df_valid, batch_size):
+        if x is None or x.shape[0] == 0:
+            continue
+        outs = [y_tensor.view(-1) for _, y_tensor in inference_model.staged_forward(torch.Tensor(x).to(device))]
+        scores.append(torch.stack(outs).cpu().numpy())
+        qids.append(qid)
+        rels.append(rel)
+
+    qids = np.hstack(qids)
+    rels = np.hstack(rels)
+    scores = np.hstack(scores)
+    ndcg_results = []
+    for stage, stage_scores in enumerate(scores):
+        ndcg_result = ndcg_from_scores(qids, rels, stage_scores, k_list, gain_type)
+        ndcg_result_print = ", ".join(["NDCG@{}: {:.5f}".format(k, ndcg_result[k]) for k in k_list])
+        print(get_time(), "{} Phase stage {} evaluate {}".format(phase, stage, ndcg_result_print))
+        ndcg_results.append(ndcg_result)
+    return ndcg_results
+
 def eval_spearman_kendall(inference_model, device, df_test, test_loader, test_group):
 
     # Switch the model into eval mode
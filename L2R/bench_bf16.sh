@@ -0,0 +1,50 @@
+#!/bin/bash
+
+# fp32 vs bfloat16 autocast (--bf16) on MSLR-WEB10K with the pairwise loss, whose
+# per-query pair matrices are then built in bf16 as well: training time and
+# best-stage test NDCG of each, then the bf16 - fp32 deltas. Extra arguments are
+# passed on to main_l2r_pairwise_cv.py and override the ones below.
+# Training is not seeded: repeat the runs to tell the deltas from run-to-run noise.
+dataset=microsoft
+
+BASEDIR=$(dirname "$0")
+OUTDIR="${BASEDIR}/ckpt/"
+
+if [ ! -d "${OUTDIR}" ]
+then   
+    echo "Output dir ${OUTDIR} does not exist, creating..."
+    mkdir -p ${OUTDIR}
+fi    
+
+for bf16 in False True
+do
+    python -u ${BASEDIR}/main_l2r_pairwise_cv.py \
+        --data_dir ${BASEDIR}/../data \
+        --model_version main_l2r_pairwise_cv.py \
+        --model_order second \
+        --feat_d 136 \
+        --hidden_d 64 \
+        --boost_rate 1 \
+        --lr 0.005 \
+        --L2 1.0e-3 \
+        --num_nets 40 \
+        --data ${dataset} \
+        --batch_size 10000 \
+        --epochs_per_stage 2 \
+        --correct_epoch 2 \
+        --normalization True \
+        --sigma 1. \
+        --cv True \
+        --bf16 ${bf16} \
+        "$@" > ${OUTDIR}/${dataset}_bf16${bf16}.log
+done
+
+for bf16 in False True
+do
+    log=${OUTDIR}/${dataset}_bf16${bf16}.log
+    echo "--bf16 ${bf16}: training time $(grep 'Training time' ${log} | awk '{s += $5} END {printf "%.1f", s}') sec"
+    grep 'Best validation stage' ${log} | sed 's/^/  /'
+done
+paste <(grep 'Best validation stage' ${OUTDIR}/${dataset}_bf16False.log | awk '{print $(NF-2), $NF}' | tr -d ',') \
+      <(grep 'Best validation stage' ${OUTDIR}/${dataset}_bf16True.log | awk '{print $(NF-2), $NF}' | tr -d ',') \
+    | awk '{printf "bf16 - fp32: NDCG@5 %+.5f, NDCG@10 %+.5f\n", $3 - $1, $4 - $2}'
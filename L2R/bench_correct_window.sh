@@ -0,0 +1,47 @@
+#!/bin/bash
+
+# Full vs windowed corrective step on MSLR-WEB10K: time per stage and test NDCG per stage.
+# WINDOWS lists the --correct_window values to compare (0 = full correction);
+# extra arguments are passed on to main_l2r_idiv_cv.py and override the ones below.
+dataset=microsoft
+WINDOWS=${WINDOWS:-"0 5 10"}
+
+BASEDIR=$(dirname "$0")
+OUTDIR="${BASEDIR}/ckpt/"
+
+if [ ! -d "${OUTDIR}" ]
+then   
+    echo "Output dir ${OUTDIR} does not exist, creating..."
+    mkdir -p ${OUTDIR}
+fi    
+
+for window in ${WINDOWS}
+do
+    python -u ${BASEDIR}/main_l2r_idiv_cv.py \
+        --data_dir ${BASEDIR}/../data \
+        --model_version main_l2r_idiv_cv.py \
+        --model_order second \
+        --feat_d 136 \
+        --hidden_d 64 \
+        --boost_rate 1 \
+        --lr 0.005 \
+        --L2 1.0e-3 \
+        --num_nets 40 \
+        --data ${dataset} \
+        --batch_size 10000 \
+        --epochs_per_stage 2 \
+        --correct_epoch 2 \
+        --normalization True \
+        --sigma 1. \
+        --cv True \
+        --correct_window ${window} \
+        "$@" > ${OUTDIR}/${dataset}_correct_window${window}.log
+done
+
+for window in ${WINDOWS}
+do
+    log=${OUTDIR}/${dataset}_correct_window${window}.log
+    echo "--correct_window ${window}"
+    paste <(grep 'Training time' ${log} | awk '{print $2, $5}') <(grep ' Eval Phase' ${log} | awk '{print $(NF-3), $(NF-2), $(NF-1), $NF}') | awk '{print "  stage", $1, "time", $2, "sec,", $3, $4, $5, $6}'
+    grep 'Best validation stage' ${log} | sed 's/^/  /'
+done
@@ -2,13 +2,21 @@
 import numpy as np
 import pandas as pd
 import argparse
+import itertools
+import os
+import sys
 import torch
 import torch.nn as nn
 from models.mlp import MLP_1HL, MLP_2HL, MLP_3HL
 from models.dynamic_net import DynamicNet, ForwardType
+from models.stage_cache import StageCache
+from models.checkpoint import StageCheckpoint
+from models.precision import bf16_autocast
+from models.plateau import EpochPlateau
+from models.distributed import init_distributed, min_across_ranks, broadcast_module, all_reduce_grads, average_buffers, broadcast_flag, all_reduce_mean
 from torch.optim import SGD, Adam
 from DataLoader.DataLoader import L2R_DataLoader
-from Utils.utils import load_train_test_data, init_weights, get_device, eval_ndcg_at_k
+from Utils.utils import load_train_test_data, init_weights, get_device, eval_ndcg_at_k, eval_ndcg_at_k_staged
 from Misc.Calculations import grad_calc_, loss_calc_, grad_calc_v2, loss_calc_v2
 import time
 
@@ -26,16 +34,52 @@ parser.add_argument('--batch_size', type=int, required=True)
 parser.add_argument('--epochs_per_stage', type=int, required=True)
 parser.add_argument('--correct_epoch', type=int ,required=True)
 parser.add_argument('--L2', type=float, required=True)
+# End the learner and corrective epoch loops of a stage once their loss on held-out training
+# queries improves by less than this fraction (0: always run all the epochs)
+parser.add_argument('--plateau_tol', type=float, default=0.)
+# Fraction of the training queries held out for --plateau_tol
+parser.add_argument('--plateau_holdout', type=float, default=0.05)
+# Epoch cap of both loops under --plateau_tol (0: --epochs_per_stage and --correct_epoch)
+parser.add_argument('--max_epochs', type=int, default=0)
 parser.add_argument('--sigma', type=float, required=True)
 parser.add_argument('--normalization', default=False, type=lambda x: (str(x).lower() == 'true')) 
 parser.add_argument('--cv', default=False, type=lambda x: (str(x).lower() == 'true')) 
 parser.add_argument('--sparse', action='store_true')
+# Corrective step on the last N stages only (plus boost_rate), 0 corrects all of them
+parser.add_argument('--correct_window', type=int, default=0)
+# Recompute the corrective step's activations in backward, this many stages at a time (0: keep them all)
+parser.add_argument('--checkpoint_segment', type=int, default=0)
+# Cache the frozen ensemble's outputs per sample (models/stage_cache.py). The frozen learners then run
+# in eval mode (BatchNorm running stats, left unchanged) instead of train mode, in the corrective step
+# too for the ones before --correct_window. The cache keeps the outputs of the learners a corrective
+# step did not change, so it saves work with --correct_window or --epochs_per_stage > 1
+parser.add_argument('--stage_cache', default=False, type=lambda x: (str(x).lower() == 'true'))
+# Score every prefix of the final ensemble once after training instead of re-scoring after each stage
+parser.add_argument('--staged_eval', default=False, type=lambda x: (str(x).lower() == 'true'))
+# Stop once NDCG@5@Val has not improved for this many stages and keep the ensemble of the best stage (0: off)
+parser.add_argument('--patience', type=int, default=0)
+# Checkpoint directory, the ensemble is not saved if not given
+parser.add_argument('--out_f', type=str, default=None)
 parser.add_argument('--cuda', action='store_true')
+parser.add_argument('--num_threads', type=int, default=0)
+# Set by torch.distributed.launch; torchrun and the launcher's environment (RANK, WORLD_SIZE, ...)
+# start data-parallel training over gloo, see models/distributed.py
+parser.add_argument('--local_rank', type=int, default=0)
+# bfloat16 autocast for stage training, the corrective step and evaluation (CPU, torch >= 1.10)
+parser.add_argument('--bf16', default=False, type=lambda x: (str(x).lower() == 'true'))
 
 opt = parser.parse_args()
+if opt.bf16 and (opt.cuda or not hasattr(torch, 'autocast')):
+    parser.error('--bf16 needs CPU training and torch >= 1.10')
+if opt.plateau_tol and not 0 < opt.plateau_holdout < 1:
+    parser.error('--plateau_holdout must be a fraction in (0, 1)')
+if opt.patience and (not opt.cv or opt.staged_eval):
+    parser.error('--patience needs the per-stage validation of --cv True --staged_eval False')
 
 if not opt.cuda:
-    torch.set_num_threads(16)
+    # One intra-op thread per core available to this process (split between the ranks on this host) unless given
+    torch.set_num_threads(opt.num_threads or max(1, len(os.sched_getaffinity(0)) // int(os.environ.get('LOCAL_WORLD_SIZE', 1))))
+rank, world_size = init_distributed()
 
 # prepare the dataset
 def get_data():
@@ -65,18 +109,100 @@ def get_optim(params, lr, weight_decay):
     optimizer = Adam(params, lr, weight_decay=weight_decay)
     return optimizer
 
+def query_batches(df, num_batches=None):
+    # (qid, rel, features, row positions in df) of the batches of df; the row positions are
+    # the sample ids of the stage cache
+    count = 0
+    for q, y, x in itertools.islice(train_loader.generate_query_batch(df, opt.batch_size), num_batches):
+        doc_idx = np.arange(count, count + len(q))
+        count += len(q)
+        yield q, y, torch.tensor(x, dtype=torch.float32, device=device), doc_idx
+
+
+def max_epochs(epochs):
+    # Under --plateau_tol the loops stop early, up to --max_epochs if given
+    return (opt.max_epochs or epochs) if opt.plateau_tol else epochs
+
+
+def ensemble_forward(net_ensemble, x, doc_idx, cache):
+    with bf16_autocast(opt.bf16):
+        if cache is not None:
+            return cache.forward(net_ensemble, x, doc_idx)
+        return net_ensemble.forward(x)
+
+
+def heldout_learner_loss(model, net_ensemble, df_holdout, cache):
+    model.eval()
+    with torch.no_grad():
+        losses = [learner_loss(model, net_ensemble, *batch, cache)[0].item() for batch in query_batches(df_holdout)]
+    model.train()
+    return all_reduce_mean(np.mean(losses))
+
+
+def heldout_ensemble_loss(net_ensemble, df_holdout, cache):
+    net_ensemble.to_eval()
+    with torch.no_grad():
+        losses = [ensemble_loss(q, y, ensemble_forward(net_ensemble, x, doc_idx, cache)[1]).item()
+                  for q, y, x, doc_idx in query_batches(df_holdout)]
+    net_ensemble.to_train()
+    return all_reduce_mean(np.mean(losses))
+
+
+def learner_loss(model, net_ensemble, q, y, x, doc_idx, cache):
+    # Loss of the learner against the residuals of the frozen ensemble; returns it with the residuals
+    y = torch.tensor(y, dtype=torch.float32, device=device).view(-1, 1)
+    middle_feat, out = ensemble_forward(net_ensemble, x, doc_idx, cache)
+    out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
+    resid = y - out  # Negative of gradient direction: -grad/grad2
+    with bf16_autocast(opt.bf16):
+        _, out = model(x, middle_feat)
+    out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
+    return loss_f(net_ensemble.boost_rate*out, resid), resid
+
+
+def ensemble_loss(q, y, out):
+    # Squared error of the ensemble output
+    y = torch.tensor(y, dtype=torch.float32, device=device).view(-1, 1)
+    out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
+    return loss_f(out, y)
+
+
 def init_gbnn(df_train):
     avg = (2**df_train['rel'] - 1)/16
 
     return avg.mean()
 if __name__ == "__main__":
     # prepare datasets
-    device = get_device()
+    device = get_device(opt.cuda)
     print('Loading data...')
     train_loader, df_train, test_loader, df_test, val_loader, df_val = get_data()
     print(f'Start training with {opt.data} dataset...')
     c0 = init_gbnn(df_train)
-    net_ensemble = DynamicNet(c0, opt.boost_rate)
+    if world_size > 1:
+        # c0 comes from all training documents, then every rank keeps the queries of its shard
+        qids = df_train.qid.unique()
+        df_train = df_train[df_train.qid.isin(qids[rank::world_size])]
+        print(f'Rank {rank}/{world_size}: {len(df_train)} training documents')
+    df_holdout = None
+    if opt.plateau_tol:
+        # The epoch loops of every stage are scored on the same held-out training queries
+        qids = np.random.permutation(df_train.qid.unique())
+        held = qids[:max(1, int(len(qids) * opt.plateau_holdout))]
+        df_holdout = df_train[df_train.qid.isin(held)]
+        df_train = df_train[~df_train.qid.isin(held)]
+        print(f'Held out {len(df_holdout)} training documents for --plateau_tol')
+    # Batches per epoch; ranks with more documents stop at the count of the smallest shard
+    num_batches = min_across_ranks(int(np.ceil(len(df_train) / opt.batch_size)))
+    net_ensemble = DynamicNet(c0, opt.boost_rate, device)
+    # Only rank 0 evaluates and checkpoints
+    checkpoint = StageCheckpoint(opt.out_f) if opt.out_f and rank == 0 else None
+    # Outputs of the frozen learners for every training document
+    train_cache = StageCache(len(df_train)) if opt.stage_cache else None
+    # Same for the evaluation sets: after a corrective step with --correct_window W an evaluation
+    # reruns W + 1 learners per row, without a window the whole cascade
+    test_cache = StageCache(len(df_test)) if opt.stage_cache else None
+    val_cache = StageCache(len(df_val)) if opt.stage_cache and opt.cv else None
+    holdout_cache = StageCache(len(df_holdout)) if opt.stage_cache and df_holdout is not None else None
     loss_f = nn.MSELoss()
     all_scores = []
     all_ensm_losses = []
@@ -89,38 +215,38 @@ if __name__ == "__main__":
     best_ndcg  = 0
     val_ndcg   = best_ndcg
     best_stage = opt.num_nets-1
+    best_state = None
+    stop_reason = f'trained all {opt.num_nets} stages'
 
 
     for stage in range(opt.num_nets):
         t0 = time.time()
         model = MLP_2HL.get_model(stage, opt)
         model.apply(init_weights)  # Applying uniform xavier initialization for Linear layers
-        if opt.cuda:
-            model.cuda()
+        model.to(device)
+        broadcast_module(model)     # same initial weights on every rank
         optimizer = get_optim(model.parameters(), opt.lr, opt.L2)
         net_ensemble.to_train() # Set the models in ensemble net to train mode
         stage_resid = []
         stage_mdlloss = []
-        for epoch in range(opt.epochs_per_stage):
-            for q, y, x in train_loader.generate_query_batch(df_train, opt.batch_size):
-                
-                if opt.cuda:
-                    x = torch.tensor(x, dtype=torch.float32, device=device)
-                    y = torch.tensor(y, dtype=torch.float32, device=device).view(-1, 1)
-                # Feeding input into ensemble Net
-                middle_feat, out = net_ensemble.forward(x)
-                out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
-                resid = y - out  # Negative of gradient direction: -grad/grad2
-                stage_resid.append(resid.sum().detach().cpu().numpy())
-                _, out = model(x, middle_feat)
-                out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
-                loss = loss_f(net_ensemble.boost_rate*out, resid)
-
-                stage_mdlloss.append(loss.item())    
+        plateau = None
+        if df_holdout is not None:
+            plateau = EpochPlateau(opt.plateau_tol, heldout_learner_loss(model, net_ensemble, df_holdout, holdout_cache))
+        learner_epochs = 0
+        for epoch in range(max_epochs(opt.epochs_per_stage)):
+            learner_epochs += 1
+            for q, y, x, doc_idx in query_batches(df_train, num_batches):
+                loss, resid = learner_loss(model, net_ensemble, q, y, x, doc_idx, train_cache)
                 model.zero_grad()
                 loss.backward()
+                all_reduce_grads(model.parameters())
                 optimizer.step()
+                stage_resid.append(resid.sum().detach().cpu().numpy())
+                stage_mdlloss.append(loss.item())
+            if plateau is not None and plateau.stop(heldout_learner_loss(model, net_ensemble, df_holdout, holdout_cache)):
+                break
 
+        average_buffers([model])
         net_ensemble.add(model)
         sr = np.mean(stage_resid)
         sml = np.mean(stage_mdlloss)
@@ -128,6 +254,7 @@ if __name__ == "__main__":
 
         # fully-corrective step
         stage_loss = []
+        correct_epochs = 0
         lr_scaler = 3
         if stage > 2:
             # Adjusting corrective step learning rate 
@@ -136,46 +263,91 @@ if __name__ == "__main__":
                 opt.lr /= 2
                 opt.L2 /= 2
 
-            optimizer = get_optim(net_ensemble.parameters(), opt.lr / lr_scaler, opt.L2)
+            params = net_ensemble.parameters(opt.correct_window)
+            optimizer = get_optim(params, opt.lr / lr_scaler, opt.L2)
             #scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=10, gamma=0.75)
-            for _ in range(opt.correct_epoch):
-                for q, y, x in train_loader.generate_query_batch(df_train, opt.batch_size):
-                    
-                    if opt.cuda:
-                        x = torch.tensor(x, dtype=torch.float32, device=device)
-                        y = torch.tensor(y, dtype=torch.float32, device=device).view(-1, 1)
-                    
-                    _, out = net_ensemble.forward_grad(x)
-                    out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
-                    loss = loss_f(out, y)
-                    #net_ensemble.zero_grad()
+            plateau = None
+            if df_holdout is not None:
+                plateau = EpochPlateau(opt.plateau_tol, heldout_ensemble_loss(net_ensemble, df_holdout, holdout_cache))
+            for correct_epochs in range(1, max_epochs(opt.correct_epoch) + 1):
+                for q, y, x, _ in query_batches(df_train, num_batches):
+                    with bf16_autocast(opt.bf16):
+                        _, out = net_ensemble.forward_grad(x, opt.correct_window, opt.checkpoint_segment, opt.stage_cache)
+                    loss = ensemble_loss(q, y, out)
                     optimizer.zero_grad()
                     loss.backward()
                     #scheduler.step()
+                    all_reduce_grads(params)
                     optimizer.step()
                     stage_loss.append(loss.item())
+                if plateau is not None and plateau.stop(heldout_ensemble_loss(net_ensemble, df_holdout, holdout_cache)):
+                    break
+        # Under --stage_cache the learners before the window ran in eval mode and did not change
+        first = net_ensemble.window_start(opt.correct_window) if opt.stage_cache else 0
+        if average_buffers(net_ensemble.models[first:]):
+            # The averaged BatchNorm stats change the outputs cached since the last forward_grad
+            net_ensemble.changed(first)
+        if rank != 0:
+            if opt.patience and broadcast_flag(False):
+                break
+            continue
+
         sl = 0
         if stage_loss != []:
             sl = np.mean(stage_loss)
                     
         all_ensm_losses.append(sl)
         all_mdl_losses.append(sml)
-        print(f'Stage - {stage}, Boost rate: {net_ensemble.boost_rate} Loss: {sl}')          
+        print(f'Stage - {stage}, Boost rate: {net_ensemble.boost_rate} Loss: {sl}, epochs: {learner_epochs} learner, {correct_epochs} corrective')
+        # store model: writes the new stage and the stages changed by the corrective step
+        if checkpoint is not None:
+            checkpoint.save(net_ensemble)
 
         elapsed_tr = time.time()-t0
         
-        ndcg_result = eval_ndcg_at_k(net_ensemble, device, df_test, test_loader, 100000, [5, 10], gain_type)
+        if opt.staged_eval:
+            continue
+
+        with bf16_autocast(opt.bf16):
+            ndcg_result = eval_ndcg_at_k(net_ensemble, device, df_test, test_loader, 100000, [5, 10], gain_type, cache=test_cache)
         if opt.cv:
-            val_result = eval_ndcg_at_k(net_ensemble, device, df_val, val_loader, 100000, [5, 10], gain_type, "Validation") 
+            with bf16_autocast(opt.bf16):
+                val_result = eval_ndcg_at_k(net_ensemble, device, df_val, val_loader, 100000, [5, 10], gain_type, "Validation", cache=val_cache) 
             if val_result[5] > best_ndcg:
                 best_ndcg = val_result[5]
                 best_stage = stage
+                if opt.patience:
+                    best_state = net_ensemble.snapshot()
 
         all_scores.append([ndcg_result[5], ndcg_result[10]])
         elapsed_te = time.time()-t0 - elapsed_tr
         print(f'Stage: {stage} Training time: {elapsed_tr: .1f} sec and Test time: {elapsed_te: .1f} sec \n')
+
+        if opt.patience and broadcast_flag(stage - best_stage >= opt.patience):
+            stop_reason = f'no NDCG@5@Val improvement for {opt.patience} stages after stage {best_stage}'
+            break
         
     ### Test results from CV ###
+    if rank != 0:
+        sys.exit(0)
+
+    if best_state is not None and len(net_ensemble.models) > best_stage + 1:
+        # Early stopped: the saved ensemble is the one of the best stage
+        net_ensemble.restore(best_state)
+    print(f'Stopped after stage {stage}: {stop_reason}')
+    if checkpoint is not None:
+        checkpoint.save(net_ensemble, stop_reason=stop_reason, best_stage=best_stage)
+
+    if opt.staged_eval:
+        # Every prefix of the final ensemble, one cascade pass per set
+        with bf16_autocast(opt.bf16):
+            ndcg_results = eval_ndcg_at_k_staged(net_ensemble, device, df_test, test_loader, 100000, [5, 10], gain_type)
+        all_scores = [[r[5], r[10]] for r in ndcg_results]
+        if opt.cv:
+            with bf16_autocast(opt.bf16):
+                val_results = eval_ndcg_at_k_staged(net_ensemble, device, df_val, val_loader, 100000, [5, 10], gain_type, "Validation")
+            best_stage = int(np.argmax([r[5] for r in val_results]))
+
     te_ndcg_5, te_ndcg_10 = all_scores[best_stage][0], all_scores[best_stage][1]
     print(f'Best validation stage: {best_stage}  final Test NDCG@5: {te_ndcg_5:.5f}, NDCG@10: {te_ndcg_10:.5f}')
     fname = opt.data + '_NDCG_MSEloss'
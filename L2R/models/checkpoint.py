@@ -0,0 +1,134 @@
+import json
+import os
+import numpy as np
+import torch
+from sklearn.preprocessing import StandardScaler, MinMaxScaler
+
+MANIFEST = 'manifest.json'
+SCALER = 'scaler.npz'
+ALIGN = 64
+_SCALERS = {'MinMaxScaler': MinMaxScaler, 'StandardScaler': StandardScaler}
+
+
+def read_checkpoint(path, num_stages=None):
+    """Returns the manifest and the state dicts of the first `num_stages` stages.
+
+    The tensors are memory-mapped (copy-on-write) from the stage files, nothing
+    is unpickled.
+    """
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    states = []
+    for entry in manifest['stages'][:num_stages]:
+        buf = np.memmap(os.path.join(path, entry['file']), dtype=np.uint8, mode='c')
+        state = {}
+        for t in entry['tensors']:
+            dtype = np.dtype(t['dtype'])
+            nbytes = dtype.itemsize * int(np.prod(t['shape']))
+            arr = buf[t['offset']:t['offset'] + nbytes].view(dtype).reshape(t['shape'])
+            state[t['name']] = torch.from_numpy(arr)
+        states.append(state)
+    return manifest, states
+
+
+def scaler_path(path):
+    # scaler.npz in a checkpoint directory, <file>.scaler.npz next to a single-file model
+    return os.path.join(path, SCALER) if os.path.isdir(path) else f'{path}.{SCALER}'
+
+
+def write_scaler(path, scaler):
+    # Fitted attributes of a training scaler, as plain arrays; None removes a previous one
+    name = scaler_path(path)
+    if scaler is None:
+        if os.path.isfile(name):
+            os.remove(name)
+        return
+    attrs = {k: np.asarray(v) for k, v in vars(scaler).items() if k.endswith('_') and v is not None}
+    with open(name + '.tmp', 'wb') as f:
+        np.savez(f, kind=type(scaler).__name__, **attrs)
+    os.replace(name + '.tmp', name)
+
+
+def read_scaler(path):
+    # The feature scaler saved with a model (write_scaler), None if there is none
+    name = scaler_path(path)
+    if not os.path.isfile(name):
+        return None
+    with np.load(name) as z:
+        scaler = _SCALERS[str(z['kind'])]()
+        for k in z.files:
+            if k != 'kind':
+                setattr(scaler, k, z[k].item() if z[k].ndim == 0 else z[k])
+    return scaler
+
+
+class StageCheckpoint(object):
+    """Checkpoint directory made of a manifest plus one weight file per stage.
+
+    `save` writes files only for stages that are new or whose weights or
+    BatchNorm buffers changed since the previous save (after
+    `DynamicNet.stage_versions`), then atomically replaces the manifest and
+    removes the files it no longer references, so the directory always holds
+    a complete ensemble. A full corrective step, and any forward of the
+    ensemble in train mode, changes every learner, so plain training rewrites
+    all stages each time; with --stage_cache and --correct_window W only the
+    last W stages are written. Load it with
+    `DynamicNet.from_file`; the feature scaler of the training script, if
+    any, is kept next to it (`save_scaler`, `read_scaler`).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.net = None
+        self.versions = []      # stage_versions of the last written state of each stage
+        self.entries = []       # their manifest entries
+        self.generation = 0
+        os.makedirs(path, exist_ok=True)
+        if os.path.isfile(os.path.join(path, MANIFEST)):
+            with open(os.path.join(path, MANIFEST)) as f:
+                self.generation = json.load(f)['generation'] + 1
+
+    def _write_stage(self, stage, state):
+        entry = {'file': f'stage_{stage:04d}_{self.generation}.bin', 'tensors': []}
+        offset = 0
+        with open(os.path.join(self.path, entry['file']), 'wb') as f:
+            for name, t in state.items():
+                arr = t.numpy()
+                pad = -offset % ALIGN
+                f.write(b'\0' * pad)
+                offset += pad
+                entry['tensors'].append({'name': name, 'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset})
+                f.write(arr.tobytes())
+                offset += arr.nbytes
+        return entry
+
+    def save_scaler(self, scaler):
+        write_scaler(self.path, scaler)
+
+    def save(self, net_ensemble, **meta):
+        if net_ensemble is not self.net:
+            self.net, self.versions = net_ensemble, []
+        num_stages = len(net_ensemble.models)
+        del self.versions[num_stages:], self.entries[num_stages:]
+        for stage, m in enumerate(net_ensemble.models):
+            version = net_ensemble.stage_versions[stage]
+            if stage < len(self.versions) and self.versions[stage] == version:
+                continue
+            entry = self._write_stage(stage, {k: v.detach().cpu() for k, v in m.state_dict().items()})
+            if stage < len(self.versions):
+                self.versions[stage], self.entries[stage] = version, entry
+            else:
+                self.versions.append(version)
+                self.entries.append(entry)
+
+        manifest = {'generation': self.generation, 'c0': float(net_ensemble.c0), 'lr': float(net_ensemble.lr),
+                    'boost_rate': float(net_ensemble.boost_rate.item()), 'stages': self.entries, 'meta': meta}
+        tmp = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+        self.generation += 1
+
+        used = set(e['file'] for e in self.entries)
+        for name in os.listdir(self.path):
+            if name.startswith('stage_') and name not in used:
+                os.remove(os.path.join(self.path, name))
@@ -1,7 +1,40 @@
 from enum import Enum
+import inspect
+import os
 import torch
 #import pickle
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+from .fused_net import FusedDynamicNet
+from .checkpoint import read_checkpoint
+from .quantized import quantize_learner
+
+# Reentrant checkpointing; newer torch requires choosing it explicitly, older versions lack the argument
+_CHECKPOINT_KWARGS = {'use_reentrant': True} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+
+def _segment_fn(models):
+    # Runs a group of stages; called once without grad on the forward pass and
+    # again with grad when backward recomputes it. BatchNorm running stats and
+    # batch counts are already updated by the first call, so the recompute
+    # freezes the stats and restores the counts.
+    def run(x, middle_feat_cum, prediction, dummy):
+        recompute = torch.is_grad_enabled()
+        bns = [b for m in models for b in m.modules() if isinstance(b, nn.modules.batchnorm._BatchNorm)] if recompute else []
+        momentum = [b.momentum for b in bns]
+        tracked = [None if b.num_batches_tracked is None else b.num_batches_tracked.clone() for b in bns]
+        for b in bns:
+            b.momentum = 0.
+        for m in models:
+            middle_feat_cum, pred = m(x, middle_feat_cum)
+            prediction = pred.float() if prediction is None else prediction + pred.float()
+        for b, mom, n in zip(bns, momentum, tracked):
+            b.momentum = mom
+            if n is not None:
+                b.num_batches_tracked.copy_(n)
+        return middle_feat_cum, prediction
+    return run
+
 
 class ForwardType(Enum):
     SIMPLE = 0
@@ -10,18 +43,38 @@ class ForwardType(Enum):
     GRADIENT = 3
 
 class DynamicNet(object):
-    def __init__(self, c0, lr):
+    # Stage outputs are summed in fp32 (they are bf16 under autocast), so c0,
+    # boost_rate and the ensemble output stay fp32 in every forward
+    def __init__(self, c0, lr, device="cpu"):
         self.models = []
         self.c0 = c0
         self.lr = lr
-        self.boost_rate  = nn.Parameter(torch.tensor(lr, requires_grad=True, device="cuda:0"))
+        # Bumped whenever the learners may change, so cached outputs can be dropped;
+        # stage_versions holds its value at the last change of every learner, so
+        # outputs cached for the learners before a change can be kept
+        self.version = 0
+        self.stage_versions = []
+        self.quantized = False
+        self.boost_rate  = nn.Parameter(torch.tensor(lr, requires_grad=True, device=device))
 
     def add(self, model):
         self.models.append(model)
+        self.version += 1
+        self.stage_versions.append(self.version)
+
+    def changed(self, start=0):
+        # Marks the learners from `start` on as changed (weights or BatchNorm buffers)
+        self.version += 1
+        self.stage_versions[start:] = [self.version] * (len(self.models) - start)
+
+    def window_start(self, window=None):
+        # First of the last `window` learners, 0 if window is None or 0
+        return max(len(self.models) - window, 0) if window else 0
 
-    def parameters(self):
+    def parameters(self, window=None):
+        # window: only the last `window` learners (plus boost_rate), all if None or 0
         params = []
-        for m in self.models:
+        for m in self.models[self.window_start(window):]:
             params.extend(m.parameters())
 
         params.append(self.boost_rate)
@@ -31,9 +84,26 @@ class DynamicNet(object):
         for m in self.models:
             m.zero_grad()
 
-    def to_cuda(self):
+    def snapshot(self):
+        # Copy of the learner weights and boost_rate, see restore
+        return [{k: v.clone() for k, v in m.state_dict().items()} for m in self.models], self.boost_rate.item()
+
+    def restore(self, snapshot):
+        # Back to a snapshot, dropping the learners added after it (e.g. the best stage under early stopping)
+        states, boost_rate = snapshot
+        del self.models[len(states):], self.stage_versions[len(states):]
+        for m, state in zip(self.models, states):
+            m.load_state_dict(state)
+        self.boost_rate.data.fill_(boost_rate)
+        self.changed()
+
+    def to(self, device):
         for m in self.models:
-            m.cuda()
+            m.to(device)
+        self.boost_rate.data = self.boost_rate.data.to(device)
+
+    def to_cuda(self):
+        self.to("cuda")
 
     def to_eval(self):
         for m in self.models:
@@ -45,44 +115,99 @@ class DynamicNet(object):
 
     def forward(self, x):
         if len(self.models) == 0:
-            return None, self.c0*torch.ones((len(x), 1))
+            return None, self.c0*torch.ones((len(x), 1), device=self.boost_rate.device)
+        if any(m.training for m in self.models):
+            self.changed()      # BatchNorm running stats move in train mode
         middle_feat_cum = None
         prediction = None
         with torch.no_grad():
             for m in self.models:
-                if middle_feat_cum is None:
-                    middle_feat_cum, prediction = m(x, middle_feat_cum)
-                else:
-                    middle_feat_cum, pred = m(x, middle_feat_cum)
-                    prediction += pred
+                middle_feat_cum, pred = m(x, middle_feat_cum)
+                prediction = pred.float() if prediction is None else prediction + pred.float()
         return middle_feat_cum, self.c0 + self.boost_rate * prediction
 
-    def forward_grad(self, x):
+    @torch.no_grad()
+    def staged_forward(self, x):
+        # Yields (middle_feat, output) of every ensemble prefix in a single cascade pass
+        if any(m.training for m in self.models):
+            self.changed()
+        middle_feat_cum = None
+        prediction = None
+        for m in self.models:
+            middle_feat_cum, pred = m(x, middle_feat_cum)
+            prediction = pred.float() if prediction is None else prediction + pred.float()
+            yield middle_feat_cum, self.c0 + self.boost_rate * prediction
+
+    def forward_grad(self, x, window=None, segment=None, frozen_eval=False):
         if len(self.models) == 0:
             return None, self.c0
         # at least one model
         middle_feat_cum = None
         prediction = None
-        for m in self.models:
-            if middle_feat_cum is None:
-                middle_feat_cum, prediction = m(x, middle_feat_cum)
-            else:
+        # With a window only the last `window` learners are trained, the ones
+        # before it run once per batch without building an autograd graph. In
+        # train mode their BatchNorm running stats still move, unless frozen_eval
+        # runs them in eval mode, which leaves them (and their cached outputs) as they are.
+        frozen = self.window_start(window)
+        self.changed(frozen if frozen_eval else 0)
+        with torch.no_grad():
+            for m in self.models[:frozen]:
+                training = m.training
+                if frozen_eval:
+                    m.eval()
+                middle_feat_cum, pred = m(x, middle_feat_cum)
+                m.train(training)
+                prediction = pred.float() if prediction is None else prediction + pred.float()
+        models = self.models[frozen:]
+        if segment:
+            # Activation checkpointing: only the segment boundaries are kept,
+            # each group of `segment` stages is recomputed during backward. The
+            # dummy input makes the checkpoint output require grad even when
+            # x and the frozen prefix do not.
+            dummy = torch.ones(1, device=x.device, requires_grad=True)
+            for i in range(0, len(models), segment):
+                middle_feat_cum, prediction = checkpoint(_segment_fn(models[i:i + segment]), x, middle_feat_cum,
+                                                         prediction, dummy, **_CHECKPOINT_KWARGS)
+        else:
+            for m in models:
                 middle_feat_cum, pred = m(x, middle_feat_cum)
-                prediction += pred
+                prediction = pred.float() if prediction is None else prediction + pred.float()
         return middle_feat_cum, self.c0 + self.boost_rate * prediction
 
+    def fuse(self):
+        return FusedDynamicNet(self)
+
+    def quantize(self, dtype=torch.qint8):
+        # CPU copy with BatchNorm folded and int8 Linear layers; c0 and boost_rate are kept as is
+        net = DynamicNet(self.c0, self.lr)
+        net.boost_rate.data.copy_(self.boost_rate.data.cpu())
+        net.quantized = True
+        for stage, m in enumerate(self.models):
+            net.add(quantize_learner(m, stage, dtype))
+        return net
+
     @classmethod
-    def from_file(cls, path, builder):
-        d = torch.load(path)
-        net = DynamicNet(d['c0'], d['lr'])
-        net.boost_rate = d['boost_rate']
-        for stage, m in enumerate(d['models']):
+    def from_file(cls, path, builder, device="cpu", num_stages=None):
+        # path is either a single file written by to_file or a StageCheckpoint directory
+        if os.path.isdir(path):
+            d, models = read_checkpoint(path, num_stages)
+            net = DynamicNet(d['c0'], d['lr'], device)
+            net.boost_rate.data.fill_(d['boost_rate'])
+        else:
+            d = torch.load(path, map_location=device)
+            models = d['models'][:num_stages]
+            net = DynamicNet(d['c0'], d['lr'], device)
+            net.boost_rate = d['boost_rate']
+            net.quantized = d.get('quantized', False)
+        for stage, m in enumerate(models):
             submod = builder(stage)
+            if net.quantized:
+                submod = quantize_learner(submod, stage)
             submod.load_state_dict(m)
-            net.add(submod)
+            net.add(submod.to(device))
         return net
 
     def to_file(self, path):
         models = [m.state_dict() for m in self.models]
-        d = {'models': models, 'c0': self.c0, 'lr': self.lr, 'boost_rate': self.boost_rate}
+        d = {'models': models, 'c0': self.c0, 'lr': self.lr, 'boost_rate': self.boost_rate, 'quantized': self.quantized}
         torch.save(d, path)
@@ -0,0 +1,16 @@
+class EpochPlateau(object):
+    """Decides when an epoch loop has stopped improving.
+
+    `baseline` is the held-out loss before the first epoch. `stop(loss)` is
+    called after every epoch with the new held-out loss and returns True once
+    it improved on the best loss so far by less than `tol` (relative). The
+    caller caps the number of epochs.
+    """
+    def __init__(self, tol, baseline):
+        self.tol = tol
+        self.best = baseline
+
+    def stop(self, loss):
+        improved = self.best - loss > self.tol * abs(self.best)
+        self.best = min(self.best, loss)
+        return not improved
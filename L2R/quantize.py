@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+import argparse
+import os
+import sys
+import time
+import torch
+from models.mlp import MLP_2HL
+from models.dynamic_net import DynamicNet
+from Utils.utils import load_train_test_data, eval_ndcg_at_k
+
+parser = argparse.ArgumentParser()
+# A checkpoint written by main_l2r_*_cv.py --out_f and the options it was trained with
+parser.add_argument('--model', type=str, required=True)
+parser.add_argument('--feat_d', type=int, required=True)
+parser.add_argument('--hidden_d', type=int, required=True)
+parser.add_argument('--data', type=str, required=True)
+parser.add_argument('--data_dir', type=str, required=True)
+parser.add_argument('--normalization', default=False, type=lambda x: (str(x).lower() == 'true'))
+parser.add_argument('--out_f', type=str, required=True)
+# Exit with status 1 if the test NDCG@10 drops by more than this
+parser.add_argument('--max_drift', type=float, default=None)
+parser.add_argument('--num_threads', type=int, default=0)
+
+opt = parser.parse_args()
+opt.sparse = False      # the int8 learners take dense inputs
+
+device = torch.device('cpu')
+torch.set_num_threads(opt.num_threads or len(os.sched_getaffinity(0)))
+
+# Same datasets and preprocessing as main_l2r_*_cv.py
+def get_data():
+    if opt.data == 'yahoo':
+        data_fold = None
+    elif opt.data == 'microsoft':
+        data_fold = 'Fold1'
+    else:
+        pass
+    train_loader, df_train, test_loader, df_test, _, _ = load_train_test_data(opt.data_dir, data_fold, opt.data, False)
+
+    if opt.normalization:
+        df_train, scaler = train_loader.train_scaler_and_transform()
+        df_test = test_loader.apply_scaler(scaler)
+
+    print(f'#Test: {len(df_test.index)}')
+    return test_loader, df_test
+
+
+def ndcg(net_ensemble, phase):
+    t0 = time.time()
+    result = eval_ndcg_at_k(net_ensemble, device, df_test, test_loader, 100000, [5, 10], 'identity', phase)
+    return result, time.time() - t0
+
+
+if __name__ == "__main__":
+
+    test_loader, df_test = get_data()
+    builder = lambda stage: MLP_2HL.get_model(stage, opt)
+    net_ensemble = DynamicNet.from_file(opt.model, builder, device)
+    net_ensemble.quantize().to_file(opt.out_f)
+    # Score with the reloaded file so the saved model is what gets checked
+    qnet = DynamicNet.from_file(opt.out_f, builder, device)
+
+    result, t_float = ndcg(net_ensemble, 'float32')
+    qresult, t_int8 = ndcg(qnet, 'int8')
+    drift = result[10] - qresult[10]
+
+    print(f'#Stages: {len(net_ensemble.models)}, model size: {os.path.getsize(opt.out_f) / 1024:.1f} KB (int8)')
+    print(f'float32: {len(df_test) / t_float:.0f} rows/s, int8: {len(df_test) / t_int8:.0f} rows/s')
+    print(f'NDCG@5 drift: {result[5] - qresult[5]:.5f}, NDCG@10 drift: {drift:.5f}')
+    if opt.max_drift is not None and drift > opt.max_drift:
+        print(f'NDCG@10 drift above {opt.max_drift}')
+        sys.exit(1)
@@ -0,0 +1,48 @@
+#!/bin/bash
+
+# fp32 vs bfloat16 autocast (--bf16) on YearPredictionMSD: training time and best-stage
+# RMSE of each, then the bf16 - fp32 deltas. Extra arguments are passed on to
+# main_reg_cv.py and override the ones below.
+# Training is not seeded: repeat the runs to tell the deltas from run-to-run noise.
+dataset=YearPredictionMSD
+
+BASEDIR=$(dirname "$0")
+OUTDIR="${BASEDIR}/ckpt/"
+
+if [ ! -d "${OUTDIR}" ]
+then   
+    echo "Output dir ${OUTDIR} does not exist, creating..."
+    mkdir -p ${OUTDIR}
+fi    
+
+for bf16 in False True
+do
+    python -u ${BASEDIR}/main_reg_cv.py \
+        --feat_d 90 \
+        --hidden_d 32 \
+        --boost_rate 1 \
+        --lr 0.005 \
+        --L2 .0e-3 \
+        --num_nets 40 \
+        --data ${dataset} \
+        --tr ${BASEDIR}/../data/${dataset}_tr.npz \
+        --te ${BASEDIR}/../data/${dataset}_te.npz \
+        --batch_size 2048 \
+        --epochs_per_stage 1 \
+        --correct_epoch 1 \
+        --normalization True \
+        --cv True \
+        --bf16 ${bf16} \
+        --out_f ${OUTDIR}/${dataset}_reg_bf16${bf16} \
+        "$@" > ${OUTDIR}/${dataset}_bf16${bf16}.log
+done
+
+for bf16 in False True
+do
+    log=${OUTDIR}/${dataset}_bf16${bf16}.log
+    echo "--bf16 ${bf16}: training time $(grep 'training time' ${log} | awk '{s += $6} END {printf "%.1f", s}') sec"
+    grep 'Best validation stage' ${log} | sed 's/^/  /'
+done
+paste <(grep 'Best validation stage' ${OUTDIR}/${dataset}_bf16False.log | awk '{print $(NF-3), $NF}' | tr -d ',') \
+      <(grep 'Best validation stage' ${OUTDIR}/${dataset}_bf16True.log | awk '{print $(NF-3), $NF}' | tr -d ',') \
+    | awk '{printf "bf16 - fp32: RMSE@Tr %+.5f, RMSE@Te %+.5f\n", $3 - $1, $4 - $2}'
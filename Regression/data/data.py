@@ -9,16 +9,20 @@ from scipy.sparse import csr_matrix
 from sklearn.datasets import load_svmlight_file
 from sklearn import datasets
 from sklearn.model_selection import train_test_split
+from data.cache import cached_arrays
+from data.libsvm import load_libsvm
+from data.csvfile import read_csv, log_fill
 
 
 class LibSVMData(Dataset):
-    def __init__(self, root, dim, normalization, pos=1, neg=-1, out_pos=1, out_neg=-1):
-        self.feat, self.label = load_svmlight_file(root)
-
-        self.feat = csr_matrix((self.feat.data, self.feat.indices, self.feat.indptr), shape=(len(self.label), dim))
-        self.feat = self.feat.toarray().astype(np.float32)
-
-        self.label = self.label.astype(np.float32)
+    def __init__(self, root, dim, normalization, pos=1, neg=-1, out_pos=1, out_neg=-1, cache=True):
+        def parse():
+            feat, label = load_libsvm(root, dim, np.float32, dense=True)
+            return {'feat': feat, 'label': label.astype(np.float32)}
+        # parsed once, then memory mapped from data/cache.py
+        arrays = cached_arrays(root, ('libsvm', dim), parse, cache)
+        self.feat = arrays['feat']
+        self.label = np.array(arrays['label'])
         idx_pos = self.label == pos
         idx_neg = self.label == neg
         self.label[idx_pos] = out_pos
@@ -32,9 +36,8 @@ class LibSVMData(Dataset):
 
 class LibSVMRankData(Dataset):
     def __init__(self, root2data, root2qid, dim):
-        self.feat, self.label = load_svmlight_file(root2data)
+        self.feat, self.label = load_libsvm(root2data, dtype=np.float32, dense=True)
         self.qid = np.loadtxt(root2qid, dtype='int32')
-        self.feat = self.feat.toarray().astype(np.float32)
         self.label = self.label.astype(np.float32)
         self.feat = self.feat[:, ~(self.feat == 0).all(0)]
         print(self.feat.shape[1])
@@ -46,12 +49,13 @@ class LibSVMRankData(Dataset):
         return len(self.label)
 
 class LibSVMRegData(Dataset):
-    def __init__(self, root, dim, normalization):
-        data = np.load(root)        
-        self.feat, self.label = data['features'], data['labels']
-        del data
-        self.feat = self.feat.astype(np.float32)
-        self.label = self.label.astype(np.float32)
+    def __init__(self, root, dim, normalization, cache=True):
+        def parse():
+            data = np.load(root)
+            return {'feat': data['features'].astype(np.float32), 'label': data['labels'].astype(np.float32)}
+        arrays = cached_arrays(root, ('npz',), parse, cache)
+        self.feat = arrays['feat']
+        self.label = np.array(arrays['label'])
         #self.feat = self.feat[:, ~(self.feat == 0).all(0)]
         #import ipdb; ipdb.set_trace()
 
@@ -64,10 +68,14 @@ class LibSVMRegData(Dataset):
         return len(self.label)
 
 class LibCSVData(Dataset):
-    def __init__(self, root, dim, pos=1, neg=-1):
-        self.data = np.loadtxt(root, delimiter=',').astype(np.float32)
-        self.feat = self.data[:, 1:]
-        self.label = self.data[:, 0]
+    def __init__(self, root, dim, pos=1, neg=-1, cache=True):
+        def parse(out_dir):
+            # features written straight into the cache entry
+            feat, label, _ = read_csv(root, 0, out=out_dir and os.path.join(out_dir, 'feat.npy'))
+            return {'feat': feat, 'label': label}
+        arrays = cached_arrays(root, ('csv',), parse, cache, in_place=True)
+        self.feat = arrays['feat']
+        self.label = np.array(arrays['label'])
         self.label[self.label == pos] = 1
         self.label[self.label == neg] = -1
 
@@ -80,27 +88,21 @@ class LibCSVData(Dataset):
     def __len__(self):
         return len(self.label)
 class CriteoCSVData(Dataset):
-    def __init__(self, root, dim, normalization, pos=1, neg=-1):
-        # Reading the data into panda data frame
-        self.data = pd.read_csv(root, header=None, dtype='float32')
-        # extracting labels (0, 1) and weights
-        self.label = self.data.iloc[:, -2]
-        self.weights = self.data.iloc[:, -1]
-        self.data = self.data.iloc[:, :-2]
+    def __init__(self, root, dim, normalization, pos=1, neg=-1, cache=True):
+        def parse(out_dir):
+            # labels (0, 1) and weights are the last two columns
+            data, label, weights = read_csv(root, -2, -1, out=out_dir and os.path.join(out_dir, 'data.npy'))
+            if normalization:
+                # log transformation, then Nan values filled with the mean of their column
+                log_fill(data)
+            return {'data': data, 'label': label, 'weights': weights}
+        arrays = cached_arrays(root, ('criteo', normalization), parse, cache, in_place=True)
+        self.data = arrays['data']
+        self.label = np.array(arrays['label'])
+        self.weights = np.array(arrays['weights'])
         # transferring labels from {0, 1} to {-1, 1}
         self.label[self.label == pos] = 1
         self.label[self.label == neg] = -1
-
-        # Applying log transformation
-        mm = self.data.min().min() # to prevent 0 division
-        if normalization:
-            # Filling Nan values: Simple approach, mean of the that column or interpolation
-            self.data = self.data.transform(lambda x: np.log(x - mm + 1))
-            #self.data = self.data.interpolate(method='polynomial', order=2)
-            self.data = self.data.fillna(self.data.mean()) # To fill the rest of Nan values left untouched on the corners
-            #self.data = (self.data - self.data.mean())/self.data.std()
-        #self.feat = self.data.to_numpy('float32')
-        self.data = self.data.to_numpy('float32')
     def __getitem__(self, index):
         #arr = np.log(self.feat[index, :] + 1.0e-5)
         #arr = np.log10(self.feat[index, :] + 1.0e-5)
@@ -110,3 +112,14 @@ class CriteoCSVData(Dataset):
 
     def __len__(self):
         return len(self.label)
+
+class IndexedData(Dataset):
+    """Wraps a dataset so that every item also carries its sample id."""
+    def __init__(self, data):
+        self.data = data
+
+    def __getitem__(self, index):
+        return tuple(self.data[index]) + (index,)
+
+    def __len__(self):
+        return len(self.data)
@@ -0,0 +1,105 @@
+import io
+import mmap
+import os
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.datasets import load_svmlight_file
+from data.stream import line_ranges, read_range, count_lines
+from models.fork import fork_map
+
+# Parallel LibSVM parser. The file is cut into byte ranges on line boundaries
+# and every range is parsed by sklearn's parser in a forked process, which
+# writes its rows straight into CSR buffers (or a dense array) in shared
+# memory; the parent only joins the ranges. The result is the one of
+# load_svmlight_file(path), including its zero_based='auto' rule: one-based
+# unless some feature index is 0.
+
+_MIN_PART = 1 << 24     # bytes; smaller files are parsed in this process
+
+
+def _shared(n, dtype):
+    # Anonymous shared mapping, written by the forked workers and read by the parent
+    dtype = np.dtype(dtype)
+    return np.frombuffer(mmap.mmap(-1, max(n * dtype.itemsize, 1)), dtype=dtype, count=n)
+
+
+def _densify(out, data, indices, indptr, rows):
+    lo, hi = indptr[rows.start], indptr[rows.stop]
+    row = np.repeat(np.arange(rows.stop - rows.start), np.diff(indptr[rows.start:rows.stop + 1]))
+    out[rows][row, indices[lo:hi]] = data[lo:hi]
+
+
+def load_libsvm(path, n_features=None, dtype=np.float64, zero_based='auto', dense=False, workers=None):
+    """load_svmlight_file(path, n_features=..., dtype=..., zero_based=...) on
+    several cores.
+
+    :param dense: return the features as a C-ordered ndarray instead of a csr_matrix
+    :param workers: processes to parse with, all available cores if None
+    :return: (features, labels)
+    """
+    workers = workers or len(os.sched_getaffinity(0))
+    parts = max(1, min(workers, os.path.getsize(path) // _MIN_PART))
+    if parts == 1:
+        feat, label = load_svmlight_file(path, n_features=n_features, dtype=dtype, zero_based=zero_based)
+        return (feat.toarray() if dense else csr_matrix(feat)), label
+    ranges = line_ranges(path, parts)
+
+    # Upper bounds of the rows (lines) and entries (':') of every range, so
+    # the shared buffers can be allocated before the workers are forked
+    def count(k):
+        buf = read_range(path, *ranges[k])
+        return count_lines(buf), buf.count(b':')
+    bounds = np.array(fork_map(count, parts, 'Parser process'), dtype=np.int64)
+    row_start = np.concatenate([[0], np.cumsum(bounds[:, 0])])
+    nnz_start = np.concatenate([[0], np.cumsum(bounds[:, 1])])
+    index_dtype = np.int32 if nnz_start[-1] < 2 ** 31 else np.int64
+    label = _shared(row_start[-1], np.float64)
+    indptr = _shared(row_start[-1] + parts, index_dtype)     # one leading 0 per range
+    indices = _shared(nnz_start[-1], index_dtype)
+    data = _shared(nnz_start[-1], dtype)
+
+    def parse(k):
+        buf = read_range(path, *ranges[k])
+        if not buf.strip():
+            return 0, 0, -1, -1
+        x, y = load_svmlight_file(io.BytesIO(buf), dtype=dtype, zero_based=True)
+        n, nnz = len(y), x.nnz
+        r, z = row_start[k] + k, nnz_start[k]
+        label[row_start[k]:row_start[k] + n] = y
+        indptr[r:r + n + 1] = x.indptr
+        indices[z:z + nnz] = x.indices
+        data[z:z + nnz] = x.data
+        return n, nnz, int(x.indices.min()) if nnz else -1, int(x.indices.max()) if nnz else -1
+    parsed = np.array(fork_map(parse, parts, 'Parser process'), dtype=np.int64)
+    rows, nnz = parsed[:, 0], parsed[:, 1]
+
+    # Join the ranges; no copy when the bounds were exact (one row per line, no comments)
+    if np.array_equal(rows, bounds[:, 0]) and np.array_equal(nnz, bounds[:, 1]):
+        label = label[:]
+        indices, data = indices[:], data[:]
+    else:
+        label = np.concatenate([label[row_start[k]:row_start[k] + rows[k]] for k in range(parts)])
+        indices = np.concatenate([indices[nnz_start[k]:nnz_start[k] + nnz[k]] for k in range(parts)])
+        data = np.concatenate([data[nnz_start[k]:nnz_start[k] + nnz[k]] for k in range(parts)])
+    offset = np.concatenate([[0], np.cumsum(nnz)])
+    indptr = np.concatenate([[0]] + [indptr[row_start[k] + k + 1:row_start[k] + k + rows[k] + 1] + offset[k]
+                                     for k in range(parts)]).astype(index_dtype)
+
+    seen = parsed[:, 2] >= 0
+    if zero_based is False and seen.any() and parsed[seen, 2].min() == 0:
+        raise ValueError(f'{path}: feature index 0 with zero_based=False')
+    if zero_based is False or (zero_based == 'auto' and seen.any() and parsed[seen, 2].min() > 0):
+        indices -= 1
+        parsed[:, 3] -= 1
+    n_f = int(parsed[:, 3].max()) + 1 if seen.any() else 1
+    if n_features is None:
+        n_features = n_f
+    elif n_features < n_f:
+        raise ValueError(f'n_features was set to {n_features}, but input file contains {n_f} features')
+    if not dense:
+        return csr_matrix((data, indices, indptr), shape=(len(label), n_features)), label
+
+    out = _shared(len(label) * n_features, dtype).reshape(len(label), n_features)
+    row_start = np.concatenate([[0], np.cumsum(rows)])
+    fork_map(lambda k: _densify(out, data, indices, indptr, slice(row_start[k], row_start[k + 1])), parts, 'Parser process')
+    return out, label
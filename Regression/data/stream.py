@@ -0,0 +1,119 @@
+import io
+import itertools
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+from sklearn.datasets import load_svmlight_file
+
+# Chunked readers for the file formats of data.py. Each yields float32
+# feature blocks of at most `chunk_size` rows, so a file of any size can be
+# scored in bounded memory; with labels=True they yield (features, labels)
+# pairs instead.
+
+
+def line_ranges(path, parts):
+    # `parts` byte ranges of a text file that start at the beginning of a line
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, parts):
+            f.seek(max(size * k // parts - 1, bounds[-1]))
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+def count_lines(buf):
+    return buf.count(b'\n') + (len(buf) > 0 and not buf.endswith(b'\n'))
+
+
+def count_rows(path, fmt):
+    if fmt == 'npz':
+        with zipfile.ZipFile(path) as z, z.open('features.npy') as f:
+            return _npy_header(f)[0][0]
+    rows = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            rows += block.count(b'\n')
+            last = block
+    if not last.endswith(b'\n'):
+        rows += 1   # no newline after the last row
+    return rows
+
+
+def libsvm_chunks(path, dim, chunk_size, zero_based='auto', labels=False):
+    """LibSVM rows as in LibSVMData.
+
+    With zero_based='auto' the indexing is decided once from the first chunk
+    (zero-based if it uses feature index 0) and kept for the whole file.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            buf = b''.join(lines)
+            if zero_based == 'auto':
+                feat, _ = load_svmlight_file(io.BytesIO(buf), n_features=dim + 1, zero_based=True)
+                zero_based = bool(feat.nnz and feat.indices.min() == 0)
+            feat, label = load_svmlight_file(io.BytesIO(buf), n_features=dim, zero_based=zero_based)
+            feat = feat.toarray().astype(np.float32)
+            yield (feat, label.astype(np.float32)) if labels else feat
+
+
+def csv_chunks(path, dim, chunk_size, labels=False):
+    # LibCSVData layout: label in the first column, then the features
+    for df in pd.read_csv(path, header=None, dtype=np.float32, chunksize=chunk_size):
+        feat = df.iloc[:, 1:dim + 1].to_numpy(np.float32)
+        yield (feat, df.iloc[:, 0].to_numpy(np.float32)) if labels else feat
+
+
+def _npy_header(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def _npy_blocks(z, name, ndim, chunk_size):
+    # Rows of an array member of an open archive, chunk_size at a time
+    with z.open(name) as f:
+        shape, fortran_order, dtype = _npy_header(f)
+        if fortran_order or len(shape) != ndim:
+            raise ValueError(f'{z.filename}: expected a C-ordered {ndim}-d {name} array, got shape {shape}')
+        row_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+        for start in range(0, shape[0], chunk_size):
+            n = min(chunk_size, shape[0] - start)
+            yield np.frombuffer(f.read(n * row_bytes), dtype=dtype).reshape((n,) + shape[1:])
+
+
+def npz_chunks(path, dim, chunk_size, labels=False):
+    # 'features' (and 'labels') arrays of a LibSVMRegData file, read straight
+    # from the archive members (stored or compressed) instead of loading them whole
+    with zipfile.ZipFile(path) as z:
+        feats = _npy_blocks(z, 'features.npy', 2, chunk_size)
+        if not labels:
+            for arr in feats:
+                yield arr[:, :dim].astype(np.float32)
+            return
+        for arr, label in zip(feats, _npy_blocks(z, 'labels.npy', 1, chunk_size)):
+            yield arr[:, :dim].astype(np.float32), label.astype(np.float32)
+
+
+def iter_chunks(path, fmt, dim, chunk_size, zero_based='auto', labels=False):
+    if fmt == 'libsvm':
+        return libsvm_chunks(path, dim, chunk_size, zero_based, labels)
+    elif fmt == 'csv':
+        return csv_chunks(path, dim, chunk_size, labels)
+    elif fmt == 'npz':
+        return npz_chunks(path, dim, chunk_size, labels)
+    raise ValueError(f'Unknown input format {fmt}')
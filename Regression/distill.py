@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+import numpy as np
+import argparse
+import os
+import time
+import torch
+import torch.nn as nn
+from data.sparseloader import DataLoader
+from data.data import LibSVMRegData, IndexedData
+from models.mlp import MLP_2HL, DNN
+from models.dynamic_net import DynamicNet
+from models.checkpoint import read_scaler, write_scaler
+from torch.optim import Adam
+
+
+parser = argparse.ArgumentParser()
+# Teacher: a checkpoint written by main_reg_cv.py and the options it was trained with
+parser.add_argument('--model', type=str, required=True)
+parser.add_argument('--feat_d', type=int, required=True)
+parser.add_argument('--hidden_d', type=int, required=True)
+parser.add_argument('--data', type=str, required=True)
+parser.add_argument('--tr', type=str, required=True)
+parser.add_argument('--te', type=str, required=True)
+parser.add_argument('--sparse', action='store_true')
+parser.add_argument('--normalization', default=False, type=lambda x: (str(x).lower() == 'true'))
+# Student
+parser.add_argument('--student_hidden', type=int, default=64)
+parser.add_argument('--student_layers', type=int, default=2)
+parser.add_argument('--lr', type=float, default=1e-3)
+parser.add_argument('--L2', type=float, default=0.)
+parser.add_argument('--epochs', type=int, default=10)
+parser.add_argument('--batch_size', type=int, default=2048)
+# Weight of the true-label MSE next to matching the teacher's scores
+parser.add_argument('--alpha', type=float, default=0.)
+parser.add_argument('--batch_sizes', type=str, default='1,64,2048')
+parser.add_argument('--out_f', type=str, required=True)
+parser.add_argument('--cuda', action='store_true')
+parser.add_argument('--num_threads', type=int, default=0)
+
+opt = parser.parse_args()
+
+device = torch.device('cuda' if opt.cuda else 'cpu')
+if not opt.cuda:
+    # One intra-op thread per core available to this process unless given
+    torch.set_num_threads(opt.num_threads or len(os.sched_getaffinity(0)))
+
+# Same datasets and preprocessing as main_reg_cv.py, with the scaler it fit on its
+# training split and saved with the checkpoint
+def get_data():
+    if opt.data in ['ca_housing', 'ailerons', 'YearPredictionMSD', 'slice_localization']:
+        train = LibSVMRegData(opt.tr, opt.feat_d, opt.normalization)
+        test = LibSVMRegData(opt.te, opt.feat_d, opt.normalization)
+    else:
+        pass
+
+    scaler = None
+    if opt.normalization:
+        scaler = read_scaler(opt.model)
+        if scaler is None:
+            parser.error(f'--normalization: no scaler saved with {opt.model}')
+        train.feat = scaler.transform(train.feat)
+        test.feat = scaler.transform(test.feat)
+
+    print(f'#Train: {len(train)}, #Test: {len(test)}')
+    return train, test, scaler
+
+
+def teacher_fn(net_ensemble):
+    # The fused graph gives the same scores and makes labelling the training set cheap
+    if all(isinstance(m, MLP_2HL) for m in net_ensemble.models) and not opt.sparse:
+        return net_ensemble.fuse()
+    return net_ensemble.forward
+
+
+def predict(f, loader):
+    scores = []
+    with torch.no_grad():
+        for x, *_ in loader:
+            _, out = f(x.to(device))
+            scores.append(out.view(-1).cpu())
+    return torch.cat(scores)
+
+
+def student_fn(student):
+    return lambda x: (None, student(x))
+
+
+def root_mse(scores, label):
+    return torch.sqrt(((scores.double() - label.double()) ** 2).mean()).item()
+
+
+def rows_per_sec(f, x, batch_size, repeat=3):
+    best = float('inf')
+    with torch.no_grad():
+        for _ in range(repeat):
+            t0 = time.time()
+            for i in range(0, len(x), batch_size):
+                f(x[i:i + batch_size])
+            best = min(best, time.time() - t0)
+    return len(x) / best
+
+
+if __name__ == "__main__":
+
+    train, test, scaler = get_data()
+    net_ensemble = DynamicNet.from_file(opt.model, lambda stage: MLP_2HL.get_model(stage, opt), device)
+    net_ensemble.to_eval()
+    teacher = teacher_fn(net_ensemble)
+
+    # Teacher scores of every training sample, computed once
+    t0 = time.time()
+    targets = predict(teacher, DataLoader(train, opt.batch_size, shuffle=False, drop_last=False, num_workers=2)).to(device)
+    print(f'Teacher: {len(net_ensemble.models)} stages, scored {len(train)} training samples in {time.time() - t0:.1f} sec')
+
+    student = DNN(opt.feat_d, opt.student_hidden, opt.student_layers, opt.sparse, drop_out=0.).to(device)
+    optimizer = Adam(student.parameters(), opt.lr, weight_decay=opt.L2)
+    loss_f = nn.MSELoss()
+    train_loader = DataLoader(IndexedData(train), opt.batch_size, shuffle=True, drop_last=False, num_workers=2)
+    for epoch in range(opt.epochs):
+        t0 = time.time()
+        student.train()
+        epoch_loss = []
+        for x, y, idx in train_loader:
+            x = x.to(device)
+            y = torch.as_tensor(y, dtype=torch.float32, device=device).view(-1)
+            out = student(x).view(-1)
+            loss = loss_f(out, targets[idx.to(device)])
+            if opt.alpha > 0:
+                loss = loss + opt.alpha * loss_f(out, y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            epoch_loss.append(loss.item())
+        print(f'Epoch - {epoch}, time: {time.time() - t0: .1f} sec, distillation loss: {np.mean(epoch_loss): .5f}')
+    student.eval()
+    torch.save({'state_dict': student.state_dict(), 'dim_in': opt.feat_d, 'dim_hidden': opt.student_hidden,
+                'n_hidden': opt.student_layers, 'sparse': opt.sparse}, opt.out_f)
+    # The student takes the same scaled inputs as the teacher
+    write_scaler(opt.out_f, scaler)
+
+    # Accuracy vs latency of the teacher (python loop and fused) and the student
+    test_loader = DataLoader(test, opt.batch_size, shuffle=False, drop_last=False, num_workers=2)
+    label = torch.as_tensor(test.label, dtype=torch.float32)
+    batch_sizes = [int(b) for b in opt.batch_sizes.split(',')]
+    if opt.sparse:
+        batch_sizes = []    # timing slices dense rows
+    else:
+        x = torch.as_tensor(test.feat[:20000], dtype=torch.float32, device=device)
+    candidates = [('teacher', net_ensemble.forward), ('student', student_fn(student))]
+    if teacher is not net_ensemble.forward:
+        candidates.insert(1, ('teacher-fused', teacher))
+    print('Model, RMSE@Test, ' + ', '.join(f'rows/s@{b}' for b in batch_sizes))
+    for name, f in candidates:
+        test_rmse = root_mse(predict(f, test_loader), label)
+        speed = [rows_per_sec(f, x[:max(b, min(len(x), 20 * b))], b) for b in batch_sizes]
+        print(f'{name}, {test_rmse:.5f}, ' + ', '.join(f'{s:.0f}' for s in speed))
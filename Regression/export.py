@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+import argparse
+import torch
+from models.mlp import MLP_2HL
+from models.dynamic_net import DynamicNet
+from models.export import export_module, to_torchscript, to_onnx
+
+
+parser = argparse.ArgumentParser()
+# A checkpoint (file or directory) and the options the ensemble was trained with
+parser.add_argument('--model', type=str, required=True)
+parser.add_argument('--feat_d', type=int, required=True)
+parser.add_argument('--hidden_d', type=int, required=True)
+# Export the fused graph (one wide matmul for the x part of all stages)
+parser.add_argument('--fused', default=False, type=lambda x: (str(x).lower() == 'true'))
+parser.add_argument('--opset', type=int, default=11)
+# Writes <out_f>.pt (TorchScript) and <out_f>.onnx
+parser.add_argument('--out_f', type=str, required=True)
+
+opt = parser.parse_args()
+opt.sparse = False      # SpLinear is a custom autograd Function and cannot be exported
+
+
+if __name__ == "__main__":
+    net_ensemble = DynamicNet.from_file(opt.model, lambda stage: MLP_2HL.get_model(stage, opt))
+    module = export_module(net_ensemble, opt.fused)
+    example = torch.randn(2, opt.feat_d)
+    scripted = to_torchscript(module, example, opt.out_f + '.pt')
+    to_onnx(module, example, opt.out_f + '.onnx', opt.opset)
+
+    # Check both graphs against the Python ensemble on a different batch size
+    x = torch.randn(1000, opt.feat_d)
+    with torch.no_grad():
+        ref = net_ensemble.forward(x)[1].view(-1)
+        err = (torch.jit.load(opt.out_f + '.pt')(x) - ref).abs().max().item()
+    print(f'#Stages: {len(net_ensemble.models)}, TorchScript: {opt.out_f}.pt (max abs diff {err:.2e})')
+    try:
+        import onnxruntime
+    except ImportError:
+        print(f'ONNX: {opt.out_f}.onnx (not checked, onnxruntime is not installed)')
+    else:
+        session = onnxruntime.InferenceSession(opt.out_f + '.onnx', providers=['CPUExecutionProvider'])
+        out = session.run(['score'], {'x': x.numpy()})[0]
+        err = (torch.from_numpy(out) - ref).abs().max().item()
+        print(f'ONNX: {opt.out_f}.onnx (max abs diff {err:.2e})')
@@ -2,16 +2,26 @@
 import numpy as np
 import argparse
 import copy
+import os
+import sys
 import torch
 import torch.nn as nn
 import time
 from data.sparseloader import DataLoader
-from data.data import LibSVMData, LibCSVData, LibSVMRegData
+from data.batchloader import BatchLoader
+from data.data import LibSVMData, LibCSVData, LibSVMRegData, IndexedData
 from data.sparse_data import LibSVMDataSp
 from models.mlp import MLP_1HL, MLP_2HL, MLP_3HL
 from models.dynamic_net import DynamicNet, ForwardType
+from models.stage_cache import StageCache
+from models.checkpoint import StageCheckpoint
+from models.precision import bf16_autocast
+from models.candidates import train_candidates
+from models.plateau import EpochPlateau
+from models.distributed import init_distributed, shard_indices, broadcast_module, all_reduce_grads, average_buffers, broadcast_flag, all_reduce_mean
 from sklearn.metrics import mean_squared_error
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
+from torch.utils.data.sampler import SubsetRandomSampler
 from torch.optim import SGD, Adam
 
 
@@ -29,22 +39,71 @@ parser.add_argument('--batch_size', type=int, required=True)
 parser.add_argument('--epochs_per_stage', type=int, required=True)
 parser.add_argument('--correct_epoch', type=int ,required=True)
 parser.add_argument('--L2', type=float, required=True)
+# End the learner and corrective epoch loops of a stage once their loss on a held-out slice of the
+# training rows improves by less than this fraction (0: always run all the epochs)
+parser.add_argument('--plateau_tol', type=float, default=0.)
+# Fraction of the training rows held out for --plateau_tol
+parser.add_argument('--plateau_holdout', type=float, default=0.05)
+# Epoch cap of both loops under --plateau_tol (0: --epochs_per_stage and --correct_epoch)
+parser.add_argument('--max_epochs', type=int, default=0)
 parser.add_argument('--sparse', action='store_true')
 parser.add_argument('--normalization', default=False, type=lambda x: (str(x).lower() == 'true')) 
 parser.add_argument('--cv', default=False, type=lambda x: (str(x).lower() == 'true')) 
+# Train this many candidate learners per stage in forked processes (CPU only) and keep the one
+# with the lowest validation RMSE (training loss without --cv)
+parser.add_argument('--candidates', type=int, default=1)
+# Learning rate multipliers cycled over the candidates; each candidate also gets its own seed
+parser.add_argument('--candidate_lr_scale', type=str, default='1')
+# Corrective step on the last N stages only (plus boost_rate), 0 corrects all of them
+parser.add_argument('--correct_window', type=int, default=0)
+# Recompute the corrective step's activations in backward, this many stages at a time (0: keep them all)
+parser.add_argument('--checkpoint_segment', type=int, default=0)
+# Keep the parsed dataset files as memory mapped .npy files in a .npycache directory next to them
+parser.add_argument('--data_cache', default=True, type=lambda x: (str(x).lower() == 'true'))
+# Cache the frozen ensemble's outputs per sample (models/stage_cache.py). The frozen learners then run
+# in eval mode (BatchNorm running stats, left unchanged) instead of train mode, in the corrective step
+# too for the ones before --correct_window. The cache keeps the outputs of the learners a corrective
+# step did not change, so it saves work with --correct_window or --epochs_per_stage > 1
+parser.add_argument('--stage_cache', default=False, type=lambda x: (str(x).lower() == 'true'))
+# Gather dense batches with one slice or fancy index of the feature array (data/batchloader.py)
+# instead of per-row __getitem__ in loader workers
+parser.add_argument('--batch_loader', default=True, type=lambda x: (str(x).lower() == 'true'))
+# Score every prefix of the final ensemble once after training instead of re-scoring after each stage
+parser.add_argument('--staged_eval', default=False, type=lambda x: (str(x).lower() == 'true'))
+# Stop once RMSE@Val has not improved for this many stages and keep the ensemble of the best stage (0: off)
+parser.add_argument('--patience', type=int, default=0)
 parser.add_argument('--out_f', type=str, required=True)
 parser.add_argument('--cuda', action='store_true')
+parser.add_argument('--num_threads', type=int, default=0)
+# Set by torch.distributed.launch; torchrun and the launcher's environment (RANK, WORLD_SIZE, ...)
+# start data-parallel training over gloo, see models/distributed.py
+parser.add_argument('--local_rank', type=int, default=0)
+# bfloat16 autocast for stage training, the corrective step and evaluation (CPU, torch >= 1.10)
+parser.add_argument('--bf16', default=False, type=lambda x: (str(x).lower() == 'true'))
 
 opt = parser.parse_args()
-
+if opt.bf16 and (opt.cuda or not hasattr(torch, 'autocast')):
+    parser.error('--bf16 needs CPU training and torch >= 1.10')
+if opt.patience and (not opt.cv or opt.staged_eval):
+    parser.error('--patience needs the per-stage validation of --cv True --staged_eval False')
+if opt.plateau_tol and not 0 < opt.plateau_holdout < 1:
+    parser.error('--plateau_holdout must be a fraction in (0, 1)')
+if opt.candidates > 1 and opt.cuda:
+    parser.error('--candidates needs CPU training')
+
+device = torch.device('cuda' if opt.cuda else 'cpu')
 if not opt.cuda:
-    torch.set_num_threads(16)
+    # One intra-op thread per core available to this process (split between the ranks on this host) unless given
+    torch.set_num_threads(opt.num_threads or max(1, len(os.sched_getaffinity(0)) // int(os.environ.get('LOCAL_WORLD_SIZE', 1))))
+rank, world_size = init_distributed()
+if opt.candidates > 1 and world_size > 1:
+    parser.error('--candidates cannot be combined with distributed training')
 
 # prepare the dataset
 def get_data():
     if opt.data in ['ca_housing', 'ailerons', 'YearPredictionMSD', 'slice_localization']:
-        train = LibSVMRegData(opt.tr, opt.feat_d, opt.normalization)
-        test = LibSVMRegData(opt.te, opt.feat_d, opt.normalization)
+        train = LibSVMRegData(opt.tr, opt.feat_d, opt.normalization, cache=opt.data_cache)
+        test = LibSVMRegData(opt.te, opt.feat_d, opt.normalization, cache=opt.data_cache)
         val = []
         if opt.cv:
             val = copy.deepcopy(train)
@@ -62,6 +121,7 @@ def get_data():
     else:
         pass
 
+    scaler = None
     if opt.normalization:
         scaler = StandardScaler()
         scaler.fit(train.feat)
@@ -70,7 +130,7 @@ def get_data():
         if opt.cv:
             val.feat = scaler.transform(val.feat)
     print(f'#Train: {len(train)}, #Val: {len(val)} #Test: {len(test)}')
-    return train, test, val
+    return train, test, val, scaler
 
 
 def get_optim(params, lr, weight_decay):
@@ -79,16 +139,26 @@ def get_optim(params, lr, weight_decay):
     return optimizer
 
 
-def root_mse(net_ensemble, loader):
+def get_loader(dataset, batch_size, **kwargs):
+    if opt.batch_loader and BatchLoader.supports(dataset):
+        return BatchLoader(dataset, batch_size, **kwargs)
+    return DataLoader(dataset, batch_size, num_workers=2, **kwargs)
+
+def ensemble_forward(net_ensemble, x, idx, cache):
+    with bf16_autocast(opt.bf16):
+        if cache is None:
+            return net_ensemble.forward(x)
+        return cache.forward(net_ensemble, x, idx)
+
+
+def root_mse(net_ensemble, loader, cache=None):
     loss = 0
     total = 0
  
-    for x, y in loader:
-        if opt.cuda:
-            x = x.cuda()
-
+    for x, y, *idx in loader:
+        x = x.to(device)
         with torch.no_grad():
-            _, out = net_ensemble.forward(x)
+            _, out = ensemble_forward(net_ensemble, x, *idx, cache)
         y = y.cpu().numpy().reshape(len(y), 1)
         out = out.cpu().numpy().reshape(len(y), 1)
         loss += mean_squared_error(y, out)* len(y)
@@ -96,6 +166,96 @@ def root_mse(net_ensemble, loader):
     return np.sqrt(loss / total)
 
 
+def staged_root_mse(net_ensemble, loader):
+    # RMSE of every ensemble prefix from a single cascade pass over the loader
+    loss = 0
+    total = 0
+    for x, y, *_ in loader:
+        x, y = x.to(device), y.to(device).view(1, -1)
+        with bf16_autocast(opt.bf16):
+            out = torch.stack([out.view(-1) for _, out in net_ensemble.staged_forward(x)])
+        loss += ((out - y) ** 2).sum(1).double().cpu().numpy()
+        total += y.shape[1]
+    return np.sqrt(loss / total)
+
+
+def max_epochs(epochs, holdout_loader):
+    # Under --plateau_tol the loops stop early, up to --max_epochs if given
+    return (opt.max_epochs or epochs) if holdout_loader is not None else epochs
+
+
+def learner_loss(model, net_ensemble, x, y, idx, cache):
+    # Squared error of the learner against the residuals of the frozen ensemble
+    loss_f1 = nn.MSELoss()
+    x = x.to(device)
+    y = torch.as_tensor(y, dtype=torch.float32, device=device).view(-1, 1)
+    middle_feat, out = ensemble_forward(net_ensemble, x, idx, cache)
+    out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
+    grad_direction = -(out-y)
+
+    with bf16_autocast(opt.bf16):
+        _, out = model(x, middle_feat)
+    out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
+    return loss_f1(net_ensemble.boost_rate*out, grad_direction)  # T
+
+
+def heldout_learner_loss(model, net_ensemble, holdout_loader, cache):
+    model.eval()
+    loss = total = 0
+    with torch.no_grad():
+        for x, y, idx in holdout_loader:
+            loss += learner_loss(model, net_ensemble, x, y, idx, cache).item() * len(y)
+            total += len(y)
+    model.train()
+    return all_reduce_mean(loss / total)
+
+
+def heldout_mse(net_ensemble, holdout_loader, cache):
+    net_ensemble.to_eval()
+    loss = root_mse(net_ensemble, holdout_loader, cache) ** 2
+    net_ensemble.to_train()
+    return all_reduce_mean(loss)
+
+
+def fit_learner(model, lr, net_ensemble, train_loader, train_cache, holdout_loader=None):
+    # Fits one stage learner to the residuals of the frozen ensemble, returns
+    # its batch losses and the number of epochs it took
+    optimizer = get_optim(model.parameters(), lr, opt.L2)
+    stage_mdlloss = []
+    plateau = None
+    if holdout_loader is not None:
+        plateau = EpochPlateau(opt.plateau_tol, heldout_learner_loss(model, net_ensemble, holdout_loader, train_cache))
+    epochs = 0
+    for epoch in range(max_epochs(opt.epochs_per_stage, holdout_loader)):
+        epochs += 1
+        for i, (x, y, idx) in enumerate(train_loader):
+            loss = learner_loss(model, net_ensemble, x, y, idx, train_cache)
+            model.zero_grad()
+            loss.backward()
+            all_reduce_grads(model.parameters())
+            optimizer.step()
+            stage_mdlloss.append(loss.item()*len(y))
+        if plateau is not None and plateau.stop(heldout_learner_loss(model, net_ensemble, holdout_loader, train_cache)):
+            break
+    average_buffers([model])
+    return stage_mdlloss, epochs
+
+
+def fit_candidate(stage, lr, net_ensemble, train_loader, train_cache, holdout_loader, val_loader, val_cache):
+    # Runs in a forked process (models/candidates.py): adding the learner to the
+    # ensemble here only changes this process' copy
+    model = MLP_2HL.get_model(stage, opt)
+    model.to(device)
+    stage_mdlloss, epochs = fit_learner(model, lr, net_ensemble, train_loader, train_cache, holdout_loader)
+    if val_loader is None:
+        return model, stage_mdlloss, epochs, float(np.sqrt(np.sum(stage_mdlloss) / len(train_loader.sampler)))
+    net_ensemble.add(model)
+    net_ensemble.to_eval()
+    loss = root_mse(net_ensemble, val_loader, val_cache)
+    net_ensemble.to_train()
+    return model, stage_mdlloss, epochs, float(loss)
+
+
 def init_gbnn(train):
     positive = negative = 0
     for i in range(len(train)):
@@ -110,47 +270,64 @@ def init_gbnn(train):
 
 if __name__ == "__main__":
 
-    train, test, val = get_data()
-    N = len(train)
+    train, test, val, scaler = get_data()
     print(opt.data + ' training and test datasets are loaded!')
-    train_loader = DataLoader(train, opt.batch_size, shuffle=True, drop_last=False, num_workers=2)
-    test_loader = DataLoader(test, opt.batch_size, shuffle=False, drop_last=False, num_workers=2)
+    train_loader = get_loader(IndexedData(train), opt.batch_size, shuffle=True, drop_last=False)
+    test_loader = get_loader(IndexedData(test), opt.batch_size, shuffle=False, drop_last=False)
     if opt.cv:
-        val_loader = DataLoader(val, opt.batch_size, shuffle=True, drop_last=False, num_workers=2)
+        val_loader = get_loader(IndexedData(val), opt.batch_size, shuffle=True, drop_last=False)
     best_rmse = pow(10, 6)
     val_rmse = best_rmse
     best_stage = opt.num_nets-1
     c0 = np.mean(train.label)  #init_gbnn(train)
-    net_ensemble = DynamicNet(c0, opt.boost_rate)
+    if world_size > 1:
+        # c0 comes from all training rows, then every rank keeps its own shard
+        shard = shard_indices(len(train), rank, world_size)
+        train.feat = train.feat[shard]
+        train.label = train.label[shard]
+        print(f'Rank {rank}/{world_size}: {len(train)} training rows')
+    holdout_loader = None
+    if opt.plateau_tol:
+        # The epoch loops of every stage are scored on the same held-out rows
+        indices = np.random.permutation(len(train))
+        cut = int(len(train) * (1 - opt.plateau_holdout))
+        train_loader = get_loader(IndexedData(train), opt.batch_size, sampler=SubsetRandomSampler(indices[:cut]), drop_last=False)
+        holdout_loader = get_loader(IndexedData(train), opt.batch_size, sampler=SubsetRandomSampler(indices[cut:]), drop_last=False)
+    N = len(train_loader.sampler)
+    net_ensemble = DynamicNet(c0, opt.boost_rate, device)
+    # Only rank 0 evaluates and checkpoints
+    checkpoint = StageCheckpoint(opt.out_f) if rank == 0 else None
+    if checkpoint is not None:
+        # Fit on the training split only; predict.py, serve.py, distill.py and quantize.py load it from the checkpoint
+        checkpoint.save_scaler(scaler)
+    # Outputs of the frozen learners for every training sample
+    train_cache = StageCache(len(train)) if opt.stage_cache else None
+    # Same for the evaluation sets: after a corrective step with --correct_window W an evaluation
+    # reruns W + 1 learners per row, without a window the whole cascade
+    test_cache = StageCache(len(test)) if opt.stage_cache else None
+    val_cache = StageCache(len(val)) if opt.stage_cache and opt.cv else None
     loss_f1 = nn.MSELoss()
     loss_models = torch.zeros((opt.num_nets, 3))
+    lr_scale = [float(v) for v in opt.candidate_lr_scale.split(',')]
+    epochs_used = []    # learner and corrective epochs of every stage
+    best_state = None
+    stop_reason = f'trained all {opt.num_nets} stages'
     for stage in range(opt.num_nets):
         t0 = time.time()
-        model = MLP_2HL.get_model(stage, opt)  # Initialize the model_k: f_k(x), multilayer perception v2
-        if opt.cuda:
-            model.cuda()
-
-        optimizer = get_optim(model.parameters(), opt.lr, opt.L2)
         net_ensemble.to_train() # Set the models in ensemble net to train mode
-        stage_mdlloss = []
-        for epoch in range(opt.epochs_per_stage):
-            for i, (x, y) in enumerate(train_loader):
-                
-                if opt.cuda:
-                    x= x.cuda()
-                    y = torch.as_tensor(y, dtype=torch.float32).cuda().view(-1, 1)
-                middle_feat, out = net_ensemble.forward(x)
-                out = torch.as_tensor(out, dtype=torch.float32).cuda().view(-1, 1)
-                grad_direction = -(out-y)
-
-                _, out = model(x, middle_feat)
-                out = torch.as_tensor(out, dtype=torch.float32).cuda().view(-1, 1)
-                loss = loss_f1(net_ensemble.boost_rate*out, grad_direction)  # T
-
-                model.zero_grad()
-                loss.backward()
-                optimizer.step()
-                stage_mdlloss.append(loss.item()*len(y))
+        if opt.candidates > 1:
+            fit = lambda k: fit_candidate(stage, opt.lr * lr_scale[k % len(lr_scale)], net_ensemble, train_loader, train_cache, holdout_loader,
+                                          val_loader if opt.cv else None, val_cache)
+            results = train_candidates(fit, opt.candidates, max(1, torch.get_num_threads() // opt.candidates))
+            losses = [r[3] for r in results]
+            best = int(np.argmin(losses))
+            model, stage_mdlloss, learner_epochs, _ = results[best]
+            print(f'Stage - {stage}, candidate losses: {np.round(losses, 5).tolist()}, kept candidate {best}')
+        else:
+            model = MLP_2HL.get_model(stage, opt)  # Initialize the model_k: f_k(x), multilayer perception v2
+            model.to(device)
+            broadcast_module(model)     # same initial weights on every rank
+            stage_mdlloss, learner_epochs = fit_learner(model, opt.lr, net_ensemble, train_loader, train_cache, holdout_loader)
 
         net_ensemble.add(model)
         sml = np.sqrt(np.sum(stage_mdlloss)/N)
@@ -160,59 +337,105 @@ if __name__ == "__main__":
         lr_scaler = 3
         # fully-corrective step
         stage_loss = []
+        correct_epochs = 0
         if stage > 0:
             # Adjusting corrective step learning rate 
             if stage % 15 == 0:
                 #lr_scaler *= 2
                 opt.lr /= 2
                 opt.L2 /= 2
-            optimizer = get_optim(net_ensemble.parameters(), opt.lr / lr_scaler, opt.L2)
-            for _ in range(opt.correct_epoch):
+            params = net_ensemble.parameters(opt.correct_window)
+            optimizer = get_optim(params, opt.lr / lr_scaler, opt.L2)
+            plateau = None
+            if holdout_loader is not None:
+                plateau = EpochPlateau(opt.plateau_tol, heldout_mse(net_ensemble, holdout_loader, train_cache))
+            for correct_epochs in range(1, max_epochs(opt.correct_epoch, holdout_loader) + 1):
                 stage_loss = []
-                for i, (x, y) in enumerate(train_loader):
-                    if opt.cuda:
-                        x, y = x.cuda(), y.cuda().view(-1, 1)
-                    _, out = net_ensemble.forward_grad(x)
-                    out = torch.as_tensor(out, dtype=torch.float32).cuda().view(-1, 1)
+                for i, (x, y, _) in enumerate(train_loader):
+                    x, y = x.to(device), y.to(device).view(-1, 1)
+                    with bf16_autocast(opt.bf16):
+                        _, out = net_ensemble.forward_grad(x, opt.correct_window, opt.checkpoint_segment, opt.stage_cache)
+                    out = torch.as_tensor(out, dtype=torch.float32, device=device).view(-1, 1)
                     
                     loss = loss_f1(out, y) 
                     optimizer.zero_grad()
                     loss.backward()
+                    all_reduce_grads(params)
                     optimizer.step()
                     stage_loss.append(loss.item()*len(y))
+                if plateau is not None and plateau.stop(heldout_mse(net_ensemble, holdout_loader, train_cache)):
+                    break
+            # Under --stage_cache the learners before the window ran in eval mode and did not change
+            first = net_ensemble.window_start(opt.correct_window) if opt.stage_cache else 0
+            if average_buffers(net_ensemble.models[first:]):
+                # The averaged BatchNorm stats change the outputs cached since the last forward_grad
+                net_ensemble.changed(first)
+        if rank != 0:
+            if opt.patience and broadcast_flag(False):
+                break
+            continue
         #print(net_ensemble.boost_rate)
         # store model
         elapsed_tr = time.time()-t0
         sl = 0
         if stage_loss != []:
             sl = np.sqrt(np.sum(stage_loss)/N)
+        epochs_used.append([learner_epochs, correct_epochs])
 
-        print(f'Stage - {stage}, training time: {elapsed_tr: .1f} sec, model MSE loss: {sml: .5f}, Ensemble Net MSE Loss: {sl: .5f}')
+        print(f'Stage - {stage}, training time: {elapsed_tr: .1f} sec, model MSE loss: {sml: .5f}, Ensemble Net MSE Loss: {sl: .5f}, '
+              f'epochs: {learner_epochs} learner, {correct_epochs} corrective')
 
-        net_ensemble.to_file(opt.out_f)
-        net_ensemble = DynamicNet.from_file(opt.out_f, lambda stage: MLP_2HL.get_model(stage, opt))
+        # store model: writes the stages changed since the last save (models/checkpoint.py)
+        checkpoint.save(net_ensemble)
 
-        if opt.cuda:
-            net_ensemble.to_cuda()
         net_ensemble.to_eval() # Set the models in ensemble net to eval mode
+        if opt.staged_eval:
+            continue
 
         # Train
-        tr_rmse  = root_mse(net_ensemble, train_loader)
+        tr_rmse  = root_mse(net_ensemble, train_loader, train_cache)
         if opt.cv:
-            val_rmse = root_mse(net_ensemble, val_loader) 
+            val_rmse = root_mse(net_ensemble, val_loader, val_cache)
             if val_rmse < best_rmse:
                 best_rmse = val_rmse
                 best_stage = stage
+                if opt.patience:
+                    best_state = net_ensemble.snapshot()
 
-        te_rmse  = root_mse(net_ensemble, test_loader)
+        te_rmse  = root_mse(net_ensemble, test_loader, test_cache)
 
         print(f'Stage: {stage}  RMSE@Tr: {tr_rmse:.5f}, RMSE@Val: {val_rmse:.5f}, RMSE@Te: {te_rmse:.5f}')
 
         loss_models[stage, 0], loss_models[stage, 1] = tr_rmse, te_rmse
 
+        if opt.patience and broadcast_flag(stage - best_stage >= opt.patience):
+            stop_reason = f'no RMSE@Val improvement for {opt.patience} stages after stage {best_stage}'
+            break
+
+    if rank != 0:
+        sys.exit(0)
+
+    if best_state is not None and len(net_ensemble.models) > best_stage + 1:
+        # Early stopped: the saved ensemble is the one of the best stage
+        net_ensemble.restore(best_state)
+        loss_models = loss_models[:stage + 1]
+    print(f'Stopped after stage {stage}: {stop_reason}')
+    checkpoint.save(net_ensemble, stop_reason=stop_reason, best_stage=best_stage)
+
+    if opt.staged_eval:
+        # Every prefix of the final ensemble, one cascade pass per set
+        tr_rmses = staged_root_mse(net_ensemble, train_loader)
+        te_rmses = staged_root_mse(net_ensemble, test_loader)
+        val_rmses = staged_root_mse(net_ensemble, val_loader) if opt.cv else [val_rmse] * len(te_rmses)
+        for stage, (tr_rmse, val_rmse, te_rmse) in enumerate(zip(tr_rmses, val_rmses, te_rmses)):
+            print(f'Stage: {stage}  RMSE@Tr: {tr_rmse:.5f}, RMSE@Val: {val_rmse:.5f}, RMSE@Te: {te_rmse:.5f}')
+            loss_models[stage, 0], loss_models[stage, 1] = tr_rmse, te_rmse
+        if opt.cv:
+            best_stage = int(np.argmin(val_rmses))
+
     tr_rmse, te_rmse = loss_models[best_stage, 0], loss_models[best_stage, 1]
     print(f'Best validation stage: {best_stage}  RMSE@Tr: {tr_rmse:.5f}, final RMSE@Te: {te_rmse:.5f}')
     loss_models = loss_models.detach().cpu().numpy()
     fname =  './results/' + opt.data +'_rmse'
-    np.savez(fname, rmse=loss_models, params=opt) 
+    np.savez(fname, rmse=loss_models, epochs_used=epochs_used, stop_reason=stop_reason, params=opt) 
 
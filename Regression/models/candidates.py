@@ -0,0 +1,26 @@
+import pickle
+import numpy as np
+import torch
+from models.fork import fork_map
+
+
+def train_candidates(fit, num_candidates, num_threads=1):
+    """Runs `fit(k)` for k = 0 .. num_candidates-1 in forked processes and
+    returns their results in candidate order.
+
+    Every process is forked from the caller (models/fork.py), so it sees the
+    frozen ensemble, data loaders and caches as they are now and its changes
+    to them stay in the process. Each candidate gets its own torch and numpy
+    seed. The result of `fit` (typically the trained learner and its losses)
+    must be picklable. CPU only (Linux).
+    """
+    seeds = np.random.randint(2 ** 31 - 1, size=num_candidates)
+
+    def run(k):
+        torch.set_num_threads(num_threads)
+        torch.manual_seed(int(seeds[k]))
+        np.random.seed(int(seeds[k]))
+        # Pickled to bytes here so the result does not go through shared memory,
+        # which would have to outlive this process
+        return pickle.dumps(fit(k))
+    return [pickle.loads(payload) for payload in fork_map(run, num_candidates, 'Candidate')]
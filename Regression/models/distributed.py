@@ -0,0 +1,100 @@
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+# Data-parallel helpers for the boosting loop. Every rank holds a shard of the
+# training rows and an identical copy of the ensemble; the learner being fit
+# and the corrective step average their gradients over the ranks before each
+# optimizer step, so the replicas stay equal. All of them are no-ops when the
+# script was not started by a distributed launcher.
+
+
+def _active():
+    return dist.is_available() and dist.is_initialized()
+
+
+def init_distributed(backend='gloo'):
+    """Joins the process group described by the environment (RANK, WORLD_SIZE,
+    MASTER_ADDR, MASTER_PORT, as set by torchrun or torch.distributed.launch)
+    and gives all ranks the same numpy and torch seeds.
+
+    :return: (rank, world_size), (0, 1) when not launched that way
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+    dist.init_process_group(backend, init_method='env://')
+    seed = torch.randint(2 ** 31 - 1, (1,))
+    dist.broadcast(seed, 0)
+    np.random.seed(seed.item())
+    torch.manual_seed(seed.item())
+    return dist.get_rank(), world_size
+
+
+def shard_indices(n, rank, world_size):
+    # Strided shard of n rows; every rank gets n // world_size of them, so all
+    # ranks run the same number of batches
+    return np.arange(rank, n, world_size)[:n // world_size]
+
+
+def min_across_ranks(n):
+    if not _active():
+        return n
+    t = torch.tensor([n], dtype=torch.long)
+    dist.all_reduce(t, op=dist.ReduceOp.MIN)
+    return int(t.item())
+
+
+def broadcast_module(module):
+    # Parameters and buffers of rank 0, e.g. for a freshly initialized learner
+    if not _active():
+        return
+    for t in module.state_dict().values():
+        dist.broadcast(t, 0)
+
+
+def all_reduce_grads(params):
+    # Averages the gradients over the ranks in one flat message
+    if not _active():
+        return
+    grads = [p.grad.data for p in params if p.grad is not None]
+    if not grads:
+        return
+    flat = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    for g, synced in zip(grads, _unflatten_dense_tensors(flat, grads)):
+        g.copy_(synced)
+
+
+def average_buffers(modules):
+    # BatchNorm running statistics are updated from the local shard only;
+    # returns whether the buffers were averaged (changed)
+    if not _active():
+        return False
+    for m in modules:
+        for b in m.buffers():
+            if b.is_floating_point():
+                dist.all_reduce(b)
+                b /= dist.get_world_size()
+    return True
+
+
+def all_reduce_mean(value):
+    # Mean of a python number over the ranks, e.g. a training loss for the log
+    if not _active():
+        return value
+    t = torch.tensor([float(value)], dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.item() / dist.get_world_size()
+
+
+def broadcast_flag(flag):
+    # Rank 0's decision (e.g. to stop training) on every rank
+    if not _active():
+        return flag
+    t = torch.tensor([int(flag)])
+    dist.broadcast(t, 0)
+    return bool(t.item())
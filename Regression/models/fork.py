@@ -0,0 +1,49 @@
+import queue
+import traceback
+import torch.multiprocessing as mp
+
+
+def fork_map(fn, n, name='Process'):
+    """[fn(k) for k in range(n)], every call in its own forked process.
+
+    The processes see the caller's state as it is now and their changes to it
+    stay in the process, so results must come back through the return value
+    (picklable) or memory shared before the fork. An exception in `fn` or a
+    process that dies without reporting (e.g. out of memory) raises a
+    RuntimeError naming `name` and k; the other processes are then stopped.
+    CPU only (Linux).
+    """
+    ctx = mp.get_context('fork')
+    out_queue = ctx.Queue()
+
+    def run(k):
+        try:
+            out_queue.put((k, fn(k), None))
+        except Exception:
+            out_queue.put((k, None, traceback.format_exc()))
+
+    procs = [ctx.Process(target=run, args=(k,)) for k in range(n)]
+    for p in procs:
+        p.start()
+    results = [None] * n
+    pending = set(range(n))
+    try:
+        while pending:
+            try:
+                k, result, error = out_queue.get(timeout=1.)
+            except queue.Empty:
+                # killed before it could report
+                dead = [k for k in pending if procs[k].exitcode not in (None, 0)]
+                if dead:
+                    raise RuntimeError(f'{name} {dead[0]} exited with code {procs[dead[0]].exitcode}')
+                continue
+            if error is not None:
+                raise RuntimeError(f'{name} {k} failed:\n{error}')
+            results[k] = result
+            pending.discard(k)
+    finally:
+        for p in procs:
+            if p.is_alive() and pending:
+                p.terminate()
+            p.join()
+    return results
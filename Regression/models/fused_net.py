@@ -0,0 +1,97 @@
+from typing import Tuple
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from .mlp import MLP_2HL
+
+
+def _bn_affine(bn):
+    # BatchNorm1d in eval mode is y = x * scale + shift
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    return scale, shift
+
+
+class FusedDynamicNet(nn.Module):
+    """Inference-only version of a DynamicNet made of MLP_2HL learners.
+
+    The x-slices of all `in_layer` weights are packed into one matrix, so the
+    raw features go through a single wide matmul for the whole ensemble. Only
+    the small middle_feat projection is left in the sequential cascade.
+    BatchNorm layers (bn2 in front of `in_layer`, bn in front of
+    `hidden_layer`) are folded into the neighbouring Linear layers using their
+    running statistics, and the per-stage out_layers are summed with one
+    matrix-vector product. Weights are a snapshot: fuse again after training.
+    """
+    def __init__(self, net_ensemble, chunk_size=4096):
+        super(FusedDynamicNet, self).__init__()
+        self.chunk_size = chunk_size
+        models = net_ensemble.models
+        if len(models) == 0:
+            raise ValueError('Cannot fuse an empty ensemble')
+        for m in models:
+            if not isinstance(m, MLP_2HL):
+                raise ValueError(f'Fusing is only implemented for MLP_2HL learners, got {type(m).__name__}')
+        self.num_stages = len(models)
+        self.feat_d = models[0].in_layer.weight.shape[1]
+        self.hidden1 = models[0].in_layer.weight.shape[0]
+        self.hidden2 = models[0].hidden_layer.weight.shape[0]
+        self.c0 = float(net_ensemble.c0)
+        self.boost_rate = net_ensemble.boost_rate.item()
+
+        in_x, in_bias, in_mid = [], [], []
+        hidden_w, hidden_b, out_w = [], [], []
+        out_b = 0.
+        with torch.no_grad():
+            for stage, m in enumerate(models):
+                w, b = m.in_layer.weight, m.in_layer.bias
+                if stage > 0:
+                    scale, shift = _bn_affine(m.bn2)
+                    b = b + w.mv(shift)
+                    w = w * scale
+                    in_mid.append(w[:, self.feat_d:].t())
+                in_x.append(w[:, :self.feat_d])
+                in_bias.append(b)
+                scale, shift = _bn_affine(m.bn)
+                w, b = m.hidden_layer.weight, m.hidden_layer.bias
+                hidden_w.append((w * scale).t())
+                hidden_b.append(b + w.mv(shift))
+                out_w.append(m.out_layer.weight.view(-1))
+                out_b += m.out_layer.bias.item()
+
+            self.register_buffer('in_x_weight', torch.cat(in_x, 0).t().contiguous())
+            self.register_buffer('in_bias', torch.cat(in_bias, 0))
+            if in_mid:
+                self.register_buffer('in_mid_weight', torch.stack(in_mid, 0).contiguous())
+            else:
+                self.register_buffer('in_mid_weight', self.in_bias.new_empty(0, self.hidden2, self.hidden1))
+            self.register_buffer('hidden_weight', torch.stack(hidden_w, 0).contiguous())
+            self.register_buffer('hidden_bias', torch.stack(hidden_b, 0))
+            self.register_buffer('out_weight', torch.cat(out_w, 0))
+        self.out_bias = out_b
+
+    def forward(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
+        if x.shape[0] <= self.chunk_size:
+            return self._forward(x)
+        # Keep the (rows, num_stages * hidden) intermediates cache-sized on big inputs
+        middle_feat, out = [], []
+        for chunk in torch.split(x, self.chunk_size):
+            m, o = self._forward(chunk)
+            middle_feat.append(m)
+            out.append(o)
+        return torch.cat(middle_feat, 0), torch.cat(out, 0)
+
+    def _forward(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
+        # x part of every stage's in_layer at once: (N, num_stages * hidden1)
+        xw = torch.addmm(self.in_bias, x, self.in_x_weight)
+        middle_feat = x.new_empty(0)
+        feats = []
+        for stage in range(self.num_stages):
+            out = xw[:, stage * self.hidden1:(stage + 1) * self.hidden1]
+            if stage > 0:
+                out = torch.addmm(out, middle_feat, self.in_mid_weight[stage - 1])
+            out = F.leaky_relu(out, 0.1)
+            middle_feat = torch.addmm(self.hidden_bias[stage], out, self.hidden_weight[stage])
+            feats.append(middle_feat)
+        prediction = torch.relu(torch.cat(feats, 1)).mv(self.out_weight) + self.out_bias
+        return middle_feat, self.c0 + self.boost_rate * prediction
@@ -0,0 +1,21 @@
+import torch
+
+
+class _NoCast(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def bf16_autocast(enabled):
+    """bfloat16 autocast on CPU (torch >= 1.10); a no-op context if not enabled.
+
+    Linear layers run in bf16 while the weights stay fp32. DynamicNet sums the
+    stage outputs and applies c0 and boost_rate in fp32, so the ensemble
+    output is always fp32.
+    """
+    if not enabled:
+        return _NoCast()
+    return torch.autocast('cpu', dtype=torch.bfloat16)
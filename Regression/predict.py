@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+import numpy as np
+import argparse
+import collections
+import multiprocessing
+import os
+import time
+import torch
+from data.stream import count_rows, iter_chunks
+from models.mlp import MLP_2HL
+from models.dynamic_net import DynamicNet
+from models.checkpoint import read_scaler
+from models.pipeline import PipelineDynamicNet
+
+
+parser = argparse.ArgumentParser()
+# A checkpoint (file or directory) and the options the ensemble was trained with
+parser.add_argument('--model', type=str, required=True)
+parser.add_argument('--feat_d', type=int, required=True)
+parser.add_argument('--hidden_d', type=int, required=True)
+parser.add_argument('--input', type=str, required=True)
+parser.add_argument('--format', type=str, default='libsvm', choices=['libsvm', 'csv', 'npz'])
+parser.add_argument('--zero_based', type=str, default='auto')
+# Feature scaling: 'auto' applies the scaler main_cls_cv.py / main_reg_cv.py saved with the checkpoint
+# (--normalization True), if there is one
+parser.add_argument('--scaler', type=str, default='auto', choices=['auto', 'none'])
+parser.add_argument('--chunk_size', type=int, default=100000)
+# Scores are written to this .npy file through a memory map
+parser.add_argument('--out_f', type=str, required=True)
+# Score chunks in this many processes (CPU only); --num_threads is then per worker
+parser.add_argument('--workers', type=int, default=1)
+# Or split the stages into this many contiguous groups, one process each, scoring
+# batches of --pipeline_batch rows in a pipeline (CPU only)
+parser.add_argument('--stage_groups', type=int, default=1)
+parser.add_argument('--pipeline_batch', type=int, default=4096)
+parser.add_argument('--cuda', action='store_true')
+parser.add_argument('--num_threads', type=int, default=0)
+
+opt = parser.parse_args()
+opt.sparse = False
+if opt.cuda and (opt.workers > 1 or opt.stage_groups > 1):
+    parser.error('--workers and --stage_groups need CPU scoring')
+if opt.workers > 1 and opt.stage_groups > 1:
+    parser.error('use either --workers or --stage_groups')
+
+device = torch.device('cuda' if opt.cuda else 'cpu')
+if not opt.cuda:
+    # Split the cores available to this process between the workers unless given
+    num_threads = opt.num_threads or max(1, len(os.sched_getaffinity(0)) // max(opt.workers, opt.stage_groups))
+    torch.set_num_threads(num_threads)
+
+
+def get_scaler():
+    if opt.scaler == 'none':
+        return None
+    scaler = read_scaler(opt.model)
+    if scaler is None:
+        print(f'No scaler saved with {opt.model}, scoring unscaled features')
+    return scaler
+
+
+def zero_based():
+    return opt.zero_based if opt.zero_based == 'auto' else opt.zero_based.lower() == 'true'
+
+
+def scorer(net_ensemble, pipeline=None):
+    if pipeline is not None:
+        return lambda x: pipeline.forward(x, opt.pipeline_batch)[1]
+    # The fused graph gives the same scores with far fewer kernel calls
+    if not net_ensemble.quantized and all(isinstance(m, MLP_2HL) for m in net_ensemble.models):
+        fused = net_ensemble.fuse().to(device)
+        fused.share_memory()
+        return lambda x: fused(x)[1]
+    for m in net_ensemble.models:
+        m.share_memory()
+    return lambda x: net_ensemble.forward(x)[1]
+
+
+# Per-process scoring state. Workers are forked after the model is loaded into
+# shared memory, so they all read the same weights, and each writes its chunks
+# straight into the output memmap at their row offset, which keeps the output
+# in input order without sending scores back.
+_worker = {}
+
+def init_worker(score, scaler, out_f):
+    if not opt.cuda:
+        torch.set_num_threads(num_threads)
+    _worker['score'] = score
+    _worker['scaler'] = scaler
+    _worker['out'] = np.load(out_f, mmap_mode='r+')
+
+def score_chunk(pos, x):
+    if _worker['scaler'] is not None:
+        x = _worker['scaler'].transform(x).astype(np.float32)
+    t0 = time.time()
+    with torch.no_grad():
+        _worker['out'][pos:pos + len(x)] = _worker['score'](torch.from_numpy(x).to(device)).view(-1).cpu().numpy()
+    return time.time() - t0
+
+
+if __name__ == "__main__":
+    net_ensemble = DynamicNet.from_file(opt.model, lambda stage: MLP_2HL.get_model(stage, opt), device)
+    net_ensemble.to_eval()
+    pipeline = None
+    if opt.stage_groups > 1:
+        pipeline = PipelineDynamicNet(net_ensemble, opt.stage_groups, num_threads)
+    score = scorer(net_ensemble, pipeline)
+    scaler = get_scaler()
+
+    num_rows = count_rows(opt.input, opt.format)
+    out = np.lib.format.open_memmap(opt.out_f, mode='w+', dtype=np.float32, shape=(num_rows,))
+    del out     # created here, written by score_chunk
+    print(f'#Rows: {num_rows}, #Stages: {len(net_ensemble.models)}, chunk size: {opt.chunk_size}, '
+          f'workers: {opt.workers} x {torch.get_num_threads()} threads')
+
+    t0 = time.time()
+    t_model = 0.
+    pos = 0
+    if opt.workers > 1:
+        pool = multiprocessing.get_context('fork').Pool(opt.workers, init_worker, (score, scaler, opt.out_f))
+        pending = collections.deque()
+        for x in iter_chunks(opt.input, opt.format, opt.feat_d, opt.chunk_size, zero_based()):
+            # at most two chunks in flight per worker keeps memory bounded
+            if len(pending) >= 2 * opt.workers:
+                t_model += pending.popleft().get()
+            pending.append(pool.apply_async(score_chunk, (pos, x)))
+            pos += len(x)
+        t_model += sum(p.get() for p in pending)
+        pool.close()
+        pool.join()
+    else:
+        init_worker(score, scaler, opt.out_f)
+        for x in iter_chunks(opt.input, opt.format, opt.feat_d, opt.chunk_size, zero_based()):
+            t_model += score_chunk(pos, x)
+            pos += len(x)
+        _worker['out'].flush()
+    elapsed = time.time() - t0
+    if pipeline is not None:
+        pipeline.close()
+
+    if pos != num_rows:
+        print(f'Warning: read {pos} rows, expected {num_rows} (blank lines?)')
+    print(f'Wrote {opt.out_f}: {pos / elapsed:.0f} rows/s end to end, '
+          f'{pos * opt.workers / max(t_model, 1e-9):.0f} rows/s in the model')
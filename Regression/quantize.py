@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+import numpy as np
+import argparse
+import os
+import sys
+import time
+import torch
+from data.sparseloader import DataLoader
+from data.data import LibSVMRegData
+from models.mlp import MLP_2HL
+from models.dynamic_net import DynamicNet
+from models.checkpoint import read_scaler, write_scaler
+
+
+parser = argparse.ArgumentParser()
+# A checkpoint written by main_reg_cv.py and the options it was trained with
+parser.add_argument('--model', type=str, required=True)
+parser.add_argument('--feat_d', type=int, required=True)
+parser.add_argument('--hidden_d', type=int, required=True)
+parser.add_argument('--data', type=str, required=True)
+parser.add_argument('--te', type=str, required=True)
+parser.add_argument('--normalization', default=False, type=lambda x: (str(x).lower() == 'true'))
+parser.add_argument('--batch_size', type=int, default=2048)
+parser.add_argument('--out_f', type=str, required=True)
+# Exit with status 1 if the test RMSE grows by more than this
+parser.add_argument('--max_drift', type=float, default=None)
+parser.add_argument('--num_threads', type=int, default=0)
+
+opt = parser.parse_args()
+opt.sparse = False      # the int8 learners take dense inputs
+
+device = torch.device('cpu')
+torch.set_num_threads(opt.num_threads or len(os.sched_getaffinity(0)))
+
+# Same test sets and preprocessing as main_reg_cv.py, with the scaler it fit on its
+# training split and saved with the checkpoint
+def get_data():
+    if opt.data in ['ca_housing', 'ailerons', 'YearPredictionMSD', 'slice_localization']:
+        test = LibSVMRegData(opt.te, opt.feat_d, opt.normalization)
+    else:
+        pass
+
+    scaler = None
+    if opt.normalization:
+        scaler = read_scaler(opt.model)
+        if scaler is None:
+            parser.error(f'--normalization: no scaler saved with {opt.model}')
+        test.feat = scaler.transform(test.feat)
+
+    print(f'#Test: {len(test)}')
+    return test, scaler
+
+
+def predict(net_ensemble, loader):
+    scores = []
+    t0 = time.time()
+    for x, _ in loader:
+        with torch.no_grad():
+            _, out = net_ensemble.forward(x.to(device))
+        scores.append(out.view(-1))
+    return torch.cat(scores), time.time() - t0
+
+
+def root_mse(scores, label):
+    return torch.sqrt(((scores.double() - label.double()) ** 2).mean()).item()
+
+
+if __name__ == "__main__":
+
+    test, scaler = get_data()
+    builder = lambda stage: MLP_2HL.get_model(stage, opt)
+    net_ensemble = DynamicNet.from_file(opt.model, builder, device)
+    net_ensemble.to_eval()
+    net_ensemble.quantize().to_file(opt.out_f)
+    # Next to the int8 file, so predict.py and serve.py scale its inputs as in training
+    write_scaler(opt.out_f, scaler)
+    # Score with the reloaded file so the saved model is what gets checked
+    qnet = DynamicNet.from_file(opt.out_f, builder, device)
+
+    test_loader = DataLoader(test, opt.batch_size, shuffle=False, drop_last=False, num_workers=2)
+    label = torch.as_tensor(test.label, dtype=torch.float32)
+    scores, t_float = predict(net_ensemble, test_loader)
+    qscores, t_int8 = predict(qnet, test_loader)
+    rmse_float, rmse_int8 = root_mse(scores, label), root_mse(qscores, label)
+    drift = rmse_int8 - rmse_float
+
+    print(f'#Stages: {len(net_ensemble.models)}, model size: {os.path.getsize(opt.out_f) / 1024:.1f} KB (int8)')
+    print(f'float32: RMSE@Test: {rmse_float:.5f}, {len(test) / t_float:.0f} rows/s')
+    print(f'int8:    RMSE@Test: {rmse_int8:.5f}, {len(test) / t_int8:.0f} rows/s')
+    print(f'RMSE drift: {drift:.5f}, max abs score diff: {(scores - qscores).abs().max().item():.2e}')
+    if opt.max_drift is not None and drift > opt.max_drift:
+        print(f'RMSE drift above {opt.max_drift}')
+        sys.exit(1)
@@ -30,5 +30,5 @@ CUDA_VISIBLE_DEVICES=0 python -u main_reg_cv.py \
     --correct_epoch 1 \
     --normalization True \
     --cv True \
-    --out_f ${OUTDIR}/${dataset}_cls.pth \
+    --out_f ${OUTDIR}/${dataset}_reg \
     --cuda